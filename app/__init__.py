@@ -3,7 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
 from datetime import timedelta
+import logging
 import os
+from .intake import UploadRequest
 
 bcrypt = Bcrypt()
 login_manager = LoginManager()
@@ -12,7 +14,13 @@ login_manager.login_view = 'auth.login'
 db = SQLAlchemy()  # Make sure db is instantiated here if not imported
 
 def create_app():
+    # DEBUG turns on per-stage detail from the analysis pipeline; it is skipped entirely at INFO
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s",
+    )
     app = Flask(__name__, static_folder="static")
+    app.request_class = UploadRequest
 
     # Load base config from config.py
     app.config.from_object('config')
@@ -30,8 +38,123 @@ def create_app():
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
     app.config["ALLOWED_EXTENSIONS"] = {"png", "jpg", "jpeg", "gif", "heic", "heif"}
     app.config["ELA_QUALITY"] = 90 # Quality for ELA re-compression
+    # Extra qualities ELA re-compresses at to score regions (a sweep catches double-compressed pastes)
+    app.config["ELA_SWEEP"] = tuple(int(q) for q in os.environ.get("ELA_SWEEP", "55,75").split(",") if q.strip())
+    app.config["COPY_MOVE_MODE"] = os.environ.get("COPY_MOVE_MODE", "block")  # "block" or "orb" (fast)
+    # Full-resolution ELA/noise in tiles instead of downscaling to 1920px and re-encoding
+    app.config["TILED_ANALYSIS"] = os.environ.get("TILED_ANALYSIS", "0") == "1"
+    app.config["TILE_SIZE"] = 1024
+    app.config["HEATMAP_MAX_SIDE"] = 2048
+    # Heatmaps go out as overviews no larger than ARTIFACT_MAX_SIDE: lossy WebP ("webp") or palette PNG ("png")
+    # for per-pixel maps, palette PNG for block maps. Regions and copy-move matches are vector data in the JSON.
+    app.config["ARTIFACT_FORMAT"] = os.environ.get("ARTIFACT_FORMAT", "webp")
+    app.config["ARTIFACT_MAX_SIDE"] = int(os.environ.get("ARTIFACT_MAX_SIDE", 1024))
+    # Tile size of the zoom pyramids of larger heatmaps (tiled analysis only, by default); 0 disables them
+    app.config["ARTIFACT_PYRAMID_TILE"] = int(os.environ.get(
+        "ARTIFACT_PYRAMID_TILE", 512 if app.config["TILED_ANALYSIS"] else 0))
+    # Decode big-enough embedded HEIC thumbnails instead of the primary image (faster; trusts the thumbnail)
+    app.config["HEIF_THUMBNAILS"] = os.environ.get("HEIF_THUMBNAILS", "0") == "1"
+    # JPEG-domain analysis decodes DCT coefficients in Python unless jpegio is installed (about 0.4s per
+    # megapixel, and then charged as an expensive detector); bigger uploads get the tables only
+    app.config["JPEG_DCT_MAX_PIXELS"] = int(os.environ.get("JPEG_DCT_MAX_PIXELS", 1_000_000))
+    # Optional JSON file of {quantization table digest: camera or program} for table fingerprinting
+    app.config["JPEG_KNOWN_TABLES"] = os.environ.get("JPEG_KNOWN_TABLES") or None
+
+    # JSON responses larger than this are compressed (br if the brotli module is installed, else gzip)
+    # when the client accepts it; clients sending "Accept: application/msgpack" get MessagePack if installed
+    app.config["RESPONSE_COMPRESS_MIN_BYTES"] = int(os.environ.get("RESPONSE_COMPRESS_MIN_BYTES", 1024))
+    app.config["RESPONSE_COMPRESS_LEVEL"] = int(os.environ.get("RESPONSE_COMPRESS_LEVEL", 5))
 
     app.config['MAX_CONTENT_LENGTH'] = 60 * 1024 * 1024  # 60MB max upload size
+    # Uploads stay in memory up to this size and spill to a temp file (in UPLOAD_SPILL_DIR) beyond it
+    app.config["UPLOAD_MEMORY_BYTES"] = int(os.environ.get("UPLOAD_MEMORY_BYTES", 16 * 1024 * 1024))
+    app.config["UPLOAD_SPILL_DIR"] = os.environ.get("UPLOAD_SPILL_DIR") or None
+    # Uploads whose header declares more pixels than this are rejected before decoding (decompression bombs)
+    app.config["MAX_IMAGE_PIXELS"] = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+
+    # Detectors run concurrently within a request, on up to DETECTOR_WORKERS threads of its own; ones still
+    # running DETECTOR_TIMEOUT seconds after they started are reported as "timeout" without waiting for them
+    app.config["DETECTOR_EXECUTOR"] = os.environ.get("DETECTOR_EXECUTOR", "thread")  # "thread" or "inline"
+    app.config["DETECTOR_WORKERS"] = int(os.environ.get("DETECTOR_WORKERS", 4))
+    app.config["DETECTOR_TIMEOUT"] = float(os.environ.get("DETECTOR_TIMEOUT", 30))  # seconds
+    # Under load, costly detectors are skipped ("skipped" in method_status) rather than queued behind others.
+    # Load is the analyses in progress in a worker per unit of capacity; a threshold of 0 never sheds.
+    app.config["ANALYSIS_CAPACITY"] = int(os.environ.get("ANALYSIS_CAPACITY", os.cpu_count() or 2))
+    app.config["SHED_EXPENSIVE_LOAD"] = float(os.environ.get("SHED_EXPENSIVE_LOAD", 1.0))  # copy-move
+    app.config["SHED_MODERATE_LOAD"] = float(os.environ.get("SHED_MODERATE_LOAD", 2.0))  # ELA, noise, JPEG
+    # At most ANALYSIS_CAPACITY synchronous analyses/previews run at once per worker; the rest wait for a slot.
+    # While even the quickest wait over an interval exceeds the target, new ones get a 503 with Retry-After.
+    app.config["ANALYSIS_QUEUE_TARGET"] = float(os.environ.get("ANALYSIS_QUEUE_TARGET", 0.5))  # seconds
+    app.config["ANALYSIS_QUEUE_INTERVAL"] = float(os.environ.get("ANALYSIS_QUEUE_INTERVAL", 2.0))  # seconds
+    app.config["ANALYSIS_QUEUE_TIMEOUT"] = float(os.environ.get("ANALYSIS_QUEUE_TIMEOUT", 30))  # seconds
+
+    # Token buckets per user and per IP, charged per MB uploaded and per selected detector (see app/ratelimit.py)
+    app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+    app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # "memory" or "redis"
+    app.config["RATE_LIMIT_REDIS_URL"] = os.environ.get("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+    app.config["RATE_LIMIT_USER_RATE"] = float(os.environ.get("RATE_LIMIT_USER_RATE", 1.0))  # tokens per second
+    app.config["RATE_LIMIT_USER_BURST"] = float(os.environ.get("RATE_LIMIT_USER_BURST", 60))
+    app.config["RATE_LIMIT_IP_RATE"] = float(os.environ.get("RATE_LIMIT_IP_RATE", 2.0))
+    app.config["RATE_LIMIT_IP_BURST"] = float(os.environ.get("RATE_LIMIT_IP_BURST", 120))
+    app.config["RATE_LIMIT_BYTES_PER_TOKEN"] = int(os.environ.get("RATE_LIMIT_BYTES_PER_TOKEN", 1024 * 1024))
+    # Reverse proxies in front of the app whose X-Forwarded-For is trusted (1 behind Heroku's router, as in the
+    # Procfile). Behind a proxy that isn't counted here, every client shares the proxy's address and so one IP
+    # bucket; counting a proxy that isn't there lets clients pick their own address. 0 uses the peer address.
+    app.config["PROXY_FIX_X_FOR"] = int(os.environ.get("PROXY_FIX_X_FOR", 0))
+    # Refuse analyses from clients that aren't logged in (they are otherwise limited per IP only)
+    app.config["ANALYZE_REQUIRE_LOGIN"] = os.environ.get("ANALYZE_REQUIRE_LOGIN", "0") == "1"
+
+    # Result cache keyed by decoded-pixel hash, detector and parameters
+    app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")  # "memory", "disk", "redis" or "none"
+    app.config["CACHE_MAX_BYTES"] = int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    app.config["CACHE_MAX_AGE"] = int(os.environ.get("CACHE_MAX_AGE", 24 * 3600))  # seconds
+    app.config["CACHE_DIR"] = os.environ.get("CACHE_DIR", os.path.join(app.instance_path, "analysis_cache"))
+    app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+    # Heatmaps are stored by content hash, sharded ("local") or in an S3-compatible bucket ("s3");
+    # "none" leaves them as plain files in UPLOAD_FOLDER with no expiry
+    app.config["ARTIFACT_STORAGE"] = os.environ.get("ARTIFACT_STORAGE", "local")
+    app.config["ARTIFACT_DIR"] = os.environ.get("ARTIFACT_DIR") or None  # local store root; defaults to UPLOAD_FOLDER
+    app.config["ARTIFACT_S3_BUCKET"] = os.environ.get("ARTIFACT_S3_BUCKET", "")
+    app.config["ARTIFACT_S3_PREFIX"] = os.environ.get("ARTIFACT_S3_PREFIX", "artifacts/")
+    app.config["ARTIFACT_S3_ENDPOINT"] = os.environ.get("ARTIFACT_S3_ENDPOINT") or None  # MinIO or a local stub
+    app.config["ARTIFACT_S3_REGION"] = os.environ.get("ARTIFACT_S3_REGION") or None
+    # Background GC: artifacts expire after ARTIFACT_MAX_AGE and the oldest go first beyond ARTIFACT_MAX_BYTES
+    app.config["ARTIFACT_MAX_AGE"] = int(os.environ.get("ARTIFACT_MAX_AGE", 7 * 24 * 3600))  # seconds, also the HTTP max-age
+    app.config["ARTIFACT_MAX_BYTES"] = int(os.environ.get("ARTIFACT_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+    app.config["ARTIFACT_GC_INTERVAL"] = int(os.environ.get("ARTIFACT_GC_INTERVAL", 600))  # seconds; 0 disables
+
+    # Async analysis jobs (POST /analyze?async=1)
+    app.config["JOB_BACKEND"] = os.environ.get("JOB_BACKEND", "process")  # "process" or "thread"
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 2))
+    app.config["JOB_MAX_PENDING"] = int(os.environ.get("JOB_MAX_PENDING", 16))  # queued + running before 429
+    app.config["JOB_RESULT_TTL"] = 600  # seconds a finished job's result is kept
+    # Progressive analysis (POST /analyze?progressive=1): quick ELA/noise/metadata on a small proxy first
+    app.config["PREVIEW_MAX_SIDE"] = int(os.environ.get("PREVIEW_MAX_SIDE", 640))
+    app.config["PREVIEW_TIMEOUT"] = float(os.environ.get("PREVIEW_TIMEOUT", 2))  # seconds before a preview detector is skipped
+    # Where the full analysis's stages find the upload and the decoded image; outside static/, so never served
+    app.config["STAGE_FOLDER"] = os.environ.get("STAGE_FOLDER") or os.path.join(app.instance_path, "stages")
+    os.makedirs(app.config["STAGE_FOLDER"], exist_ok=True)
+    # Prometheus-style /metrics and an optional per-response Server-Timing breakdown
+    app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") == "1"
+    app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "0") == "1"
+    app.config["BATCH_MAX_FILES"] = int(os.environ.get("BATCH_MAX_FILES", 1000))  # images per /analyze/batch request
+    # Analysis history rows are queued and written in batches by a background thread
+    app.config["HISTORY_ENABLED"] = os.environ.get("HISTORY_ENABLED", "1") == "1"
+    app.config["HISTORY_BATCH_SIZE"] = int(os.environ.get("HISTORY_BATCH_SIZE", 200))
+    app.config["HISTORY_FLUSH_INTERVAL"] = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 1.0))  # seconds
+    app.config["HISTORY_PAGE_SIZE"] = 50
+    # Perceptual-hash index of every analyzed image; /analyze reports near-duplicates of earlier uploads
+    app.config["FINGERPRINT_INDEX"] = os.environ.get("FINGERPRINT_INDEX", "1") == "1"
+    app.config["FINGERPRINT_RADIUS"] = int(os.environ.get("FINGERPRINT_RADIUS", 10))  # max pHash bits apart
+    app.config["FINGERPRINT_BLOCK_RADIUS"] = int(os.environ.get("FINGERPRINT_BLOCK_RADIUS", 10))  # per grid cell
+    app.config["FINGERPRINT_MIN_BLOCKS"] = int(os.environ.get("FINGERPRINT_MIN_BLOCKS", 4))  # matching cells for a hit
+    # When OpenCV/NumPy and the detectors are imported: "lazy", "background" or "eager" (see app/engines.py)
+    app.config["ENGINE_LOADING"] = os.environ.get("ENGINE_LOADING", "background")
+
+    if app.config["PROXY_FIX_X_FOR"]:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
 
     # Initialize extensions with app
     db.init_app(app)
@@ -54,10 +177,13 @@ def create_app():
     app.register_blueprint(admin_bp, url_prefix='/admin')
     app.register_blueprint(upload_bp)
 
-        # Create tables and ensure admin user exists
-    #print("🟢 Running db.create_all() in app context")
-    #with app.app_context():
-    #    db.create_all()
+    if app.config["ENGINE_LOADING"] == "eager":
+        from .engines import load_engines
+        load_engines()
+
+    # Create the tables of every model (users, analysis history, fingerprints) that don't exist yet
+    with app.app_context():
+        db.create_all()
     #    create_admin_user()
 
     return app
@@ -1,6 +1,11 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, current_app, request
 from flask_login import current_user, login_required, login_user
-from .models import User
+from sqlalchemy import or_
+import os
+from . import metrics
+from .history import history_page
+from .models import Analysis, User
+from .ratelimit import get_admission, get_rate_limiter
 from app import db, bcrypt
 
 #def create_admin_user():
@@ -38,7 +43,25 @@ def admin_panel():
         return redirect(url_for('main.index'))
     users = User.query.filter(User.email != 'admin@myapp.com').all()
     #users = User.query.all()
-    return render_template('admin.html', users=users)
+    return render_template('admin.html', users=users, traffic=_traffic())
+
+def _traffic():
+    # Live counters of the worker serving this page; each gunicorn worker keeps its own
+    app = current_app
+    limiter = get_rate_limiter(app)
+    queue = app.extensions.get("job_queue")
+    usage = limiter.usage() if limiter is not None else []
+    return {
+        "pid": os.getpid(),
+        "admission": get_admission(app).state(),
+        "jobs_pending": queue.pending() if queue is not None else 0,
+        "rate_limit": limiter is not None,
+        "rate_limited": {scope: metrics.RATE_LIMITED.value(scope=scope) for scope in ("user", "ip")},
+        "shed": {reason: metrics.ANALYSES_SHED.value(reason=reason) for reason in ("latency", "timeout")},
+        "queue_rejected": metrics.QUEUE_REJECTED.value(),
+        "usage": usage,
+        "by_key": {row["key"]: row for row in usage},
+    }
 
 @admin_bp.route('/impersonate/<int:user_id>')
 @login_required
@@ -50,3 +73,33 @@ def impersonate(user_id):
     login_user(user)
     flash(f"Now impersonating {user.username}")
     return redirect(url_for("main.index"))
+
+@admin_bp.route('/analyses')
+@login_required
+def analyses():
+    """
+    Every user's analyses, newest first, paged by keyset (?before=<id>).
+
+    Filters: user_id, image_hash, status and min_score (ELA or noise score
+    at least this).
+    """
+    if current_user.role != "admin":
+        flash("Access denied.")
+        return redirect(url_for('main.index'))
+    query = Analysis.query
+    user_id = request.args.get("user_id", type=int)
+    if user_id is not None:
+        query = query.filter(Analysis.user_id == user_id)
+    image_hash = request.args.get("image_hash")
+    if image_hash:
+        query = query.filter(Analysis.image_hash == image_hash)
+    status = request.args.get("status")
+    if status:
+        query = query.filter(Analysis.status == status)
+    min_score = request.args.get("min_score", type=float)
+    if min_score is not None:
+        query = query.filter(or_(Analysis.ela_score >= min_score, Analysis.noise_score >= min_score))
+    rows, next_before = history_page(query, request.args.get("before", type=int),
+                                     current_app.config["HISTORY_PAGE_SIZE"])
+    filters = {key: value for key, value in request.args.items() if key != "before" and value}
+    return render_template('admin_analyses.html', analyses=rows, next_before=next_before, filters=filters)
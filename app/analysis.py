@@ -0,0 +1,644 @@
+"""
+Analysis pipeline shared by the /analyze handler and the background job workers.
+
+Nothing in here touches the Flask request or app context, so the functions can
+run in a worker process as well as in the request thread.
+"""
+import hashlib
+import io
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from PIL import Image
+from .cache import get_result_cache
+from .deadlines import Deadline, DeadlineExceeded, running
+from .detectors import Detector, plan, register, resolve, defaults as detector_defaults
+from .fingerprint import fingerprint, get_fingerprint_index
+from .jpeg import jpegio
+from .metadata import extract_segments, segments_digest
+from .metrics import StageTimer
+from .storage import get_artifact_store, publish_artifacts, scratch_name
+from .utils import (
+    DecodedImage,
+    open_image,
+    ela_analysis,
+    tiled_ela_analysis,
+    noise_analysis,
+    tiled_noise_analysis,
+    copy_move_detection,
+    block_copy_move_detection,
+    jpeg_analysis,
+    metadata_analysis,
+)
+
+MAX_IMAGE_SIZE_MB = 10
+MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+MAX_ANALYSIS_PIXELS = 1920
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisError(Exception):
+    """
+    Raised when an upload can't be turned into an analyzable image.
+    """
+
+
+def _encode_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer
+
+
+def _largest_fitting(qualities, fits):
+    """
+    Binary search for the highest quality in ascending qualities where fits(q)
+    holds, assuming size grows with quality. Returns None if none fits.
+    The top quality is tried first since most images fit there.
+    """
+    if not qualities:
+        return None
+    if fits(qualities[-1]):
+        return qualities[-1]
+    lo, hi = 0, len(qualities) - 2
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if fits(qualities[mid]):
+            best = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return None if best is None else qualities[best]
+
+
+def resize_image_file(img, max_bytes=MAX_IMAGE_SIZE_BYTES, source_size=None,
+                      min_quality=20, max_quality=95, trial_factor=4):
+    """
+    Compress image to be under max_bytes by reducing quality.
+
+    Returns (image, stats). An untouched JPEG upload (img.format is still
+    "JPEG") whose source_size already fits is returned as is, with no encode.
+    Otherwise an encode of the image reduced by trial_factor per side
+    predicts the full-size bytes at each quality and a binary search over
+    that prediction seeds the quality. Each full encode then recalibrates
+    the prediction and narrows the bracket between the best quality known
+    to fit and the lowest known not to, which usually settles in one to
+    three full encodes. A plain binary search over the remaining bracket is
+    the fallback. Qualities
+    move in steps of 5 like before. stats counts full-size "encodes" and
+    reduced "trial_encodes" and gives the chosen "quality" (None when the
+    source was kept).
+    """
+    stats = {"encodes": 0, "trial_encodes": 0, "quality": None}
+    if img.format == "JPEG" and source_size is not None and source_size <= max_bytes:
+        return img, stats
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")  # JPEG can't store alpha or palettes
+
+    qualities = list(range(max_quality, min_quality - 1, -5))[::-1]  # 20, 25, ... 95
+    full = {}
+
+    def full_size(quality):
+        if quality not in full:
+            stats["encodes"] += 1
+            full[quality] = _encode_jpeg(img, quality)
+        return full[quality].tell()
+
+    def fits(quality):
+        return full_size(quality) <= max_bytes
+
+    width, height = img.size
+    quality = None
+    best_fit = None  # highest quality known to fit
+    if min(width, height) >= 64 * trial_factor:
+        trial = img.reduce(trial_factor)
+        area_ratio = (width * height) / float(trial.width * trial.height)
+        trial_sizes = {}
+
+        def predicted(quality):
+            if quality not in trial_sizes:
+                stats["trial_encodes"] += 1
+                trial_sizes[quality] = _encode_jpeg(trial, quality).tell() * area_ratio
+            return trial_sizes[quality]
+
+        candidate = _largest_fitting(qualities, lambda q: predicted(q) <= max_bytes) or min_quality
+        lowest_miss = None  # lowest quality known not to fit
+        for _ in range(4):
+            if fits(candidate):
+                best_fit = candidate
+            else:
+                lowest_miss = candidate
+            # Recalibrate the prediction on the latest full encode
+            correction = full_size(candidate) / predicted(candidate)
+            qualities = [
+                q for q in qualities
+                if (best_fit is None or q > best_fit) and (lowest_miss is None or q < lowest_miss)
+            ]
+            if not qualities:
+                break
+            pick = _largest_fitting(qualities, lambda q: predicted(q) * correction <= max_bytes)
+            if pick is None:
+                if best_fit is not None:
+                    quality = best_fit  # nothing above the known fit is predicted to fit
+                    break
+                pick = qualities[0]
+            candidate = pick
+        if quality is None and not qualities:
+            quality = best_fit or min_quality
+
+    if quality is None:
+        quality = _largest_fitting(qualities, fits) or best_fit or min_quality
+    full_size(quality)
+
+    buffer = full[quality]
+    stats["quality"] = quality
+    buffer.seek(0)
+    return Image.open(buffer), stats
+
+def resize_image_dimensions(img, max_pixels=MAX_ANALYSIS_PIXELS):
+    """
+    Resize image dimensions to a max width or height of max_pixels.
+    """
+    width, height = img.size
+    if max(width, height) <= max_pixels:
+        return img
+
+    ratio = max_pixels / float(max(width, height))
+    new_size = (int(width * ratio), int(height * ratio))
+    return img.resize(new_size, Image.Resampling.LANCZOS)
+
+
+def prepare_image(data, filename, name="image", tiled=False, timer=None, heif_thumbnails=False):
+    """
+    Open, resize/compress and decode raw upload bytes into a DecodedImage.
+
+    With tiled=True the image is kept at full resolution and untouched by
+    the resize/re-encode step; the tiled detectors then work on it in tiles.
+    HEIC/HEIF uploads are decoded straight to pixels (already shrunk towards
+    MAX_ANALYSIS_PIXELS) and skip the JPEG re-encode, which exists to bound
+    the size of encoded uploads. Metadata is read from the upload's headers
+    ("header"). Stage times ("header", "heic_decode" or "decode", then
+    "resize") go to timer.
+    """
+    timer = timer or StageTimer()
+    with timer.stage("header"):
+        segments = extract_segments(data)
+    heic = filename.lower().endswith((".heic", ".heif"))
+    with timer.stage("heic_decode" if heic else "decode"):
+        max_side = None if tiled else MAX_ANALYSIS_PIXELS
+        img, exif = open_image(data, filename, max_side=max_side, heif_thumbnails=heif_thumbnails)
+        if img is None:
+            raise AnalysisError("Could not process image file")
+        img.load()  # PIL decodes lazily; keep the cost in this stage
+
+    source_format = img.format
+
+    encode_stats = None
+    if not tiled:
+        with timer.stage("resize"):
+            img = resize_image_dimensions(img)
+            if source_format != "HEIF":
+                img, encode_stats = resize_image_file(img, source_size=len(data))
+        logger.debug("JPEG encodes: %s", encode_stats)
+
+    logger.debug("Image mode=%s format=%s size=%s", img.mode, img.format, img.size)
+
+    # Decode once into the shared in-memory representation
+    image = DecodedImage(img, exif=exif, name=name, source_format=source_format, segments=segments, source=data)
+    image.encode_stats = encode_stats
+    return image
+
+
+def _artifact_options(settings):
+    return {
+        "fmt": settings["artifact_format"],
+        "max_side": settings["artifact_max_side"],
+        "pyramid_tile": settings["artifact_pyramid_tile"],
+    }
+
+def _run_ela(image, output_folder, settings):
+    if settings["tiled"]:
+        ela_output_path, ela_result_text, details = tiled_ela_analysis(
+            image, output_folder, settings["ela_quality"], settings["tile_size"], settings["heatmap_max_side"],
+            settings["ela_sweep"], _artifact_options(settings))
+    else:
+        ela_output_path, ela_result_text, details = ela_analysis(
+            image, output_folder, settings["ela_quality"], settings["ela_sweep"], _artifact_options(settings))
+    logger.debug("ELA output: %s %s", ela_output_path, ela_result_text)
+    results = {"ela_result": ela_result_text}
+    if ela_output_path:
+        results["ela_image"] = os.path.basename(ela_output_path)
+    if details:
+        results["ela_score"] = details["score"]
+        results["ela_regions"] = details["regions"]
+        results["ela_qualities"] = details["qualities"]
+        results["ela_size"] = details["size"]
+        if details["pyramid"]:
+            results["ela_pyramid"] = details["pyramid"]
+    return results
+
+def _run_noise(image, output_folder, settings):
+    if settings["tiled"]:
+        noise_output_path, noise_result_text, details = tiled_noise_analysis(
+            image, output_folder, settings["tile_size"], _artifact_options(settings))
+    else:
+        noise_output_path, noise_result_text, details = noise_analysis(image, output_folder, _artifact_options(settings))
+    logger.debug("Noise output: %s %s", noise_output_path, noise_result_text)
+    results = {"noise_result": noise_result_text}
+    if noise_output_path:
+        results["noise_image"] = os.path.basename(noise_output_path)
+    if details:
+        results["noise_score"] = details["score"]
+        results["noise_regions"] = details["regions"]
+        results["noise_level"] = details["noise_level"]
+        results["noise_size"] = details["size"]
+    return results
+
+def _run_copy_move(image, output_folder, settings):
+    # Copy-move matching works on the usual analysis size even in tiled mode
+    image = image.downscaled(MAX_ANALYSIS_PIXELS)
+    if settings["copy_move_mode"] == "orb":
+        copy_move_result_text, details = copy_move_detection(image)
+    else:
+        copy_move_result_text, details = block_copy_move_detection(image)
+    logger.debug("Copy-Move output: %s", copy_move_result_text)
+    # Vector data for the client to draw over the original, rather than a rendered composite
+    results = {"copy_move_result": copy_move_result_text}
+    for field in ("regions", "polygons", "matches", "size"):
+        if field in details:
+            results[f"copy_move_{field}"] = details[field]
+    return results
+
+def _run_jpeg(image, output_folder, settings):
+    jpeg_output_path, jpeg_result_text, details = jpeg_analysis(
+        image, output_folder, settings["jpeg_max_pixels"], settings["jpeg_known_tables"],
+        _artifact_options(settings))
+    logger.debug("JPEG output: %s %s", jpeg_output_path, jpeg_result_text)
+    results = {"jpeg_result": jpeg_result_text}
+    if jpeg_output_path:
+        results["jpeg_image"] = os.path.basename(jpeg_output_path)
+    if details:
+        results["jpeg_quality"] = details["quality"]
+        results["jpeg_tables"] = details["tables"]
+    if "double_compressed" in details:
+        results["jpeg_double_compressed"] = details["double_compressed"]
+        results["jpeg_primary_quality"] = details["primary_quality"]
+        results["jpeg_score"] = details["score"]
+        results["jpeg_regions"] = details["regions"]
+        results["jpeg_size"] = details["size"]
+    return results
+
+def _run_metadata(image, output_folder, settings):
+    metadata, signals = metadata_analysis(image)
+    logger.debug("Metadata output: %s %s", metadata, signals)
+    return {"metadata_result": metadata, "metadata_signals": signals}
+
+# Built-in detectors, in the order results are reported. Copy-move is by far
+# the slowest, so it is shed first under load and run as its own progressive
+# stage, as is JPEG analysis when it has to use the built-in decoder.
+register(Detector(
+    "ela", _run_ela, inputs=("gray", "pixels"), cost="moderate", preview=True,
+    params=("ela_quality", "ela_sweep", "tiled", "heatmap_max_side", "artifact_format", "artifact_max_side",
+            "artifact_pyramid_tile"), version=3,
+    defaults={
+        "ela_quality": 90,
+        "ela_sweep": (55, 75),  # extra re-compression qualities for ELA region scoring
+    },
+))
+register(Detector(
+    "noise", _run_noise, inputs=("gray", "rgb", "pixels"), cost="moderate", preview=True,
+    params=("tiled", "artifact_max_side", "artifact_pyramid_tile"), version=3,
+))
+register(Detector(
+    "copy_move", _run_copy_move, inputs=("gray", "bgr"), cost="expensive", aliases=("copymove", "copy-move"),
+    params=("copy_move_mode",), version=2,
+    defaults={
+        "copy_move_mode": "block",  # "block" (duplicated regions) or "orb" (fast keypoint matching)
+    },
+))
+register(Detector(
+    "metadata", _run_metadata, inputs=("exif", "pixels"), cost="cheap", preview=True, version=2,
+))
+# Without jpegio the DCT coefficients are Huffman-decoded in Python, several times slower than ELA
+register(Detector(
+    "jpeg", _run_jpeg, inputs=("bytes",), cost="moderate" if jpegio is not None else "expensive",
+    params=("jpeg_max_pixels", "jpeg_known_tables", "artifact_max_side", "artifact_pyramid_tile"), version=2,
+    defaults={
+        "jpeg_max_pixels": 1_000_000,  # larger JPEGs get table analysis only, unless jpegio is installed
+        "jpeg_known_tables": None,  # JSON file of {quantization table digest: encoder}
+    },
+))
+
+# Detector parameters; callers override them with a settings dict
+DEFAULT_SETTINGS = dict({
+    "tiled": False,  # full-resolution ELA/noise processed tile by tile
+    "tile_size": 1024,
+    "heatmap_max_side": 2048,  # long side of the stitched tiled ELA error map, the top of its pyramid
+    "artifact_format": "webp",  # per-pixel heatmaps (ELA): "webp" (lossy) or "png"; block maps are always PNG
+    "artifact_max_side": 1024,  # long side of the heatmap overviews
+    "artifact_pyramid_tile": 0,  # tile size of the zoom pyramids for heatmaps beyond the overview; 0 for none
+    "heif_thumbnails": False,  # decode a large enough embedded HEIF thumbnail instead of the primary image
+}, **detector_defaults())
+
+# How often _execute looks for newly started detectors whose deadlines it doesn't know yet
+DEADLINE_POLL = 0.05
+
+
+def selected_detectors(selected_methods):
+    """
+    Detector names to run, in report order. An empty selection means all of them.
+    """
+    return [detector.name for detector in resolve(selected_methods)]
+
+
+def _timed(detector, image, output_folder, settings, timer, deadline):
+    with running(deadline), timer.stage(detector.name):
+        return detector.run(image, output_folder, settings)
+
+
+def _await_deadlines(futures):
+    """
+    Wait until every future in {future: (name, deadline)} is done or past its deadline.
+
+    Deadlines start when their detector does, so one still queued behind
+    the others doesn't lose its time; the overdue ones are cancelled and
+    stop at their next check().
+    """
+    pending = set(futures)
+    while pending:
+        for future in list(pending):
+            deadline = futures[future][1]
+            if not future.done() and deadline.expired():
+                deadline.cancel()
+                pending.discard(future)
+        pending = {future for future in pending if not future.done()}
+        if not pending:
+            return
+        bounds = [futures[future][1].remaining() for future in pending]
+        known = [bound for bound in bounds if bound is not None]
+        wait_for = min(known) if known else None
+        if any(not futures[future][1].started.is_set() for future in pending):
+            wait_for = DEADLINE_POLL if wait_for is None else min(wait_for, DEADLINE_POLL)
+        wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+
+def _execute(image, plan, output_folder, settings, executor, workers, timeout, timer=None):
+    """
+    Run an ExecutionPlan and return ({name: results}, {name: status}).
+
+    Detectors the plan skipped are reported as "skipped" with the reason,
+    and one that raises as "error" with the exception's message, so
+    analyze_bytes doesn't cache it. Each detector's run time is added to timer under its own name.
+
+    timeout is per detector and counts from when it starts running. A
+    detector past it is reported as "timeout" and _execute returns without
+    waiting for it; it is also cancelled (see deadlines), so one that
+    checks its deadline stops at its next check() rather than running on
+    in the background. With executor="thread" each call has its own pool of
+    at most workers threads, so no analysis queues behind another's
+    detectors. executor="inline" can't leave a detector behind and only
+    stops the ones that check.
+    """
+    timer = timer or StageTimer()
+    per_method, status = plan.skipped_results()
+
+    def report(name, deadline, outcome=None):
+        # outcome is None for a detector still running past its deadline
+        try:
+            if outcome is not None:
+                per_method[name] = outcome()
+                status[name] = "ok"
+        except DeadlineExceeded:
+            pass
+        except Exception as e:
+            logger.error("%s analysis failed: %s", name, e, exc_info=e)
+            per_method[name] = {f"{name}_error": str(e)}
+            status[name] = "error"
+        if deadline.cancelled.is_set() or name not in status:
+            logger.warning("%s analysis timed out after %ss", name, timeout)
+            per_method[name] = {f"{name}_error": f"Timed out after {timeout} seconds"}
+            status[name] = "timeout"
+
+    if executor == "inline":
+        for detector in plan.detectors:
+            logger.debug("Starting %s analysis", detector.name)
+            deadline = Deadline(timeout)
+            report(detector.name, deadline,
+                   lambda: _timed(detector, image, output_folder, settings, timer, deadline))
+        return per_method, status
+
+    plan.prepare(image, timer)  # products several detectors read, converted once before fanning out
+
+    futures = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(plan.detectors))), thread_name_prefix="detector")
+    try:
+        for detector in plan.detectors:
+            logger.debug("Starting %s analysis", detector.name)
+            deadline = Deadline(timeout)
+            future = pool.submit(_timed, detector, image, output_folder, settings, timer, deadline)
+            futures[future] = (detector.name, deadline)
+        _await_deadlines(futures)
+    finally:
+        # Overdue detectors are left to unwind (or finish) on their own; the response doesn't wait for them
+        pool.shutdown(wait=False)
+
+    for future, (name, deadline) in futures.items():
+        report(name, deadline, future.result if future.done() else None)
+
+    return per_method, status
+
+
+def resolve_settings(settings=None):
+    """
+    DEFAULT_SETTINGS plus every registered detector's defaults, overridden by settings.
+    """
+    merged = dict(detector_defaults(), **DEFAULT_SETTINGS)
+    merged.update(settings or {})
+    return merged
+
+
+def run_analysis(image, selected_methods, output_folder, settings=None,
+                 executor="thread", workers=4, timeout=None, load=0.0, shed_load=None):
+    """
+    Run the selected detectors on a DecodedImage and return the results dict.
+
+    An empty selected_methods list runs every detector and settings overrides
+    DEFAULT_SETTINGS. With executor="thread"
+    the detectors run concurrently and any still running after timeout seconds
+    are reported as "timeout" instead of holding back the others;
+    executor="inline" runs them one after another in the calling thread.
+    load and shed_load are passed to plan(), which may skip costly detectors.
+    results["method_status"] maps each detector to "ok", "timeout", "error"
+    or "skipped".
+    """
+    settings = resolve_settings(settings)
+    methods = selected_detectors(selected_methods)
+    timer = StageTimer()
+    per_method, status = _execute(
+        image, plan(methods, settings, load, shed_load), output_folder, settings, executor, workers, timeout, timer)
+
+    results = {}
+    for name in methods:
+        results.update(per_method[name])
+    results["method_status"] = {name: status[name] for name in methods}
+    results["timings"] = dict(timer.timings)
+    return results
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _near_duplicates(index, digest, image=None):
+    """
+    Earlier images the upload near-duplicates, or None if the index can't say.
+
+    With image the upload is fingerprinted and added to the index; without
+    it, its fingerprint must already be stored.
+    """
+    try:
+        if image is None:
+            stored = index.get(digest)
+            return None if stored is None else index.find(stored, exclude=digest)
+        # Hashes only need a thumbnail, so tiled mode's full-resolution pixels aren't converted
+        found = fingerprint(image.downscaled(MAX_ANALYSIS_PIXELS).gray)
+        near = index.find(found, exclude=digest)
+        index.add(digest, found)
+        return near
+    except Exception:
+        logger.exception("Fingerprint index lookup failed")
+        return None
+
+
+def analyze_bytes(data, filename, selected_methods, output_folder, settings=None,
+                  cache_settings=None, executor="thread", workers=4, timeout=None, upload_digest=None,
+                  storage_settings=None, index_settings=None, load=0.0, shed_load=None, handoff=None):
+    """
+    Decode and analyze raw upload bytes, reusing cached results where possible.
+
+    This is the entry point for both the /analyze handler and background job
+    workers. When every selected detector is cached for an upload we have seen
+    before, the image is not decoded at all. Detectors render into
+    output_folder; with storage_settings their artifacts are then moved into
+    the artifact store and the "*_image" fields and pyramid tiles hold store keys. results["cache_hits"] lists the
+    detectors served from the cache and results["encode_stats"] (present when
+    the image was decoded) reports the JPEG encodes resize_image_file made.
+    With index_settings, results["near_duplicates"] lists earlier images the
+    upload matches in the fingerprint index (see FingerprintIndex.find) and
+    the upload is added to it. results["image_digest"] is the decoded-pixel
+    hash everything above is keyed by.
+    Detectors still to run after the cache are planned with load and
+    shed_load (see detectors.plan); those shed are reported as "skipped",
+    while cached results are returned whatever the load.
+    results["timings"] maps each stage that ran to its duration in seconds.
+    handoff, a dict, lets consecutive calls on the same upload and settings
+    share one decode: the image this call decodes and its digests are stored
+    there, and an image an earlier call stored is used instead of decoding
+    data again (see progressive.analyze_stage).
+    """
+    started = time.perf_counter()
+    timer = StageTimer()
+    settings = resolve_settings(settings)
+    cache = get_result_cache(cache_settings)
+    store = get_artifact_store(storage_settings)
+    index = get_fingerprint_index(index_settings)
+    detectors = resolve(selected_methods)
+    methods = [detector.name for detector in detectors]
+    upload_digest = upload_digest or hash_bytes(data)
+    per_method = {}
+    status = {}
+    encode_stats = None
+    near_duplicates = None
+    digests = None
+
+    def lookup(digests):
+        for detector in detectors:
+            if detector.name in per_method:
+                continue
+            params = detector.cache_params(settings, digests["exif"], upload_digest)
+            cached = cache.get_result(digests["pixels"], detector.name, params, output_folder, store)
+            if cached is not None:
+                per_method[detector.name] = cached
+                status[detector.name] = "ok"
+
+    if cache is not None:
+        with timer.stage("cache"):
+            digests = cache.get_alias(upload_digest)
+            if digests is not None:
+                lookup(digests)
+    hits = list(per_method)
+    if index is not None and digests is not None and len(per_method) == len(methods):
+        with timer.stage("fingerprint"):
+            near_duplicates = _near_duplicates(index, digests["pixels"])
+
+    def pending():
+        return plan([detector for detector in detectors if detector.name not in per_method],
+                    settings, load, shed_load)
+
+    todo = pending()
+    # A fully cached (or shed) upload is still decoded once if the index hasn't fingerprinted it yet
+    if todo.detectors or (index is not None and near_duplicates is None):
+        handed_off = handoff is not None and handoff.get("image") is not None
+        if handed_off:
+            image, digests = handoff["image"], handoff["digests"]
+        else:
+            image = prepare_image(data, filename, tiled=settings["tiled"], timer=timer,
+                                  heif_thumbnails=settings["heif_thumbnails"])
+            with timer.stage("hash"):
+                digests = {"pixels": image.digest(), "exif": segments_digest(image.segments)}
+            # Renders are named after the content plus a per-request suffix, so neither same-named
+            # uploads nor concurrent requests for the same image can clobber each other's files
+            image.name = scratch_name(digests["pixels"][:16])
+            if handoff is not None:
+                handoff.update(image=image, digests=digests)
+        encode_stats = image.encode_stats
+
+        if cache is not None:
+            with timer.stage("cache"):
+                if not handed_off:
+                    cache.set_alias(upload_digest, digests["pixels"], digests["exif"])
+                lookup(digests)
+            hits = list(per_method)
+            todo = pending()
+
+        if index is not None:
+            with timer.stage("fingerprint"):
+                # The call that decoded the image has already fingerprinted it
+                near_duplicates = _near_duplicates(index, digests["pixels"], None if handed_off else image)
+
+        if todo.detectors:
+            fresh, fresh_status = _execute(image, todo, output_folder, settings, executor, workers, timeout, timer)
+            if store is not None:
+                with timer.stage("store"):
+                    for detector in todo.detectors:
+                        publish_artifacts(fresh[detector.name], output_folder, store)
+            per_method.update(fresh)
+            status.update(fresh_status)
+            if cache is not None:
+                with timer.stage("cache"):
+                    for detector in todo.detectors:
+                        if fresh_status[detector.name] == "ok":
+                            params = detector.cache_params(settings, digests["exif"], upload_digest)
+                            cache.set_result(
+                                digests["pixels"], detector.name, params, fresh[detector.name], output_folder, store)
+    skipped, skipped_status = todo.skipped_results()
+    per_method.update(skipped)
+    status.update(skipped_status)
+
+    results = {}
+    for name in methods:
+        results.update(per_method[name])
+    results["method_status"] = {name: status[name] for name in methods}
+    results["cache_hits"] = [name for name in methods if name in hits]
+    if digests is not None:
+        results["image_digest"] = digests["pixels"]
+    if near_duplicates is not None:
+        results["near_duplicates"] = near_duplicates
+    if encode_stats is not None:
+        results["encode_stats"] = encode_stats
+    timer.add("total", time.perf_counter() - started)
+    results["timings"] = {stage: round(seconds, 6) for stage, seconds in timer.timings.items()}
+    return results
@@ -0,0 +1,103 @@
+"""
+Compact heatmap artifacts.
+
+Detectors hand over a single-channel value map (uint8, 0 = cold, 255 = hot)
+and the colormap it is read with, rather than a full-resolution color image
+with the regions burned in. save_heatmap writes an overview of the map no
+larger than max_side: an 8-bit PNG whose palette is the colormap, or a lossy
+WebP for per-pixel maps (ELA), whose noise compresses poorly without loss.
+Regions and copy-move matches stay vector data in the results, and the
+client draws them over the heatmap or the original.
+
+Maps larger than the overview can also get a tiled image pyramid, so a
+viewer can zoom into a full-resolution tiled analysis while fetching only
+the tiles in view.
+"""
+import os
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .deadlines import check
+
+COLORMAPS = {"inferno": cv2.COLORMAP_INFERNO, "jet": cv2.COLORMAP_JET}
+WEBP_QUALITY = 60
+PNG_COMPRESS_LEVEL = 1  # higher levels take several times longer for a few percent
+PNG_LEVEL_MASK = 0xFC  # 64 of the 256 palette entries: no visible banding, and about a third smaller
+
+
+@lru_cache(maxsize=None)
+def palette(colormap):
+    """
+    The 256 RGB colors of an OpenCV colormap, flattened for Image.putpalette.
+    """
+    colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), COLORMAPS[colormap])
+    return colors[:, 0, ::-1].flatten().tolist()
+
+
+def shrink(values, max_side):
+    """
+    values area-averaged down so the long side is at most max_side (values itself if it fits).
+    """
+    height, width = values.shape
+    if not max_side or max(width, height) <= max_side:
+        return values
+    ratio = max_side / float(max(width, height))
+    size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    return cv2.resize(values, size, interpolation=cv2.INTER_AREA)
+
+
+def encode(values, colormap, path, fmt="png"):
+    """
+    Write a uint8 map to path (or a file object), colored by colormap.
+    """
+    if fmt == "webp":
+        rgb = cv2.cvtColor(cv2.applyColorMap(values, COLORMAPS[colormap]), cv2.COLOR_BGR2RGB)
+        # method 0 is the fastest encoder setting and within a few percent of the smallest output here
+        Image.fromarray(rgb).save(path, format="WEBP", quality=WEBP_QUALITY, method=0)
+    elif fmt == "png":
+        height, width = values.shape
+        image = Image.frombytes("P", (width, height), np.ascontiguousarray(values & PNG_LEVEL_MASK).tobytes())
+        image.putpalette(palette(colormap))
+        image.save(path, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        raise ValueError(f"Unknown artifact format: {fmt}")
+
+
+def save_heatmap(values, colormap, output_folder, name, fmt="png", max_side=1024, pyramid_tile=0):
+    """
+    Write a value map as "<name>.<fmt>" in output_folder. Returns (path, pyramid).
+
+    The file is the overview, no larger than max_side. With pyramid_tile and
+    a map larger than the overview, pyramid describes the levels above it,
+    each half the size of the next and cut into pyramid_tile-pixel tiles
+    named "<name>_<level>_<row>_<col>.<fmt>": {"tile_size", "levels": [{"width",
+    "height", "tiles": [[filename per column] per row]}]}, smallest level
+    first, the last one at the map's own resolution. Otherwise pyramid is None.
+    """
+    path = os.path.join(output_folder, f"{name}.{fmt}")
+    encode(shrink(values, max_side), colormap, path, fmt)
+    if not pyramid_tile or max(values.shape) <= max_side:
+        return path, None
+
+    maps = [values]
+    while max(maps[-1].shape) > 2 * max_side:
+        height, width = maps[-1].shape
+        maps.append(cv2.resize(maps[-1], ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA))
+    levels = []
+    for level, level_map in enumerate(reversed(maps)):
+        height, width = level_map.shape
+        tiles = []
+        for row, top in enumerate(range(0, height, pyramid_tile)):
+            check()
+            names = []
+            for col, left in enumerate(range(0, width, pyramid_tile)):
+                tile_name = f"{name}_{level}_{row}_{col}.{fmt}"
+                tile = level_map[top:top + pyramid_tile, left:left + pyramid_tile]
+                encode(tile, colormap, os.path.join(output_folder, tile_name), fmt)
+                names.append(tile_name)
+            tiles.append(names)
+        levels.append({"width": width, "height": height, "tiles": tiles})
+    return path, {"tile_size": pyramid_tile, "levels": levels}
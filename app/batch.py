@@ -0,0 +1,220 @@
+"""
+Bulk analysis of many images: the /analyze/batch endpoint, the batch.py CLI
+and the index_images.py bulk build of the near-duplicate index.
+
+Images are analyzed one per worker on a process pool (each worker runs its
+detectors inline, so the pool is the only source of parallelism) and every
+finished image becomes one JSON Lines record. The CLI appends records to its
+output file as they arrive and skips images already recorded as "ok", so an
+interrupted run picks up where it stopped.
+"""
+import json
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from PIL import Image
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+from .analysis import MAX_ANALYSIS_PIXELS, AnalysisError, analyze_bytes, prepare_image
+from .fingerprint import fingerprint
+from .intake import SNIFF_BYTES, InvalidImageUpload, check_header, sniff_image
+
+# What a record says about an image that failed; the details are only logged
+DECODE_ERROR = "Could not process image file"
+ANALYSIS_ERROR = "Analysis failed"
+
+logger = logging.getLogger(__name__)
+
+
+def iter_image_files(root, allowed_extensions):
+    """
+    Yield (relative_path, absolute_path) for every allowed image under root, in sorted order.
+    """
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            if "." not in name or name.rsplit(".", 1)[1].lower() not in allowed_extensions:
+                continue
+            path = os.path.join(directory, name)
+            yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def screen_image(data, max_pixels):
+    """
+    Check an image's leading bytes the way /analyze checks an upload.
+
+    Returns data, or the InvalidImageUpload/ImageTooLarge it fails with
+    when it is not a supported image or declares more than max_pixels.
+    """
+    try:
+        header = sniff_image(memoryview(data)[:SNIFF_BYTES])
+        if header is None:
+            raise InvalidImageUpload("Truncated image header")
+        check_header(header, max_pixels)
+    except HTTPException as e:
+        return e
+    return data
+
+
+def iter_zip_members(archive, allowed_extensions, max_bytes, max_pixels=None):
+    """
+    Yield (name, data) for every allowed image in an open ZipFile.
+
+    Members larger than max_bytes once uncompressed are not inflated into
+    memory, and members that are not images or declare more than max_pixels
+    are not decoded; for those data is the exception to report instead.
+    """
+    for info in archive.infolist():
+        name = info.filename
+        if info.is_dir() or "." not in name or name.rsplit(".", 1)[1].lower() not in allowed_extensions:
+            continue
+        if info.file_size > max_bytes:
+            yield name, RequestEntityTooLarge("File too large")
+            continue
+        with archive.open(info) as member:
+            head = member.read(SNIFF_BYTES)
+        screened = screen_image(head, max_pixels)
+        if isinstance(screened, HTTPException):
+            yield name, screened
+            continue
+        yield name, archive.read(info)
+
+
+def analyze_item(key, source, methods, output_folder, settings, options):
+    """
+    Analyze one image given as a file path or its bytes. Runs in a pool worker.
+
+    Returns the image's JSON Lines record; failures are recorded, not raised,
+    with a fixed message for the client and the details in the log.
+    """
+    started = time.time()
+    record = {"path": key}
+    try:
+        if isinstance(source, str):
+            with open(source, "rb") as fh:
+                source = fh.read()
+        record["results"] = analyze_bytes(source, key, methods, output_folder, settings, **options)
+        record["status"] = "ok"
+    except AnalysisError as e:
+        record["status"] = "error"
+        record["error"] = str(e)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning("Could not decode %s: %s: %s", key, type(e).__name__, e)
+        record["status"] = "error"
+        record["error"] = DECODE_ERROR
+    except Exception:
+        logger.exception("Analysis of %s failed", key)
+        record["status"] = "error"
+        record["error"] = ANALYSIS_ERROR
+    record["seconds"] = round(time.time() - started, 3)
+    return record
+
+
+def fingerprint_item(key, path):
+    """
+    Decode one image file and fingerprint it. Runs in a pool worker.
+
+    Returns (key, pixel digest, fingerprint), or (key, None, error message).
+    """
+    try:
+        with open(path, "rb") as fh:
+            image = prepare_image(fh.read(), key)
+        return key, image.digest(), fingerprint(image.downscaled(MAX_ANALYSIS_PIXELS).gray)
+    except Exception as e:
+        return key, None, f"{type(e).__name__}: {e}"
+
+
+def run_batch(items, executor, methods, output_folder, settings, options, max_in_flight):
+    """
+    Submit (key, source) items to executor and yield records as images finish.
+
+    At most max_in_flight images are submitted at once, so a large archive is
+    never held in memory all at the same time. A source that is an
+    HTTPException (see iter_zip_members) is reported with its description
+    without being submitted.
+    """
+    in_flight = set()
+    for key, source in items:
+        if isinstance(source, HTTPException):
+            yield {"path": key, "status": "error", "error": source.description, "seconds": 0.0}
+            continue
+        in_flight.add(executor.submit(analyze_item, key, source, methods, output_folder, settings, options))
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+class Throughput:
+    """
+    Counts finished images and summarizes the run's throughput.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.started = time.time()
+        self.images = 0
+        self.errors = 0
+        self.skipped = 0
+        self.busy_seconds = 0.0
+
+    def add(self, record):
+        self.images += 1
+        self.busy_seconds += record.get("seconds", 0.0)
+        if record["status"] != "ok":
+            self.errors += 1
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        per_second = self.images / elapsed
+        return {
+            "images": self.images,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "workers": self.workers,
+            "elapsed_seconds": round(elapsed, 3),
+            "images_per_second": round(per_second, 3),
+            "images_per_second_per_core": round(per_second / max(1, self.workers), 3),
+            "seconds_per_image": round(self.busy_seconds / self.images, 3) if self.images else None,
+        }
+
+
+def load_finished(path):
+    """
+    Keys of images already recorded as "ok" in a JSON Lines output file.
+
+    A line cut short by a crash is ignored, so that image is analyzed again.
+    """
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok" and "path" in record:
+                finished.add(record["path"])
+    return finished
+
+
+def to_jsonl(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def open_zip(stream):
+    """
+    Open an uploaded archive, raising ValueError if it is not a zip file.
+    """
+    try:
+        return zipfile.ZipFile(stream)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Not a zip archive: {e}")
@@ -0,0 +1,282 @@
+"""
+Content-addressed cache for analysis results and their rendered artifacts.
+
+Entries are keyed by a hash of the decoded pixels plus the detector name and
+its parameters, so re-uploading the same photo (under any filename) reuses
+earlier work. A second, cheaper key maps the hash of the raw upload bytes to
+the pixel hash, which lets an identical re-upload skip decoding entirely.
+
+Backends share a tiny bytes-in/bytes-out interface (get/set/delete):
+MemoryCache (in-process LRU), DiskCache (files, shared between processes)
+and RedisCache (any server speaking the Redis protocol).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .storage import artifact_names
+
+_cache = None
+_cache_settings = None
+_cache_lock = threading.Lock()
+
+
+class MemoryCache:
+    """
+    In-process LRU bounded by total value size and entry age.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_age=24 * 3600):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.max_age:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.time(), value)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+
+class DiskCache:
+    """
+    File-per-entry cache shared by every process pointing at the same directory.
+
+    File mtimes double as LRU timestamps: reads touch the file, and eviction
+    removes the least recently used files once the directory exceeds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_age=24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._scan())
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _scan(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self._unlink(path)
+                return None
+            with open(path, "rb") as fh:
+                value = fh.read()
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(value)
+        try:
+            replaced = os.path.getsize(path)  # an entry being overwritten no longer counts
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(value) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        self._unlink(self._path(key))
+
+    def _unlink(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def _evict(self):
+        # Called with self._lock held; rescans so other processes' writes count too
+        entries = sorted(self._scan(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        cutoff = time.time() - self.max_age
+        target = self.max_bytes * 0.9
+        for path, mtime, size in entries:
+            if total <= target and mtime >= cutoff:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._size = total
+
+
+class RedisCache:
+    """
+    Cache stored in Redis or any server speaking its protocol.
+
+    Entry age is enforced with key expiry; size-based LRU eviction is left to
+    the server's maxmemory-policy (allkeys-lru).
+    """
+
+    def __init__(self, url=None, max_age=24 * 3600, client=None, prefix="analysis-cache:"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.max_age = max_age
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=int(self.max_age))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def make_cache_backend(settings):
+    """
+    Build a backend from a settings dict (see the CACHE_* config keys).
+    """
+    backend = settings["backend"]
+    if backend == "memory":
+        return MemoryCache(settings["max_bytes"], settings["max_age"])
+    if backend == "disk":
+        return DiskCache(settings["directory"], settings["max_bytes"], settings["max_age"])
+    if backend == "redis":
+        return RedisCache(settings["redis_url"], settings["max_age"])
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+def params_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Stores per-detector results and artifact bytes on top of a backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_alias(self, upload_digest):
+        """
+        Return {"pixels": ..., "exif": ...} digests for an upload we have decoded before.
+        """
+        value = self.backend.get(f"alias:{upload_digest}")
+        return json.loads(value) if value is not None else None
+
+    def set_alias(self, upload_digest, pixel_digest, exif_digest):
+        value = json.dumps({"pixels": pixel_digest, "exif": exif_digest})
+        self.backend.set(f"alias:{upload_digest}", value.encode("utf-8"))
+
+    def get_result(self, pixel_digest, method, params, output_folder, store=None):
+        """
+        Return the cached results dict for one detector, or None on a miss.
+
+        With an artifact store the results reference stored artifacts, and an
+        entry whose artifacts have since been collected is a miss. Without
+        one, artifact files missing from output_folder are restored from the
+        cache.
+        """
+        key = f"result:{pixel_digest}:{method}:{params_key(params)}"
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if store is not None:
+            if not all(store.exists(artifact) for artifact in entry["artifacts"]):
+                return None
+            return entry["results"]
+        for filename in entry["artifacts"]:
+            path = os.path.join(output_folder, filename)
+            if os.path.exists(path):
+                continue
+            data = self.backend.get(f"artifact:{key}:{filename}")
+            if data is None:
+                return None
+            with open(path, "wb") as fh:
+                fh.write(data)
+        return entry["results"]
+
+    def set_result(self, pixel_digest, method, params, results, output_folder, store=None):
+        """
+        Cache one detector's results along with the artifact files they reference.
+
+        Artifacts already in a store are referenced by key rather than copied.
+        """
+        key = f"result:{pixel_digest}:{method}:{params_key(params)}"
+        artifacts = artifact_names(results)
+        if store is None:
+            for filename in artifacts:
+                try:
+                    with open(os.path.join(output_folder, filename), "rb") as fh:
+                        self.backend.set(f"artifact:{key}:{filename}", fh.read())
+                except OSError:
+                    return
+        entry = {"results": results, "artifacts": artifacts}
+        self.backend.set(key, json.dumps(entry).encode("utf-8"))
+
+
+def get_result_cache(settings):
+    """
+    Return this process's ResultCache for settings, or None when caching is off.
+    """
+    global _cache, _cache_settings
+    if not settings or settings.get("backend") in (None, "", "none"):
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_settings != settings:
+            _cache = ResultCache(make_cache_backend(settings))
+            _cache_settings = dict(settings)
+    return _cache
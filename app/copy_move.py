@@ -0,0 +1,249 @@
+"""
+Block-based copy-move detection.
+
+Overlapping blocks are described by their low-frequency DCT coefficients,
+sorted lexicographically so similar blocks land next to each other, and the
+matched pairs are clustered by shift vector: a copied region shows up as many
+block pairs that share one shift. Everything is vectorized with NumPy and the
+work grows with the number of blocks, which is capped by widening the grid
+step on large images.
+"""
+import numpy as np
+import cv2
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .deadlines import check
+
+
+def _dct_matrix(n):
+    """
+    Orthonormal DCT-II basis, one frequency per row.
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+def block_features(gray, block=16, coeffs=3, min_std=4.0, chunk_bytes=32 * 1024 * 1024):
+    """
+    Low-frequency DCT features for every textured block position.
+
+    Returns (features, xs, ys): features is an int16 (n, coeffs*coeffs) array
+    of rounded DCT coefficients, laid out as [horizontal freq][vertical freq],
+    and xs/ys hold each block's top-left corner. Blocks whose pixel standard
+    deviation is below min_std are dropped, since flat areas match
+    everything. The 2-D DCT is done as two matrix products (rows, then
+    columns) over chunks of block rows, so only the compact int16 features
+    grow with the image.
+    """
+    height, width = gray.shape
+    n_features = coeffs * coeffs
+    empty = (np.empty((0, n_features), np.int16), np.empty(0, np.int32), np.empty(0, np.int32))
+    if height < block or width < block:
+        return empty
+
+    basis = _dct_matrix(block)[:coeffs]  # (coeffs, block)
+    nx = width - block + 1
+    ny = height - block + 1
+    area = float(block * block)
+
+    chunk = max(1, chunk_bytes // (nx * block * 4 * coeffs))
+    # Sized for the worst case (every block textured); pages that are never
+    # written are never backed by memory, and only the filled prefix is returned
+    features = np.empty((nx * ny, n_features), np.int16)
+    xs = np.empty(nx * ny, np.int32)
+    ys = np.empty(nx * ny, np.int32)
+    count = 0
+    for y0 in range(0, ny, chunk):
+        check()
+        y1 = min(ny, y0 + chunk)
+        g = gray[y0:y1 - 1 + block].astype(np.float32)
+        cy = y1 - y0
+
+        # Standard deviation of every block in the chunk from integral images
+        s, sq = cv2.integral2(g, sdepth=cv2.CV_64F)
+
+        def box(table):
+            return (table[block:block + cy, block:block + nx] - table[:cy, block:block + nx]
+                    - table[block:block + cy, :nx] + table[:cy, :nx])
+
+        mean = box(s) / area
+        textured = box(sq) / area - mean * mean >= min_std * min_std
+        if not textured.any():
+            continue
+
+        rows = sliding_window_view(g, block, axis=1)  # (h, nx, block)
+        horizontal = rows @ basis.T  # (h, nx, coeffs)
+        columns = sliding_window_view(horizontal, block, axis=0)  # (cy, nx, coeffs, block)
+        coef = (columns @ basis.T).reshape(cy, nx, n_features)
+        gy, gx = np.nonzero(textured)
+        end = count + len(gx)
+        features[count:end] = np.rint(coef[gy, gx])
+        xs[count:end] = gx
+        ys[count:end] = gy + y0
+        count = end
+
+    return features[:count], xs[:count], ys[:count]
+
+
+def match_blocks(features, xs, ys, quant=6.0, tolerance=6, window=4, min_distance=24):
+    """
+    Pair up near-identical blocks that are at least min_distance apart.
+
+    Blocks are sorted lexicographically on the quantized DC term and the three
+    lowest AC terms, and each one is compared with the next `window` blocks in
+    that order. Returns (src, dst) index arrays with shifts normalized to
+    point down/right.
+    """
+    if len(features) < 2:
+        empty = np.empty(0, np.int64)
+        return empty, empty
+
+    coeffs = int(round(np.sqrt(features.shape[1])))
+    sort_columns = (0, 1, coeffs, coeffs + 1)
+    probe_column = 2
+
+    # The sort columns are packed into one int64 key (15 bits each), which
+    # argsorts much faster than a multi-key lexsort
+    key = np.zeros(len(features), np.int64)
+    offset = int(16384 * quant)
+    for column in sort_columns:
+        quantized = (features[:, column].astype(np.int32) + offset) // int(quant)
+        key <<= 15
+        key |= np.clip(quantized, 0, 32767)
+    order = np.argsort(key)
+    del key
+    ordered = np.take(features, order, axis=0)
+    ordered_x = np.take(xs, order)
+    ordered_y = np.take(ys, order)
+
+    src_parts = []
+    dst_parts = []
+    for k in range(1, window + 1):
+        check()
+        # Cheap prefilter on one unsorted coefficient, then distance and the
+        # full comparison on the survivors
+        candidates = np.flatnonzero(np.abs(ordered[k:, probe_column] - ordered[:-k, probe_column]) <= tolerance)
+        far = ((np.abs(ordered_x[candidates + k] - ordered_x[candidates]) >= min_distance)
+               | (np.abs(ordered_y[candidates + k] - ordered_y[candidates]) >= min_distance))
+        candidates = candidates[far]
+        close = np.abs(ordered[candidates + k] - ordered[candidates]).max(axis=1) <= tolerance
+        keep = candidates[close]
+        src_parts.append(order[keep])
+        dst_parts.append(order[keep + k])
+
+    src = np.concatenate(src_parts)
+    dst = np.concatenate(dst_parts)
+
+    # Orient every pair so its shift has dy > 0, or dy == 0 and dx > 0
+    dx = xs[dst] - xs[src]
+    dy = ys[dst] - ys[src]
+    flip = (dy < 0) | ((dy == 0) & (dx < 0))
+    src, dst = np.where(flip, dst, src), np.where(flip, src, dst)
+    return src, dst
+
+
+def cluster_shifts(shifts, min_pairs, tolerance=2):
+    """
+    Group shift vectors that lie within tolerance pixels of a dominant shift.
+
+    Returns (labels, centers) where labels[i] is the cluster of shifts[i] or -1
+    when it belongs to no cluster of at least min_pairs pairs. Neighbouring
+    shifts are found by binary search on packed (dx, dy) keys, so smooth
+    images with hundreds of thousands of distinct shifts stay fast.
+    """
+    labels = np.full(len(shifts), -1, np.int64)
+    if len(shifts) == 0:
+        return labels, []
+
+    unique, inverse, counts = np.unique(shifts, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    # np.unique sorts rows by (dx, dy), which keeps these keys sorted too
+    stride = 1 << 20
+    keys = (unique[:, 0].astype(np.int64) + stride // 2) * stride + unique[:, 1] + stride // 2
+    offsets = np.array([dx * stride + dy
+                        for dx in range(-tolerance, tolerance + 1)
+                        for dy in range(-tolerance, tolerance + 1)], np.int64)
+
+    def neighbours(targets):
+        idx = np.minimum(np.searchsorted(keys, targets), len(keys) - 1)
+        return idx[keys[idx] == targets]
+
+    # Pairs within tolerance of each shift, counting all of them: an upper
+    # bound on what the shift can still gather once its neighbours are taken
+    window_counts = np.zeros(len(unique), np.int64)
+    for offset in offsets:
+        idx = np.minimum(np.searchsorted(keys, keys + offset), len(keys) - 1)
+        window_counts += np.where(keys[idx] == keys + offset, counts[idx], 0)
+
+    unique_labels = np.full(len(unique), -1, np.int64)
+    centers = []
+    window_size = len(offsets)
+    for idx in np.argsort(-counts, kind="stable"):
+        # Every remaining shift is at most this common, so no later window can reach min_pairs
+        if counts[idx] * window_size < min_pairs:
+            break
+        if unique_labels[idx] != -1 or window_counts[idx] < min_pairs:
+            continue
+        near = neighbours(keys[idx] + offsets)
+        near = near[unique_labels[near] == -1]
+        if counts[near].sum() < min_pairs:
+            continue
+        unique_labels[near] = len(centers)
+        centers.append(unique[idx])
+    labels = unique_labels[inverse]
+    return labels, centers
+
+
+def _bbox(points, block):
+    x0, y0 = points.min(axis=0)
+    x1, y1 = points.max(axis=0) + block
+    return [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+
+
+def detect_copy_move(gray, block=16, min_std=4.0, min_area=1024,
+                     quant=6.0, tolerance=6, window=4, min_distance=None):
+    """
+    Find duplicated regions in a grayscale image.
+
+    Blocks are taken on a full step-1 grid at the image's own resolution:
+    copies land at arbitrary offsets, and any coarser grid or downscaled
+    proxy misaligns the two halves of a copy enough to break matching.
+
+    Returns a dict with the full-size uint8 "mask" (255 on duplicated pixels),
+    the list of "regions" ({"source", "target", "shift", "blocks"}; boxes are
+    [x, y, w, h]) and the number of matched block "pairs".
+    """
+    if min_distance is None:
+        min_distance = block + 1
+    # A duplicated w x h patch yields about (w - block) * (h - block) block pairs
+    min_pairs = max(8, min_area // 4)
+
+    features, xs, ys = block_features(gray, block=block, min_std=min_std)
+    src, dst = match_blocks(features, xs, ys, quant, tolerance, window, min_distance)
+    del features
+    positions = np.stack([xs, ys], axis=1)
+    shifts = positions[dst] - positions[src]
+    labels, centers = cluster_shifts(shifts, min_pairs)
+
+    mask = np.zeros(gray.shape, np.uint8)
+    regions = []
+    kept = labels >= 0
+    if kept.any():
+        corners = np.concatenate([positions[src[kept]], positions[dst[kept]]])
+        mask[corners[:, 1], corners[:, 0]] = 255
+        # Grow each block corner into the full block it stands for
+        kernel = np.ones((block, block), np.uint8)
+        mask = cv2.dilate(mask, kernel, anchor=(0, 0))
+        for label, center in enumerate(centers):
+            members = labels == label
+            regions.append({
+                "source": _bbox(positions[src[members]], block),
+                "target": _bbox(positions[dst[members]], block),
+                "shift": [int(center[0]), int(center[1])],
+                "blocks": int(members.sum()),
+            })
+
+    return {"mask": mask, "regions": regions, "pairs": int(kept.sum())}
@@ -0,0 +1,80 @@
+"""
+Cooperative deadlines for running detectors.
+
+A thread can't be stopped from outside, so a detector that overruns its
+timeout has to stop itself. _execute gives each detector a Deadline, which
+starts counting when the detector starts running rather than when it is
+queued, and the long loops (image tiles, copy-move chunks, pyramid rows,
+JPEG MCU rows) call check() between iterations. Once the deadline has
+passed or been cancelled, check() raises DeadlineExceeded and the detector
+unwinds without writing its artifact. _execute reports the timeout without
+waiting for that, so a detector that never checks only costs its thread.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(BaseException):
+    """
+    Raised by check() in a detector whose deadline has passed.
+
+    Like asyncio.CancelledError it is not an Exception, so the detectors'
+    own error handling (which turns failures into result text) lets it through.
+    """
+
+
+class Deadline:
+    """
+    A time limit of seconds (None for no limit) that starts with start().
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires = None
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+
+    def start(self):
+        if self.seconds is not None:
+            self.expires = time.monotonic() + self.seconds
+        self.started.set()
+
+    def remaining(self):
+        """
+        Seconds left, or None if the deadline has no limit or hasn't started.
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def expired(self):
+        return self.cancelled.is_set() or (self.expires is not None and time.monotonic() >= self.expires)
+
+
+@contextlib.contextmanager
+def running(deadline):
+    """
+    Start deadline and make it the one check() reads in this thread.
+    """
+    deadline.start()
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def check():
+    """
+    Raise DeadlineExceeded if the current thread's deadline has passed.
+    """
+    deadline = _current.get()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded
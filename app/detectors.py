@@ -0,0 +1,210 @@
+"""
+Detector registry and per-request execution plans.
+
+Each detector registers a Detector declaring what it reads from an upload
+(inputs), how expensive it is (cost), the settings it introduces and the
+settings that change its output (params), next to the function that runs
+it. Nothing else in the pipeline names detectors: method selection, cache
+keys, the progressive stages and the handlers' settings all follow from
+the declarations, so adding a detector is one register() call.
+
+plan() turns a request into an ExecutionPlan: the detectors to run, the
+ones dropped because the server is loaded, and the image products (the
+grayscale conversion and the like) that several of them read, which are
+computed once before the detectors fan out.
+"""
+import logging
+import threading
+
+# What a detector reads: the decoded image (PIL), arrays derived from it, the
+# upload's own bytes, or its metadata segments
+INPUTS = ("pixels", "gray", "rgb", "bgr", "bytes", "exif")
+
+# Cost classes, cheapest first. Expensive detectors get a progressive stage of their own.
+COSTS = ("cheap", "moderate", "expensive")
+
+# Products shared between detectors: input -> (timing stage, conversion)
+PRODUCTS = {
+    "gray": ("grayscale", lambda image: image.gray),
+    "rgb": ("rgb", lambda image: image.rgb),
+    "bgr": ("bgr", lambda image: image.bgr),
+}
+
+logger = logging.getLogger(__name__)
+
+_registry = {}  # name -> Detector, in report order
+_aliases = {}  # alternative spelling -> name
+_lock = threading.Lock()
+
+
+class Detector:
+    """
+    One detector and what the pipeline needs to know to plan it.
+
+    run(image, output_folder, settings) returns its result fields. defaults
+    are the settings it introduces; params names the settings (its own or
+    shared ones such as "tiled") that change its output, which key its
+    cached results. Bump version when the output changes for the same
+    params. Detectors reading "exif" or "bytes" are also keyed by the
+    upload's metadata or bytes, which the pixel hash doesn't cover. preview
+    marks detectors that give a useful answer on a small proxy.
+    """
+
+    def __init__(self, name, run, inputs, cost="moderate", params=(), defaults=None, version=1,
+                 aliases=(), preview=False):
+        unknown = set(inputs) - set(INPUTS)
+        if unknown:
+            raise ValueError(f"Unknown detector inputs: {', '.join(sorted(unknown))}")
+        if cost not in COSTS:
+            raise ValueError(f"Unknown cost class: {cost}")
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.cost = cost
+        self.params = tuple(params)
+        self.defaults = dict(defaults or {})
+        self.version = version
+        self.aliases = tuple(aliases)
+        self.preview = preview
+
+    def cache_params(self, settings, exif_digest=None, upload_digest=None):
+        """
+        The parameters this detector's output depends on, as part of its cache key.
+        """
+        params = {key: _key_value(settings[key]) for key in self.params}
+        params["version"] = self.version
+        if "exif" in self.inputs:
+            params["exif"] = exif_digest
+        if "bytes" in self.inputs:
+            params["upload"] = upload_digest
+        return params
+
+    def __repr__(self):
+        return f"Detector({self.name!r}, cost={self.cost!r})"
+
+
+def _key_value(value):
+    # Cache keys are JSON; sets have no order and tuples come back as lists anyway
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def register(detector):
+    """
+    Add a detector to the registry (after the ones already there) and return it.
+    """
+    with _lock:
+        names = (detector.name,) + detector.aliases
+        taken = [name for name in names if name in _registry or name in _aliases]
+        if taken:
+            raise ValueError(f"Detector name already registered: {', '.join(taken)}")
+        _registry[detector.name] = detector
+        _aliases.update((alias, detector.name) for alias in detector.aliases)
+    return detector
+
+
+def registered():
+    """
+    Every registered detector, in report order.
+    """
+    return list(_registry.values())
+
+
+def get(name):
+    """
+    The detector registered under name or one of its aliases; KeyError if none.
+    """
+    return _registry[_aliases.get(name, name)]
+
+
+def defaults():
+    """
+    The settings introduced by the registered detectors, with their defaults.
+    """
+    merged = {}
+    for detector in registered():
+        merged.update(detector.defaults)
+    return merged
+
+
+def resolve(selected_methods):
+    """
+    The detectors named by selected_methods (names or aliases), in report order.
+
+    An empty selection means all of them; unknown names are logged and ignored.
+    """
+    if not selected_methods:
+        return registered()
+    wanted = {_aliases.get(name, name) for name in selected_methods}
+    unknown = wanted - set(_registry)
+    if unknown:
+        logger.info("Ignoring unknown detectors: %s", ", ".join(sorted(unknown)))
+    return [detector for detector in registered() if detector.name in wanted]
+
+
+class ExecutionPlan:
+    """
+    What one analysis runs.
+
+    detectors are the ones to run, in report order; skipped maps each
+    dropped detector's name to the reason; shared lists the image products
+    (keys of PRODUCTS) to compute before the detectors start.
+    """
+
+    def __init__(self, detectors, skipped=None, shared=()):
+        self.detectors = list(detectors)
+        self.skipped = dict(skipped or {})
+        self.shared = tuple(shared)
+
+    @property
+    def names(self):
+        return [detector.name for detector in self.detectors]
+
+    def skipped_results(self):
+        """
+        ({name: results}, {name: status}) reporting the skipped detectors, like the pipeline's.
+        """
+        return ({name: {f"{name}_error": reason} for name, reason in self.skipped.items()},
+                {name: "skipped" for name in self.skipped})
+
+    def prepare(self, image, timer):
+        """
+        Compute the shared products on image, each timed as its own stage.
+        """
+        for product in self.shared:
+            stage, convert = PRODUCTS[product]
+            with timer.stage(stage):
+                convert(image)
+
+
+def plan(detectors, settings, load=0.0, shed_load=None):
+    """
+    Build the ExecutionPlan for detectors (Detector objects or names).
+
+    load is how busy the server is, in analyses in progress per unit of
+    capacity; shed_load maps a cost class to the load at which detectors of
+    that class are skipped (cheap ones never are). Whole-image products are
+    shared only outside tiled mode, where detectors read the pixels tile by
+    tile instead.
+    """
+    detectors = [get(detector) if isinstance(detector, str) else detector for detector in detectors]
+    run = []
+    skipped = {}
+    for detector in detectors:
+        threshold = (shed_load or {}).get(detector.cost)
+        if detector.cost != "cheap" and threshold and load >= threshold:
+            skipped[detector.name] = f"Skipped while the server is busy (load {load:.2f}); try again later"
+        else:
+            run.append(detector)
+    if skipped:
+        logger.info("Load %.2f: skipping %s", load, ", ".join(skipped))
+
+    shared = []
+    if not settings.get("tiled"):
+        for product in PRODUCTS:
+            if sum(1 for detector in run if product in detector.inputs) > 1:
+                shared.append(product)
+    return ExecutionPlan(run, skipped, shared)
@@ -0,0 +1,276 @@
+"""
+Error level analysis with a multi-quality sweep and per-block scoring.
+
+Instead of re-encoding the image once per quality, the luma channel is
+transformed once into 8x8 DCT coefficients, exactly as a JPEG encoder would,
+and the re-compression error at each quality is the quantization error of
+those coefficients under that quality's table. The DCT is orthonormal, so the
+error energy of a block is its pixel-domain squared error (before the final
+rounding to 8 bits); the reference quality's error is transformed back to
+pixels for the heatmap. One DCT serves every quality, all as NumPy array
+arithmetic.
+
+For every 16x16 block the error is then compared with what blocks of similar
+texture show elsewhere in the same image: error rises with texture, so a
+block is only suspicious when its error is out of line for its texture. A
+region pasted from a less compressed source errs high at every quality; one
+that went through an extra, lower-quality save errs low near that quality (a
+"JPEG ghost"). Blocks with too much error at two or more qualities, or too
+little at any, are outliers; connected runs of them become ranked regions.
+
+Nothing touches the filesystem and no state is shared, so concurrent
+requests are independent.
+"""
+import math
+
+import cv2
+import numpy as np
+
+from .tiling import JPEG_ALIGN, HeatmapCanvas, iter_tiles
+
+BLOCK = 16  # scoring block: a 4:2:0 JPEG macroblock, 2x2 DCT blocks
+SWEEP = (55, 75)  # with the reference quality; low ones expose ghosts of low-quality pastes
+TEXTURE_BINS = 10
+
+# Block z-scores of untouched photos stay mostly within +-2.5 once smoothed;
+# a region's score of 3 maps to 0.5 on the calibrated scale
+REGION_Z = 3.0
+SCORE_CENTER = 3.0
+SCORE_SLOPE = 2.5
+
+# Standard JPEG luminance table (ITU T.81 Annex K), row-major
+_LUMA_TABLE = np.array([
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+], np.float32)
+
+
+def _dct_basis():
+    k = np.arange(8)
+    basis = np.sqrt(2 / 8) * np.cos((2 * k[None, :] + 1) * k[:, None] * np.pi / 16)
+    basis[0] /= np.sqrt(2)
+    # Flattened 8x8 blocks times this matrix give their 2-D DCT coefficients
+    return np.kron(basis, basis).T.astype(np.float32)
+
+
+_DCT = _dct_basis()
+_IDCT = np.ascontiguousarray(_DCT.T)
+
+
+def quant_table(quality):
+    """
+    Luminance quantization table for quality (1-100), scaled like libjpeg.
+    """
+    quality = min(100, max(1, int(quality)))
+    scale = 5000 / quality if quality < 50 else 200 - 2 * quality
+    return np.clip(np.floor((_LUMA_TABLE * scale + 50) / 100), 1, 255).astype(np.float32)
+
+
+def _to_blocks(strip):
+    """
+    Level-shifted 8x8 blocks of a uint8 strip as an (n, 64) float32 array.
+    """
+    rows, cols = strip.shape
+    blocks = strip.reshape(rows // 8, 8, cols // 8, 8).transpose(0, 2, 1, 3).reshape(-1, 64)
+    return np.subtract(blocks, 128, dtype=np.float32)
+
+
+def _from_blocks(blocks, rows, cols):
+    return blocks.reshape(rows // 8, cols // 8, 8, 8).transpose(0, 2, 1, 3).reshape(rows, cols)
+
+
+def _block_grid(values, reduce=np.mean):
+    """
+    Per-8x8 values (rows8 x cols8) -> per-BLOCK means or another reduction.
+    """
+    rows8, cols8 = values.shape
+    return reduce(values.reshape(rows8 // 2, 2, cols8 // 2, 2), axis=(1, 3))
+
+
+def ela_maps(gray, quality=90, sweep=SWEEP, strip=32):
+    """
+    Re-compression error of a grayscale image at quality and across sweep.
+
+    Returns (diff, errors, texture): the absolute pixel error at quality
+    (uint8, same shape as gray), {quality: per-block RMS error} for the
+    reference and every sweep quality, and the per-block texture (standard
+    deviation of its flattest 8x8 quarter, 0 if any pixel is clipped).
+
+    The image is processed in strips of strip rows so every intermediate
+    array stays in cache.
+    """
+    height, width = gray.shape
+    # Pad partial MCUs with edge pixels, like an encoder does
+    padded = cv2.copyMakeBorder(gray, 0, -height % BLOCK, 0, -width % BLOCK, cv2.BORDER_REPLICATE)
+    rows, cols = padded.shape
+    tables = {q: quant_table(q) for q in sorted({quality, *sweep})}
+    diff = np.empty((rows, cols), np.uint8)
+    energy = {q: np.empty((rows // 8, cols // 8), np.float32) for q in tables}
+    ac_energy = np.empty((rows // 8, cols // 8), np.float32)
+
+    for top in range(0, rows, strip):
+        bottom = min(rows, top + strip)
+        coefficients = _to_blocks(padded[top:bottom]) @ _DCT
+        shape8 = ((bottom - top) // 8, cols // 8)
+        for q, table in tables.items():
+            error = coefficients * (1 / table)
+            residual = np.rint(error)
+            error -= residual
+            if q == quality:
+                pixels = cv2.convertScaleAbs((error * table) @ _IDCT)
+                diff[top:bottom] = _from_blocks(pixels, bottom - top, cols)
+            error *= error
+            energy[q][top // 8:bottom // 8] = (error @ (table * table)).reshape(shape8)
+        ac_energy[top // 8:bottom // 8] = np.einsum(
+            "ij,ij->i", coefficients[:, 1:], coefficients[:, 1:]).reshape(shape8)
+
+    # Only whole blocks of the original image are scored
+    grid_rows, grid_cols = height // BLOCK, width // BLOCK
+    errors = {q: np.sqrt(_block_grid(values / 64)[:grid_rows, :grid_cols]) for q, values in energy.items()}
+    # A block is as textured as its flattest 8x8 quarter, so blocks straddling
+    # a flat area's edge count as flat instead of as oddly low-error texture
+    texture = np.sqrt(_block_grid(ac_energy / 64, np.min)[:grid_rows, :grid_cols])
+    # Clipped pixels make the decoder's rounding, not quantization, dominate the error
+    unclipped = cv2.inRange(gray[:grid_rows * BLOCK, :grid_cols * BLOCK], 1, 254)
+    clipped = cv2.resize(unclipped, (grid_cols, grid_rows), interpolation=cv2.INTER_AREA) < 255
+    texture[clipped] = 0
+    return diff[:height, :width], errors, texture
+
+
+def score_blocks(errors, texture, min_texture=0.5, mad_floor=0.05):
+    """
+    Signed robust z-score per block, smoothed over 3x3 blocks.
+
+    Each quality's log error is compared with the median of blocks in the
+    same texture decile and scaled by the median absolute deviation. A block
+    scores the second-highest z across qualities or the lowest, whichever is
+    further from 0. Near-flat blocks (clipped highlights, flat
+    fills) carry no ELA signal and score 0.
+    """
+    textured = np.flatnonzero(texture.ravel() >= min_texture)
+    if textured.size < TEXTURE_BINS * 4:
+        return np.zeros(texture.shape, np.float32)
+    # Flat blocks would pile up at zero error and shrink the spread, so only textured ones are ranked
+    order = textured[np.argsort(texture.ravel()[textured], kind="stable")]
+    deciles = np.array_split(order, TEXTURE_BINS)
+    zs = []
+    for error in errors.values():
+        log_error = np.log1p(error).ravel()
+        residual = np.zeros(texture.size, np.float32)
+        for members in deciles:
+            residual[members] = log_error[members] - np.median(log_error[members])
+        # Errors all but vanish at the quality the image was last saved at
+        scale = max(1.4826 * float(np.median(np.abs(residual[textured]))), mad_floor)
+        zs.append(residual / scale)
+    zs = np.sort(np.stack(zs), axis=0)
+    # Too much error must show at two qualities: at the one the image was last
+    # saved at, error is mostly rounding noise with a long tail of its own.
+    # Too little error (a ghost) shows at the paste's own quality alone.
+    high, low = zs[-2 if len(zs) > 1 else -1], zs[0]
+    best = np.where(np.maximum(high, 0) >= -np.minimum(low, 0), np.maximum(high, 0), np.minimum(low, 0))
+    best = best.reshape(texture.shape)
+    return cv2.blur(best, (3, 3))
+
+
+def find_regions(z, threshold=REGION_Z, min_blocks=4, max_regions=8):
+    """
+    Group outlying blocks into regions, strongest first.
+
+    Each region is {"box": [x, y, w, h] in pixels, "score": mean |z|,
+    "peak": max |z|, "direction": "high" or "low" error, "area": fraction of
+    the image}.
+    """
+    mask = (np.abs(z) >= threshold).astype(np.uint8)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    regions = []
+    for label in range(1, count):
+        x, y, w, h, blocks = stats[label]
+        if blocks < min_blocks:
+            continue
+        values = z[labels == label]
+        regions.append({
+            "box": [int(x * BLOCK), int(y * BLOCK), int(w * BLOCK), int(h * BLOCK)],
+            "score": round(float(np.abs(values).mean()), 2),
+            "peak": round(float(np.abs(values).max()), 2),
+            "direction": "high" if values.mean() > 0 else "low",
+            "area": round(float(blocks) / z.size, 4),
+        })
+    regions.sort(key=lambda region: region["score"] * math.sqrt(region["area"]), reverse=True)
+    return regions[:max_regions]
+
+
+def calibrated_score(regions):
+    """
+    Map the strongest region's z-score onto 0..1 (0.5 at REGION_Z).
+    """
+    if not regions:
+        return 0.0
+    strongest = max(region["score"] for region in regions)
+    return round(1.0 / (1.0 + math.exp(-SCORE_SLOPE * (strongest - SCORE_CENTER))), 3)
+
+
+def _finish(diff, max_diff, errors, texture, scale=1.0):
+    z = score_blocks(errors, texture)
+    regions = find_regions(z)
+    return {
+        "diff": diff,
+        "max_diff": max_diff,
+        "z": z,
+        "regions": regions,
+        "score": calibrated_score(regions),
+        "scale": scale,
+    }
+
+
+def detect_ela(gray, quality=90, sweep=SWEEP):
+    """
+    Whole-image ELA of a grayscale array.
+
+    Returns {"diff", "max_diff", "z", "regions", "score", "scale"}; scale is
+    the size of diff relative to the image (always 1 here).
+    """
+    diff, errors, texture = ela_maps(gray, quality, sweep)
+    return _finish(diff, int(diff.max()), errors, texture)
+
+
+def detect_ela_tiled(pil_image, quality=90, sweep=SWEEP, tile=1024, max_side=2048):
+    """
+    ELA over full-resolution tiles; same result keys as detect_ela.
+
+    Tiles start on the block grid and DCT blocks don't interact, so the
+    tiles' block maps stitch into exactly the whole-image maps. "diff" is
+    downsampled to at most max_side pixels on its long side.
+    """
+    width, height = pil_image.size
+    canvas = HeatmapCanvas(width, height, max_side)
+    rows, cols = height // BLOCK, width // BLOCK
+    texture = np.zeros((rows, cols), np.float32)
+    errors = {}
+    max_diff = 0
+    for core, _ in iter_tiles(width, height, tile, align=JPEG_ALIGN):
+        gray = np.asarray(pil_image.crop(core).convert("L"))
+        diff, tile_errors, tile_texture = ela_maps(gray, quality, sweep)
+        max_diff = max(max_diff, int(diff.max()))
+        canvas.paste(core, diff)
+
+        r0, c0 = core[1] // BLOCK, core[0] // BLOCK
+        r1, c1 = r0 + tile_texture.shape[0], c0 + tile_texture.shape[1]
+        for q, values in tile_errors.items():
+            errors.setdefault(q, np.zeros((rows, cols), np.float32))[r0:r1, c0:c1] = values
+        texture[r0:r1, c0:c1] = tile_texture
+    return _finish(canvas.pixels, max_diff, errors, texture, canvas.scale)
+
+
+def heatmap_values(diff, max_diff):
+    """
+    ELA error map as uint8 heatmap values, stretched so max_diff is the hottest.
+
+    Read with the "inferno" colormap; regions are left to the client to draw.
+    """
+    return cv2.convertScaleAbs(diff, alpha=255.0 / max_diff if max_diff > 0 else 1)
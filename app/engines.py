@@ -0,0 +1,135 @@
+"""
+Loading of the analysis engines: the detector modules and the native
+libraries under them (NumPy, OpenCV, Pillow, the HEIF decoders, piexif).
+
+create_app imports none of them, so building the app is cheap and a worker
+that only serves logins, history pages or static files never pays for them.
+ENGINE_LOADING picks when each process loads them:
+
+    lazy        on the first analysis that needs them
+    background  in a thread started by the gunicorn post_fork hook
+                (gunicorn.conf.py) or, without it, by the worker's first request
+    eager       inside create_app; under a preloaded gunicorn master they
+                load once and the workers share the pages after forking
+
+Loading ends with one run of each detector on a tiny image so first-call
+costs (OpenCV's thread pool, NumPy's ufunc loops, the DCT bases) are not paid
+by the first upload. /ready reports the state of the serving process.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+# Imported in this order so each library's own cost is timed separately
+ENGINE_MODULES = (
+    "numpy",
+    "cv2",
+    "PIL.Image",
+    "pillow_heif",
+    "pyheif",
+    "piexif",
+    "app.jpeg",
+    "app.analysis",
+    "app.progressive",
+    "app.batch",
+)
+
+logger = logging.getLogger(__name__)
+
+_load_lock = threading.Lock()
+_start_lock = threading.Lock()
+_loader_pid = None  # process that started a loader thread
+_state = {"status": "idle", "pid": None, "seconds": None, "timings": {}, "error": None}
+
+
+def _current():
+    # A load in progress in a forked parent never finishes in this process
+    if _state["pid"] != os.getpid() and _state["status"] == "loading":
+        _state.update(status="idle", pid=None, timings={}, error=None)
+    return _state
+
+
+def _warm_up():
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    from .artifacts import encode
+    from .copy_move import detect_copy_move
+    from .ela import detect_ela
+    from .fingerprint import fingerprint
+    from .jpeg import detect_jpeg
+    from .noise import detect_noise
+
+    gray = np.random.default_rng(0).integers(0, 256, (128, 128), dtype=np.uint8)
+    detect_ela(gray)
+    detect_noise(gray)
+    detect_copy_move(gray)
+    fingerprint(gray)
+    buffer = io.BytesIO()
+    Image.fromarray(gray).save(buffer, format="JPEG")
+    detect_jpeg(buffer.getvalue())
+    for fmt in ("webp", "png"):
+        encode(gray, "inferno", io.BytesIO(), fmt)
+
+
+def load_engines():
+    """
+    Import the engines and warm them up in the calling thread; return status().
+
+    Concurrent callers wait for the one doing the work. A failed load is
+    logged and reported, and retried by the next call.
+    """
+    with _load_lock:
+        state = _current()
+        if state["status"] == "ready":
+            return status()
+        state.update(status="loading", pid=os.getpid(), seconds=None, timings={}, error=None)
+        started = time.perf_counter()
+        try:
+            for name in ENGINE_MODULES + ("warm_up",):
+                step = time.perf_counter()
+                if name == "warm_up":
+                    _warm_up()
+                else:
+                    importlib.import_module(name)
+                state["timings"][name] = round(time.perf_counter() - step, 6)
+        except Exception as e:
+            logger.exception("Could not load the analysis engines")
+            state.update(status="failed", error=str(e))
+            return status()
+        state.update(status="ready", seconds=round(time.perf_counter() - started, 6))
+    logger.info("Analysis engines loaded in %.2fs", state["seconds"])
+    return status()
+
+
+def load_in_background():
+    """
+    Start load_engines() in a daemon thread, at most once per process.
+    """
+    global _loader_pid
+    if _loader_pid == os.getpid():
+        return False
+    with _start_lock:
+        if _loader_pid == os.getpid() or _current()["status"] == "ready":
+            return False
+        _loader_pid = os.getpid()
+    threading.Thread(target=load_engines, name="engine-loader", daemon=True).start()
+    return True
+
+
+def status():
+    """
+    This process's engine state: "idle", "loading", "ready" or "failed", with per-module load times.
+    """
+    state = _current()
+    return {
+        "status": state["status"],
+        "pid": os.getpid(),
+        "seconds": state["seconds"],
+        "timings": dict(state["timings"]),
+        "error": state["error"],
+    }
@@ -0,0 +1,391 @@
+"""
+Perceptual fingerprints of analyzed images and a Hamming-distance index over them.
+
+Every analyzed image gets a 64-bit pHash (which of the lowest DCT frequencies
+of a 32x32 thumbnail are above their median), a 64-bit dHash (signs of the
+horizontal gradients of a 9x8 thumbnail) and a pHash per cell of a
+BLOCK_GRID x BLOCK_GRID grid. Re-encoded, resized or lightly edited copies
+land within a few bits of the original's pHash; an edited copy of a known
+photo keeps most of its grid cells, and the cells that changed show where.
+
+Fingerprints live in the image_fingerprint table (models.ImageFingerprint)
+so every process sees them. Each process keeps its own in-memory index,
+loaded in bulk on first use and topped up with newer rows before each
+lookup. The index is multi-index hashing: a 64-bit code is split into
+CHUNKS 16-bit chunks, and a code within r bits of a query is within
+r // CHUNKS bits of it on at least one chunk, so a lookup only probes the
+sorted-chunk ranges near the query's own chunks instead of every code.
+"""
+import functools
+import itertools
+import logging
+import threading
+from collections import Counter
+
+import cv2
+import numpy as np
+
+HASH_SIZE = 8  # 8x8 bits per hash
+BLOCK_GRID = 4
+CELLS = BLOCK_GRID * BLOCK_GRID
+# Cells flatter than this (gray-level std) have a meaningless pHash and aren't indexed
+FLAT_STD = 2.0
+
+CHUNKS = 4
+CHUNK_BITS = 16
+# Codes appended since the last sort are scanned directly until there are this many
+MIN_TAIL = 1024
+SYNC_PAGE = 10000
+
+logger = logging.getLogger(__name__)
+
+_index = None
+_index_settings = None
+_index_lock = threading.Lock()
+
+
+def _pack(bits):
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def phash(gray):
+    """
+    64-bit DCT hash of a grayscale array.
+    """
+    thumb = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(thumb)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the mean brightness; leave it out of the median
+    return _pack(low > np.median(low[1:]))
+
+
+def dhash(gray):
+    """
+    64-bit gradient hash of a grayscale array.
+    """
+    thumb = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack((thumb[:, 1:] > thumb[:, :-1]).ravel())
+
+
+def block_boxes(width, height):
+    """
+    [x, y, w, h] of every grid cell of a width x height image, row by row.
+    """
+    xs = [col * width // BLOCK_GRID for col in range(BLOCK_GRID + 1)]
+    ys = [row * height // BLOCK_GRID for row in range(BLOCK_GRID + 1)]
+    return [[xs[col], ys[row], xs[col + 1] - xs[col], ys[row + 1] - ys[row]]
+            for row, col in itertools.product(range(BLOCK_GRID), repeat=2)]
+
+
+def fingerprint(gray):
+    """
+    Fingerprint of a grayscale array.
+
+    Returns {"phash", "dhash", "blocks": one pHash per grid cell, "flat":
+    bitmask of the cells too flat to compare, "width", "height"}.
+    """
+    height, width = gray.shape
+    if min(width, height) < BLOCK_GRID:
+        gray = cv2.resize(gray, (max(width, BLOCK_GRID), max(height, BLOCK_GRID)), interpolation=cv2.INTER_NEAREST)
+    blocks, flat = [], 0
+    for cell, (x, y, w, h) in enumerate(block_boxes(gray.shape[1], gray.shape[0])):
+        pixels = gray[y:y + h, x:x + w]
+        blocks.append(phash(pixels))
+        if cv2.meanStdDev(pixels)[1][0, 0] < FLAT_STD:
+            flat |= 1 << cell
+    return {
+        "phash": phash(gray),
+        "dhash": dhash(gray),
+        "blocks": blocks,
+        "flat": flat,
+        "width": width,
+        "height": height,
+    }
+
+
+def _popcount(values):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # numpy < 2.0
+    return np.unpackbits(values.view(np.uint8).reshape(len(values), -1), axis=1).sum(axis=1)
+
+
+@functools.lru_cache(maxsize=None)
+def _chunk_masks(bits):
+    # Every CHUNK_BITS-bit value with at most `bits` bits set
+    values = np.arange(1 << CHUNK_BITS, dtype=np.uint64)
+    return values[_popcount(values) <= bits].astype(np.uint16)
+
+
+def _to_signed(code):
+    # Databases store BIGINTs signed
+    return code - (1 << 64) if code >= 1 << 63 else code
+
+
+def _to_unsigned(value):
+    return value & ((1 << 64) - 1)
+
+
+def _grow(array, size):
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 1024), array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit codes, each tagged with an integer item.
+
+    add() only appends; searches scan the codes appended since the last
+    sort directly and re-sort the chunk tables once that tail outgrows
+    MIN_TAIL and a quarter of the sorted part, so a bulk load sorts once.
+    Not thread-safe on its own.
+    """
+
+    def __init__(self):
+        self._codes = np.zeros(0, np.uint64)
+        self._items = np.zeros(0, np.int64)
+        self._size = 0
+        self._sorted = 0
+        self._tables = []  # per chunk: (chunk values in order, positions of the codes)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, codes, items):
+        codes = np.asarray(codes, np.uint64)
+        end = self._size + len(codes)
+        self._codes = _grow(self._codes, end)
+        self._items = _grow(self._items, end)
+        self._codes[self._size:end] = codes
+        self._items[self._size:end] = items
+        self._size = end
+
+    def _sort(self):
+        codes = self._codes[:self._size]
+        self._tables = []
+        for chunk in range(CHUNKS):
+            values = ((codes >> np.uint64(chunk * CHUNK_BITS)) & np.uint64((1 << CHUNK_BITS) - 1)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            self._tables.append((values[order], order))
+        self._sorted = self._size
+
+    def search(self, code, radius):
+        """
+        (items, distances) of every code within radius bits of code.
+        """
+        if self._size - self._sorted > max(MIN_TAIL, self._sorted // 4):
+            self._sort()
+        masks = _chunk_masks(min(radius // CHUNKS, CHUNK_BITS))
+        found = [np.arange(self._sorted, self._size)]
+        for chunk, (values, order) in enumerate(self._tables):
+            probes = masks ^ np.uint16((code >> (chunk * CHUNK_BITS)) & ((1 << CHUNK_BITS) - 1))
+            starts = np.searchsorted(values, probes, "left")
+            lengths = np.searchsorted(values, probes, "right") - starts
+            # Concatenate order[start:start + length] for every probe without a Python loop
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            found.append(order[offsets + np.arange(offsets.size)])
+        # A code can turn up under several chunks; dedupe the few that are close enough
+        positions = np.concatenate(found)
+        positions = positions[_popcount(self._codes[positions] ^ np.uint64(code)) <= radius]
+        positions = np.unique(positions)
+        return self._items[positions], _popcount(self._codes[positions] ^ np.uint64(code))
+
+
+class FingerprintIndex:
+    """
+    The image_fingerprint table plus this process's in-memory index of it.
+
+    Rows are read and written with SQLAlchemy Core through the
+    ImageFingerprint table, so no Flask app context is needed (job workers
+    don't have one). Other processes' inserts are picked up by sync().
+    """
+
+    def __init__(self, database_url, radius=10, block_radius=10, min_blocks=4, max_hits=10):
+        from sqlalchemy import create_engine
+        from .models import ImageFingerprint
+
+        self.engine = create_engine(database_url)
+        self.table = ImageFingerprint.__table__
+        self.radius = radius
+        self.block_radius = block_radius
+        self.min_blocks = min_blocks
+        self.max_hits = max_hits
+        self._phash = HammingIndex()
+        self._blocks = [HammingIndex() for _ in range(CELLS)]
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._phash)
+
+    def sync(self):
+        """
+        Load rows added since the last sync (every row the first time).
+        """
+        from sqlalchemy import select
+
+        columns = self.table.c
+        query = select(columns.id, columns.phash, columns.block_hashes, columns.flat_blocks).order_by(columns.id)
+        with self._lock:
+            while True:
+                with self.engine.connect() as connection:
+                    rows = connection.execute(query.where(columns.id > self._last_id).limit(SYNC_PAGE)).all()
+                if not rows:
+                    return
+                self._load(rows)
+                self._last_id = rows[-1].id
+                if len(rows) < SYNC_PAGE:
+                    return
+
+    def _load(self, rows):
+        ids = np.array([row.id for row in rows], np.int64)
+        self._phash.add(np.array([row.phash for row in rows], np.int64).view(np.uint64), ids)
+        blocks = np.frombuffer(b"".join(row.block_hashes for row in rows), "<u8").reshape(len(rows), CELLS)
+        flat = np.array([row.flat_blocks for row in rows], np.int64)
+        for cell, index in enumerate(self._blocks):
+            keep = (flat >> cell) & 1 == 0
+            index.add(blocks[keep, cell], ids[keep])
+
+    def find(self, fp, exclude=None):
+        """
+        Earlier images that fp near-duplicates, closest first.
+
+        An image is a hit when its pHash is within radius bits of fp's or
+        when at least min_blocks of its grid cells are within block_radius
+        bits of the same cells of fp. Hits are {"digest", "width", "height",
+        "first_seen", "distance" (pHash bits), "dhash_distance",
+        "matched_blocks", "changed_blocks": [x, y, w, h] boxes of fp's cells
+        that don't match}. The image with digest exclude (the upload itself)
+        is left out.
+        """
+        self.sync()
+        with self._lock:
+            candidates = set(self._phash.search(fp["phash"], self.radius)[0].tolist())
+            votes = Counter()
+            for cell, index in enumerate(self._blocks):
+                if not (fp["flat"] >> cell) & 1:
+                    votes.update(index.search(fp["blocks"][cell], self.block_radius)[0].tolist())
+        candidates.update(item for item, count in votes.items() if count >= self.min_blocks)
+        if not candidates:
+            return []
+
+        from sqlalchemy import select
+
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(self.table).where(self.table.c.id.in_(sorted(candidates)))).all()
+        hits = [self._hit(fp, row) for row in rows if row.digest != exclude]
+        hits.sort(key=lambda hit: (hit["distance"], -hit["matched_blocks"]))
+        return hits[:self.max_hits]
+
+    def _hit(self, fp, row):
+        blocks = np.frombuffer(row.block_hashes, "<u8")
+        boxes = block_boxes(fp["width"], fp["height"])
+        matched, changed = 0, []
+        for cell in range(CELLS):
+            ours, theirs = (fp["flat"] >> cell) & 1, (row.flat_blocks >> cell) & 1
+            if ours and theirs:
+                continue  # flat in both: no evidence either way
+            if not ours and not theirs and (fp["blocks"][cell] ^ int(blocks[cell])).bit_count() <= self.block_radius:
+                matched += 1
+            else:
+                changed.append(boxes[cell])
+        return {
+            "digest": row.digest,
+            "width": row.width,
+            "height": row.height,
+            "first_seen": row.created_at.isoformat() if row.created_at else None,
+            "distance": (fp["phash"] ^ _to_unsigned(row.phash)).bit_count(),
+            "dhash_distance": (fp["dhash"] ^ _to_unsigned(row.dhash)).bit_count(),
+            "matched_blocks": matched,
+            "changed_blocks": changed,
+        }
+
+    def get(self, digest):
+        """
+        The stored fingerprint of the image with this pixel digest, or None.
+        """
+        from sqlalchemy import select
+
+        with self.engine.connect() as connection:
+            row = connection.execute(select(self.table).where(self.table.c.digest == digest)).first()
+        if row is None:
+            return None
+        return {
+            "phash": _to_unsigned(row.phash),
+            "dhash": _to_unsigned(row.dhash),
+            "blocks": [int(code) for code in np.frombuffer(row.block_hashes, "<u8")],
+            "flat": row.flat_blocks,
+            "width": row.width,
+            "height": row.height,
+        }
+
+    def add(self, digest, fp):
+        """
+        Store one image's fingerprint (a no-op if the digest is already stored).
+        """
+        return self.add_many([(digest, fp)])
+
+    def add_many(self, entries):
+        """
+        Bulk-insert (digest, fingerprint) pairs, skipping digests already stored.
+
+        Returns the number of rows inserted. The in-memory index picks them
+        up on the next sync().
+        """
+        from sqlalchemy import select
+        from sqlalchemy.exc import IntegrityError
+
+        entries = list({digest: fp for digest, fp in entries}.items())
+        if not entries:
+            return 0
+        digest_column = self.table.c.digest
+        with self.engine.connect() as connection:
+            stored = set(connection.execute(
+                select(digest_column).where(digest_column.in_([digest for digest, _ in entries]))).scalars())
+        rows = [{
+            "digest": digest,
+            "width": fp["width"],
+            "height": fp["height"],
+            "phash": _to_signed(fp["phash"]),
+            "dhash": _to_signed(fp["dhash"]),
+            "block_hashes": np.array(fp["blocks"], "<u8").tobytes(),
+            "flat_blocks": fp["flat"],
+        } for digest, fp in entries if digest not in stored]
+        if not rows:
+            return 0
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(self.table.insert(), rows)
+        except IntegrityError:
+            # Another process stored one of them first; fall back to one at a time
+            inserted = 0
+            for row in rows:
+                try:
+                    with self.engine.begin() as connection:
+                        connection.execute(self.table.insert(), [row])
+                    inserted += 1
+                except IntegrityError:
+                    pass
+            return inserted
+        return len(rows)
+
+
+def get_fingerprint_index(settings):
+    """
+    Return this process's FingerprintIndex for settings, or None when indexing is off.
+    """
+    global _index, _index_settings
+    if not settings:
+        return None
+    with _index_lock:
+        if _index is None or _index_settings != settings:
+            _index = FingerprintIndex(
+                settings["database_url"],
+                radius=settings.get("radius", 10),
+                block_radius=settings.get("block_radius", 10),
+                min_blocks=settings.get("min_blocks", 4),
+            )
+            _index_settings = dict(settings)
+    return _index
@@ -0,0 +1,243 @@
+"""
+Analysis history: one Analysis row per finished analysis, written off the request path.
+
+Handlers and job callbacks hand finished results to the app's
+HistoryRecorder, which only queues them; a background thread inserts the
+queued rows in batches (and bumps the owners' upload_count in the same
+transaction), so a slow database never holds up an /analyze response. The
+stages of a progressive analysis finish separately and are merged into a
+single row once the last one ends.
+
+History views page with a keyset on the primary key ("rows older than id
+N") rather than OFFSET, so every page costs the same however deep it is.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.orm import defer
+
+from . import db
+from .models import Analysis, User
+
+# A progressive analysis whose stages haven't all ended by then is recorded no more
+GROUP_TTL = 3600  # seconds
+
+logger = logging.getLogger(__name__)
+
+_init_lock = threading.Lock()
+
+
+def analysis_row(results, user_id=None, filename=None, mode="sync", error=None):
+    """
+    The Analysis column values for one finished analysis (or failed job, with error).
+    """
+    status = results.get("method_status") or {}
+    total = (results.get("timings") or {}).get("total")
+
+    def count(key):
+        return len(results[key]) if isinstance(results.get(key), (list, dict)) else None
+
+    return {
+        "user_id": user_id,
+        "image_hash": results.get("image_digest"),
+        "filename": (filename or "")[:255],
+        "mode": mode,
+        "methods": ",".join(status)[:64],
+        "status": "ok" if error is None and status and all(state == "ok" for state in status.values()) else "error",
+        "created_at": datetime.utcnow(),
+        "seconds": total if isinstance(total, (int, float)) else None,
+        "ela_score": results.get("ela_score"),
+        "noise_score": results.get("noise_score"),
+        "copy_move_regions": count("copy_move_regions"),
+        "metadata_signals": count("metadata_signals"),
+        "near_duplicates": count("near_duplicates"),
+        "results": results if error is None else dict(results, error=str(error)),
+    }
+
+
+class HistoryRecorder:
+    """
+    Queues Analysis rows and inserts them in batches from a background thread.
+
+    A batch is written once batch_size rows are waiting or flush_interval
+    seconds after its first row. When more than max_pending rows are waiting
+    (the database is down or far behind) new rows are dropped and counted
+    in self.dropped rather than blocking requests.
+    """
+
+    def __init__(self, engine, batch_size=200, flush_interval=1.0, max_pending=10000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._groups = {}  # progressive analysis id -> {"stages", "results", "errors", "started"}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, results, user_id=None, filename=None, mode="sync", error=None):
+        self._put(analysis_row(results, user_id, filename, mode, error))
+
+    def record_job(self, result, error, tag):
+        """
+        Record a finished background job described by its submission tag.
+
+        The tag carries "user_id", "filename" and "mode"; jobs that are one
+        stage of a group also carry "group", "stage" and "stages".
+        """
+        fields = {key: tag.get(key) for key in ("user_id", "filename", "mode")}
+        if "group" not in tag:
+            self.record(result or {}, error=error, **fields)
+            return
+        with self._lock:
+            cutoff = time.time() - GROUP_TTL
+            for group_id in [key for key, group in self._groups.items() if group["started"] < cutoff]:
+                del self._groups[group_id]
+            group = self._groups.setdefault(tag["group"], {
+                "stages": set(tag["stages"]), "results": {}, "errors": {}, "started": time.time(),
+            })
+            if error is None:
+                group["results"][tag["stage"]] = result or {}
+            else:
+                group["errors"][tag["stage"]] = str(error)
+            group["stages"].discard(tag["stage"])
+            if group["stages"]:
+                return
+            del self._groups[tag["group"]]
+        from .progressive import merge_results
+
+        merged = merge_results(None, group["results"])
+        for stage, message in group["errors"].items():
+            merged[f"{stage}_stage_error"] = message
+        row = analysis_row(merged, **fields)
+        if group["errors"]:
+            row["status"] = "error"
+        row["seconds"] = round(time.time() - group["started"], 6)
+        self._put(row)
+
+    def _put(self, row):
+        self._start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("History queue full; dropped the record of %s", row["filename"])
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """
+        Write every queued row now, in the calling thread.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, rows):
+        uploads = Counter(row["user_id"] for row in rows if row["user_id"] is not None)
+        users = User.__table__
+        try:
+            with self._write_lock, self.engine.begin() as connection:
+                connection.execute(Analysis.__table__.insert(), rows)
+                for user_id, count in uploads.items():
+                    connection.execute(
+                        update(users)
+                        .where(users.c.id == user_id)
+                        .values(upload_count=db.func.coalesce(users.c.upload_count, 0) + count))
+        except Exception:
+            logger.exception("Could not write %d history records", len(rows))
+
+
+def get_history_recorder(app):
+    """
+    Return the app's HistoryRecorder, or None when HISTORY_ENABLED is off.
+
+    Its writer thread starts with the first record, inside each gunicorn
+    worker rather than in the master.
+    """
+    if not app.config["HISTORY_ENABLED"]:
+        return None
+    recorder = app.extensions.get("history_recorder")
+    if recorder is not None:
+        return recorder
+    with _init_lock:
+        recorder = app.extensions.get("history_recorder")
+        if recorder is None:
+            with app.app_context():
+                engine = db.engine
+            recorder = HistoryRecorder(
+                engine,
+                batch_size=app.config["HISTORY_BATCH_SIZE"],
+                flush_interval=app.config["HISTORY_FLUSH_INTERVAL"],
+            )
+            app.extensions["history_recorder"] = recorder
+    return recorder
+
+
+def history_page(query, before=None, limit=50):
+    """
+    One page of an Analysis query, newest first, paged by keyset on id.
+
+    Returns (rows, next_before): pass next_before as before to get the
+    following page; it is None on the last page. The results JSON is not
+    loaded.
+    """
+    if before is not None:
+        query = query.filter(Analysis.id < before)
+    rows = query.options(defer(Analysis.results)).order_by(Analysis.id.desc()).limit(limit + 1).all()
+    return rows[:limit], (rows[limit - 1].id if len(rows) > limit else None)
+
+
+def analysis_summary(analysis):
+    """
+    An Analysis row as a JSON-ready dict, without its results.
+    """
+    return {
+        "id": analysis.id,
+        "user_id": analysis.user_id,
+        "image_hash": analysis.image_hash,
+        "filename": analysis.filename,
+        "mode": analysis.mode,
+        "methods": analysis.methods.split(",") if analysis.methods else [],
+        "status": analysis.status,
+        "created_at": analysis.created_at.isoformat() if analysis.created_at else None,
+        "seconds": analysis.seconds,
+        "ela_score": analysis.ela_score,
+        "noise_score": analysis.noise_score,
+        "copy_move_regions": analysis.copy_move_regions,
+        "metadata_signals": analysis.metadata_signals,
+        "near_duplicates": analysis.near_duplicates,
+    }
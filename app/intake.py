@@ -0,0 +1,257 @@
+"""
+Upload intake: spooled upload buffers that validate images while they stream in.
+
+Flask normally spools multipart files to a 500 KB SpooledTemporaryFile and
+only lets the view look at them once the whole body has been received.
+UploadRequest swaps in an UploadSpool for views that opt in: it keeps the
+upload in memory up to a size limit (spilling to a temporary file only
+beyond it) and sniffs the first bytes as they arrive, so an upload that is
+not a JPEG/PNG/GIF/HEIF, or whose header declares a decompression bomb, is
+rejected before the rest of it is read. view() then hands the analysis a
+zero-copy memoryview of the upload (an mmap when it spilled to disk).
+"""
+import io
+import mmap
+import struct
+from tempfile import SpooledTemporaryFile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+SNIFF_BYTES = 256 * 1024  # header bytes kept for sniffing while the upload streams in
+
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+# JPEG start-of-frame markers (all but DHT, JPG and DAC in C4/C8/CC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class InvalidImageUpload(UnsupportedMediaType):
+    """
+    The upload is not a supported image, or its header is malformed.
+    """
+
+
+class ImageTooLarge(RequestEntityTooLarge):
+    """
+    The image header declares more pixels than we are willing to decode.
+    """
+
+
+def _jpeg_size(buf):
+    pos = 2
+    while True:
+        # Skip fill bytes; every marker starts with 0xFF
+        while pos < len(buf) and buf[pos] == 0xFF:
+            pos += 1
+        if pos >= len(buf):
+            return None
+        if buf[pos - 1] != 0xFF:
+            raise InvalidImageUpload("Corrupt JPEG header")
+        marker = buf[pos]
+        pos += 1
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # standalone markers carry no length
+        if marker in (0xD9, 0xDA):
+            raise InvalidImageUpload("JPEG has no frame header")
+        if pos + 2 > len(buf):
+            return None
+        (length,) = struct.unpack_from(">H", buf, pos)
+        if length < 2:
+            raise InvalidImageUpload("Corrupt JPEG header")
+        if marker in _JPEG_SOF:
+            if pos + 7 > len(buf):
+                return None
+            height, width = struct.unpack_from(">HH", buf, pos + 3)
+            return width, height
+        pos += length
+
+
+def _boxes(buf, start, end):
+    """
+    Yield (type, payload_start, box_end) for the ISO-BMFF boxes in buf[start:end].
+
+    Stops at the first box that runs past the end of buf.
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            (size,) = struct.unpack_from(">Q", buf, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise InvalidImageUpload("Corrupt HEIF box")
+        if pos + size > end:
+            return
+        yield bytes(kind), pos + header, pos + size
+        pos += size
+
+
+def _heif_size(buf):
+    # Image sizes live in meta/iprp/ipco/ispe; the largest one is the full image
+    # (the others are thumbnails or grid tiles)
+    for kind, start, end in _boxes(buf, 0, len(buf)):
+        if kind != b"meta":
+            continue
+        sizes = []
+        for kind, start, end in _boxes(buf, start + 4, end):  # meta is a full box
+            if kind != b"iprp":
+                continue
+            for kind, start, end in _boxes(buf, start, end):
+                if kind != b"ipco":
+                    continue
+                for kind, start, end in _boxes(buf, start, end):
+                    if kind == b"ispe" and start + 12 <= end:
+                        sizes.append(struct.unpack_from(">II", buf, start + 4))
+        if not sizes:
+            raise InvalidImageUpload("HEIF has no image size")
+        return max(sizes, key=lambda size: size[0] * size[1])
+    return None
+
+
+def allowed_file(filename, allowed_extensions):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
+
+
+def sniff_image(buf):
+    """
+    Identify an image from its leading bytes.
+
+    Returns (format, width, height), or None when buf is too short to tell.
+    Raises InvalidImageUpload for anything that is not a JPEG, PNG, GIF or
+    HEIF image.
+    """
+    if len(buf) < 12:
+        return None
+    head = bytes(buf[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        size = _jpeg_size(buf)
+        return ("JPEG",) + size if size else None
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        if len(buf) < 24:
+            return None
+        if bytes(buf[12:16]) != b"IHDR":
+            raise InvalidImageUpload("Corrupt PNG header")
+        return ("PNG",) + struct.unpack_from(">II", buf, 16)
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return ("GIF",) + struct.unpack_from("<HH", buf, 6)
+    if head[4:8] == b"ftyp":
+        (ftyp_size,) = struct.unpack_from(">I", buf, 0)
+        if len(buf) < ftyp_size:
+            return None
+        brands = {bytes(buf[i:i + 4]) for i in range(8, ftyp_size, 4)}
+        if not brands & HEIF_BRANDS:
+            raise InvalidImageUpload("Unsupported ISO media file")
+        size = _heif_size(buf)
+        return ("HEIF",) + size if size else None
+    raise InvalidImageUpload("File content is not a supported image")
+
+
+def check_header(header, max_pixels):
+    """
+    Reject images whose declared size is empty or exceeds max_pixels.
+    """
+    fmt, width, height = header
+    if width == 0 or height == 0:
+        raise InvalidImageUpload(f"{fmt} declares an empty image")
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge(
+            f"Image is {width}x{height} ({width * height / 1e6:.0f} MP); the limit is {max_pixels / 1e6:.0f} MP")
+
+
+class UploadSpool(SpooledTemporaryFile):
+    """
+    Upload buffer that stays in memory up to max_size bytes and checks the
+    image header while the body is still arriving.
+    """
+
+    def __init__(self, max_size, max_pixels, dir=None):
+        super().__init__(max_size=max_size, mode="w+b", dir=dir)
+        self.max_pixels = max_pixels
+        self.header = None  # (format, width, height) once sniffed
+        self._head = bytearray()
+        self._mmap = None
+
+    def write(self, data):
+        if self.header is None and len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            self._sniff(self._head, final=False)
+        return super().write(data)
+
+    def _sniff(self, buf, final):
+        header = sniff_image(buf)
+        if header is None:
+            if final:
+                raise InvalidImageUpload("Truncated image header")
+            return
+        check_header(header, self.max_pixels)
+        self.header = header
+        self._head = None
+
+    @property
+    def in_memory(self):
+        return not self._rolled
+
+    def view(self):
+        """
+        Zero-copy memoryview of the whole upload; use it as a context manager.
+
+        Headers that did not settle within the sniffing window (a JPEG with
+        very large APP segments, say) are checked here against the full upload.
+        """
+        self.flush()
+        if self._rolled:
+            if self._mmap is None:
+                size = self.seek(0, io.SEEK_END)
+                if size == 0:
+                    raise InvalidImageUpload("Empty upload")
+                self._mmap = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(self._mmap)
+        else:
+            data = self._file.getbuffer()
+        if self.header is None:
+            try:
+                self._sniff(data, final=True)
+            except Exception:
+                data.release()
+                raise
+        return data
+
+    def close(self):
+        # A decoder still holding a slice of the view keeps the buffer alive;
+        # it is then freed with that slice instead of here
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+class UploadRequest(Request):
+    """
+    Request that spools file uploads into UploadSpools when a view asks for it.
+
+    A view opts in by calling request.sniff_uploads(...) before it first
+    touches request.files; other views get Werkzeug's default buffers.
+    """
+
+    upload_policy = None
+
+    def sniff_uploads(self, max_memory, max_pixels, spill_dir=None):
+        self.upload_policy = (max_memory, max_pixels, spill_dir)
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_policy is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        max_memory, max_pixels, spill_dir = self.upload_policy
+        return UploadSpool(max_memory, max_pixels, dir=spill_dir)
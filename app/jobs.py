@@ -0,0 +1,314 @@
+"""
+Background job queue for asynchronous /analyze requests.
+
+Jobs run on a bounded executor (a process pool by default, a thread pool as a
+lighter swap-in) and their state lives in this process, so status polling has
+to reach the same gunicorn worker that accepted the job. Jobs submitted
+together (the stages of a progressive analysis) form a group that can be
+followed as a whole, and a chained group runs its stages one after another,
+each handing its work on to the next.
+"""
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .history import get_history_recorder
+from .metrics import JOBS_PENDING, REQUESTS, observe_results
+
+_init_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """
+    Raised when the queue already holds its maximum number of pending jobs.
+    """
+
+    def __init__(self, retry_after=1):
+        super().__init__("Analysis queue is full")
+        self.retry_after = retry_after
+
+
+def make_executor(backend, workers):
+    """
+    Build the executor used to run jobs. backend is "process" or "thread".
+
+    Job processes come from a forkserver, never forked from the web worker
+    itself: by the time the pool starts, that worker runs request, detector,
+    history and GC threads, and a fork could inherit locks they hold
+    (logging, the SQLAlchemy pool) and deadlock. The forkserver imports the
+    analysis modules once, so each job process starts with them loaded.
+    """
+    if backend == "process":
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["app.analysis"])
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    if backend == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-job")
+    raise ValueError(f"Unknown job backend: {backend}")
+
+
+class JobQueue:
+    """
+    Tracks submitted jobs and applies queue-depth backpressure.
+    """
+
+    def __init__(self, executor, max_pending=16, result_ttl=600, on_finish=None):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        # Called as on_finish(result, error, tag) in this process once a job ends
+        self.on_finish = on_finish
+        self._jobs = {}
+        self._groups = {}  # group id -> {stage: job id}
+        self._reserved = 0  # pending slots held by work submitted straight to the executor (see reserve)
+        self._lock = threading.Lock()
+        # Bumped and notified whenever a job finishes, for clients streaming progress
+        self._changes = 0
+        self._changed = threading.Condition(self._lock)
+
+    def _pending_count(self):
+        return self._reserved + sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running"))
+
+    def _check_room(self, count):
+        # Called with self._lock held
+        self._expire()
+        pending = self._pending_count()
+        if pending + count > self.max_pending:
+            raise QueueFull(retry_after=max(1, pending // max(1, self._workers())))
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished"] is not None and job["finished"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        for group_id, stages in list(self._groups.items()):
+            if not any(job_id in self._jobs for job_id in stages.values()):
+                del self._groups[group_id]
+
+    def pending(self):
+        with self._lock:
+            return self._pending_count()
+
+    def submit(self, fn, /, *args, tag=None, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return its job id, or raise QueueFull.
+
+        tag (a dict) is handed to on_finish when the job ends.
+        """
+        (job_id,) = self._submit_all([(fn, args, kwargs)], [tag])
+        return job_id
+
+    def submit_group(self, calls, tag=None, chain=False):
+        """
+        Queue {stage: (fn, args, kwargs)} as one group and return its group id.
+
+        Either every stage is queued or, when the queue lacks room for all of
+        them, none is and QueueFull is raised. Each stage's on_finish tag is
+        tag plus "group", "stage" and "stages" (every stage of the group).
+
+        With chain=True a stage is only handed to the executor once the one
+        before it has ended, and every fn returns (result, handoff): the next
+        stage's fn is called with handoff=handoff (None for the first stage
+        and after a failed one), and result alone is the stage's result.
+        """
+        stages = list(calls)
+        group_id = uuid.uuid4().hex
+        tags = [None if tag is None else dict(tag, group=group_id, stage=stage, stages=stages) for stage in stages]
+        job_ids = self._submit_all([calls[stage] for stage in stages], tags, chain)
+        with self._lock:
+            self._groups[group_id] = dict(zip(stages, job_ids))
+        return group_id
+
+    def _submit_all(self, calls, tags, chain=False):
+        with self._lock:
+            self._check_room(len(calls))
+            jobs = []
+            for tag, call in zip(tags, calls):
+                job = {
+                    "id": uuid.uuid4().hex,
+                    "status": "queued",
+                    "submitted": time.time(),
+                    "finished": None,
+                    "result": None,
+                    "error": None,
+                    "future": None,
+                    "tag": tag,
+                    "call": call,
+                    "chained": chain,
+                    "next": None,
+                }
+                self._jobs[job["id"]] = job
+                jobs.append(job)
+            if chain:
+                for job, following in zip(jobs, jobs[1:]):
+                    job["next"] = following
+
+        for job in jobs[:1] if chain else jobs:
+            self._start(job, {"handoff": None} if chain else {})
+        return [job["id"] for job in jobs]
+
+    def reserve(self, count):
+        """
+        Hold count pending slots for work that goes straight to the executor, or raise QueueFull.
+
+        A batch streams its images through the executor itself, at most
+        count at a time; holding the slots until release(count) counts that
+        work against max_pending like the jobs queued here.
+        """
+        with self._lock:
+            self._check_room(count)
+            self._reserved += count
+
+    def release(self, count):
+        with self._lock:
+            self._reserved -= count
+
+    def _start(self, job, extra):
+        fn, args, kwargs = job.pop("call")
+        try:
+            future = self.executor.submit(fn, *args, **kwargs, **extra)
+        except Exception as e:
+            self._fail(job["id"], e)
+            return
+        job["future"] = future
+        future.add_done_callback(lambda f, job_id=job["id"]: self._finish(job_id, f))
+
+    def _advance(self, job, handoff):
+        # A chained stage starts once the one before it has ended
+        if job is not None and job["next"] is not None:
+            self._start(job["next"], {"handoff": handoff})
+
+    def _workers(self):
+        return getattr(self.executor, "_max_workers", 1)
+
+    def _fail(self, job_id, error):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job["status"] = "failed"
+                job["error"] = str(error)
+                job["finished"] = time.time()
+            self._changes += 1
+            self._changed.notify_all()
+        self._notify(None, error, job["tag"] if job is not None else None)
+        self._advance(job, None)
+
+    def _finish(self, job_id, future):
+        error = future.exception()
+        if error is not None:
+            self._fail(job_id, error)
+            return
+        result, handoff = future.result(), None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job["chained"]:
+                    result, handoff = result
+                job["status"] = "done"
+                job["result"] = result
+                job["finished"] = time.time()
+            self._changes += 1
+            self._changed.notify_all()
+        self._notify(result, None, job["tag"] if job is not None else None)
+        self._advance(job, handoff)
+
+    def _notify(self, result, error, tag):
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(result, error, tag)
+        except Exception:
+            logger.exception("Job on_finish callback failed")
+
+    def get(self, job_id):
+        """
+        Return a snapshot of the job as a dict, or None if it is unknown.
+        """
+        with self._lock:
+            return self._snapshot(job_id)
+
+    def get_group(self, group_id):
+        """
+        Return {stage: job snapshot} for a group, or None if it is unknown.
+        """
+        with self._lock:
+            stages = self._groups.get(group_id)
+            if stages is None:
+                return None
+            return {stage: self._snapshot(job_id) for stage, job_id in stages.items()}
+
+    def changes(self):
+        """
+        Counter of finished jobs, to pass to wait_for_change.
+        """
+        with self._lock:
+            return self._changes
+
+    def wait_for_change(self, since, timeout):
+        """
+        Block until a job finishes after changes() returned since, or timeout
+        seconds pass. Returns False on timeout.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self._changes != since, timeout)
+
+    def _snapshot(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        status = job["status"]
+        if status == "queued" and job["future"] is not None and job["future"].running():
+            status = "running"
+        return {
+            "id": job["id"],
+            "status": status,
+            "submitted": job["submitted"],
+            "finished": job["finished"],
+            "result": job["result"],
+            "error": job["error"],
+        }
+
+
+def _record_job(app, result, error, tag):
+    # Job workers may be other processes, so their metrics and history are recorded here
+    if error is not None:
+        REQUESTS.inc(mode="async", status="error")
+    elif isinstance(result, dict):
+        observe_results(result, mode="async")
+    recorder = get_history_recorder(app)
+    if recorder is not None and tag is not None:
+        recorder.record_job(result, error, tag)
+
+
+def get_job_queue(app):
+    """
+    Return the app's JobQueue, creating its executor on first use.
+
+    The pool is created lazily so it is started inside each gunicorn worker
+    rather than in the master before forking.
+    """
+    queue = app.extensions.get("job_queue")
+    if queue is not None:
+        return queue
+    with _init_lock:
+        queue = app.extensions.get("job_queue")
+        if queue is None:
+            executor = make_executor(app.config["JOB_BACKEND"], app.config["JOB_WORKERS"])
+            queue = JobQueue(
+                executor,
+                max_pending=app.config["JOB_MAX_PENDING"],
+                result_ttl=app.config["JOB_RESULT_TTL"],
+                # Callbacks run outside any app context, so they get the app itself, not current_app
+                on_finish=functools.partial(_record_job, getattr(app, "_get_current_object", lambda: app)()),
+            )
+            JOBS_PENDING.callback = queue.pending
+            app.extensions["job_queue"] = queue
+    return queue
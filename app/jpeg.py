@@ -0,0 +1,652 @@
+"""
+JPEG-domain forensics: quantization tables and DCT coefficients read
+straight from the uploaded file, with entropy decoding only.
+
+The pixel-domain detectors see the upload after analyze_bytes has decoded
+(and usually re-encoded) it, so its compression history is gone by then.
+This module goes back to the original bytes:
+
+* the quantization tables give the last save's quality (exact for tables
+  scaled from the standard ones, as libjpeg, Pillow, OpenCV and most phones
+  write them) and a fingerprint matched against known encoders;
+* the luma DCT coefficients, Huffman-decoded but never inverse transformed,
+  show whether the image was JPEG compressed twice on the same 8x8 grid
+  (aligned double compression): requantizing already quantized coefficients
+  leaves periodic gaps and peaks in their histograms. Per block, the
+  coefficients are then scored for whether they follow that periodic
+  pattern; a pasted region that was compressed once, or on a shifted grid,
+  does not, and shows up as a cluster of non-aligned blocks in an otherwise
+  aligned image.
+
+The coefficients come from jpegio when it is installed (any JPEG, including
+progressive); otherwise a built-in decoder reads baseline sequential
+Huffman files, which covers cameras, phones and almost every encoder's
+default. Progressive or arithmetic-coded uploads then get the table
+analysis only.
+"""
+import array
+import hashlib
+import json
+import math
+import os
+import re
+import struct
+import tempfile
+
+import cv2
+import numpy as np
+
+from .deadlines import check
+from .ela import _LUMA_TABLE
+
+try:
+    import jpegio
+except ImportError:  # optional: coefficients of progressive JPEGs too
+    jpegio = None
+
+# Standard JPEG chrominance table (ITU T.81 Annex K), row-major
+_CHROMA_TABLE = np.array([
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+], np.float32)
+
+# Zigzag position -> row-major index within an 8x8 block
+ZIGZAG = np.array([
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+])
+
+_BASELINE_SOF = {0xC0, 0xC1}
+_FRAME_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_SCAN_END = re.compile(rb"\xff[^\x00\xd0-\xd7]")
+_RESTART = re.compile(rb"\xff[\xd0-\xd7]")
+
+
+class UnsupportedJpeg(ValueError):
+    """
+    Raised for JPEGs whose coefficients the built-in decoder can't read.
+    """
+
+
+def parse_jpeg(data):
+    """
+    Walk a JPEG's marker segments up to the first scan that carries luma.
+
+    Returns {"width", "height", "progressive", "coding", "components",
+    "tables", "huffman", "restart", "scan", "scan_start"}: components are
+    (id, h, v, table) tuples in frame order, tables maps a table id to its
+    64 steps in row-major order, huffman maps (class, id) to (counts,
+    symbols), and scan lists the (component index, dc table, ac table) of
+    the scan whose entropy-coded data begins at scan_start.
+    """
+    buf = memoryview(data)
+    if bytes(buf[:2]) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+    info = {"width": None, "height": None, "progressive": False, "coding": None, "components": [],
+            "tables": {}, "huffman": {}, "restart": 0, "scan": None, "scan_start": None}
+    pos, end = 2, len(buf)
+    while pos + 4 <= end:
+        if buf[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        pos += 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker == 0xD9:
+            break
+        (length,) = struct.unpack_from(">H", buf, pos)
+        body = bytes(buf[pos + 2:pos + length])
+        if marker == 0xDB:
+            _read_dqt(body, info["tables"])
+        elif marker == 0xC4:
+            _read_dht(body, info["huffman"])
+        elif marker == 0xDD:
+            (info["restart"],) = struct.unpack_from(">H", body)
+        elif marker in _FRAME_SOF and info["width"] is None:
+            info["height"], info["width"], count = struct.unpack_from(">HHB", body, 1)
+            info["components"] = [
+                (body[6 + 3 * i], body[7 + 3 * i] >> 4, body[7 + 3 * i] & 15, body[8 + 3 * i])
+                for i in range(count)
+            ]
+            info["progressive"] = marker in (0xC2, 0xC6, 0xCA, 0xCE)
+            info["coding"] = "huffman" if marker < 0xC8 else "arithmetic"
+            info["baseline"] = marker in _BASELINE_SOF
+        elif marker == 0xDA:
+            ids = [component[0] for component in info["components"]]
+            scan = []
+            for i in range(body[0]):
+                component, tables = body[1 + 2 * i], body[2 + 2 * i]
+                if component in ids:
+                    scan.append((ids.index(component), tables >> 4, tables & 15))
+            pos += length
+            # Sequential files may code each component in its own scan; luma comes first
+            if scan and scan[0][0] == 0:
+                info["scan"], info["scan_start"] = scan, pos
+                break
+            match = _SCAN_END.search(data, pos)
+            pos = match.start() if match else end
+            continue
+        pos += length
+    if not info["components"] or not info["tables"]:
+        raise ValueError("JPEG has no frame header or quantization tables")
+    return info
+
+
+def _read_dqt(body, tables):
+    pos = 0
+    while pos < len(body):
+        precision, table_id = body[pos] >> 4, body[pos] & 15
+        size = 128 if precision else 64
+        steps = np.frombuffer(body, ">u2" if precision else np.uint8, 64, pos + 1).astype(np.int32)
+        natural = np.empty(64, np.int32)
+        natural[ZIGZAG] = steps
+        tables[table_id] = natural
+        pos += 1 + size
+
+
+def _read_dht(body, huffman):
+    pos = 0
+    while pos + 17 <= len(body):
+        table_class, table_id = body[pos] >> 4, body[pos] & 15
+        counts = list(body[pos + 1:pos + 17])
+        total = sum(counts)
+        huffman[table_class, table_id] = (counts, list(body[pos + 17:pos + 17 + total]))
+        pos += 17 + total
+
+
+def _codes(counts, symbols):
+    # Canonical Huffman codes: (code, length, symbol)
+    code, index = 0, 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            yield code, length, symbols[index]
+            index += 1
+            code += 1
+        code <<= 1
+
+
+def _extend(value, size):
+    return value - (1 << size) + 1 if value < 1 << (size - 1) else value
+
+
+def _lookup(counts, symbols, dc):
+    """
+    A 65536-entry table indexed by the next 16 bits of the stream.
+
+    Where the code and its extra bits fit in 16 bits the entry holds the
+    decoded result: (bits used, run, value), with run 0 for DC tables and
+    value 0 for EOB and ZRL. Otherwise the entry is (code length, symbol,
+    None) and the extra bits are read separately.
+    """
+    table = [None] * 65536
+    for code, length, symbol in _codes(counts, symbols):
+        run, size = (0, symbol) if dc else (symbol >> 4, symbol & 15)
+        if size == 0 or length + size > 16:
+            span = 1 << (16 - length)
+            start = code << (16 - length)
+            table[start:start + span] = [(length, run, 0) if size == 0 else (length, symbol, None)] * span
+            continue
+        span = 1 << (16 - length - size)
+        for extra in range(1 << size):
+            start = ((code << size) | extra) << (16 - length - size)
+            table[start:start + span] = [(length + size, run, _extend(extra, size))] * span
+    return table
+
+
+def _windows(segment):
+    # 32 bits of the stream starting at every byte; zero padding reads as zeros past the end
+    raw = np.frombuffer(segment.replace(b"\xff\x00", b"\xff") + bytes(8), np.uint8).astype(np.uint32)
+    return memoryview((raw[:-7] << 24) | (raw[1:-6] << 16) | (raw[2:-5] << 8) | raw[3:-4])
+
+
+def read_luma_coefficients(data, info=None):
+    """
+    Quantized luma DCT coefficients as an int16 array (block rows, block cols, 64),
+    row-major within each block, plus the luma quantization table.
+
+    Uses jpegio when installed, the built-in baseline decoder otherwise.
+    Raises UnsupportedJpeg when neither can read the file.
+    """
+    info = info or parse_jpeg(data)
+    if jpegio is not None:
+        return _jpegio_coefficients(data, info)
+    if info["coding"] != "huffman" or info["progressive"]:
+        raise UnsupportedJpeg("Progressive or arithmetic-coded JPEG; install jpegio to read its coefficients")
+    if info["scan"] is None:
+        raise UnsupportedJpeg("No scan carries the luma component")
+    return _decode_luma(data, info), info["tables"][info["components"][0][3]]
+
+
+def _jpegio_coefficients(data, info):
+    # jpegio reads from a path only
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as fh:
+        fh.write(data)
+    try:
+        decoded = jpegio.read(fh.name)
+    finally:
+        os.unlink(fh.name)
+    coefs = np.asarray(decoded.coef_arrays[0], np.int16)
+    rows, cols = coefs.shape[0] // 8, coefs.shape[1] // 8
+    blocks = coefs[:rows * 8, :cols * 8].reshape(rows, 8, cols, 8).transpose(0, 2, 1, 3).reshape(rows, cols, 64)
+    table = np.asarray(decoded.quant_tables[0], np.int32).reshape(64)
+    return np.ascontiguousarray(blocks), table
+
+
+def _decode_luma(data, info):
+    components = info["components"]
+    scan = info["scan"]
+    width, height = info["width"], info["height"]
+    hmax = max(component[1] for component in components)
+    vmax = max(component[2] for component in components)
+    luma_h, luma_v = components[0][1], components[0][2]
+    huffman = {key: _lookup(*value, dc=key[0] == 0) for key, value in info["huffman"].items()}
+
+    if len(scan) == 1:
+        # A non-interleaved scan codes the component's own block grid, one block per MCU
+        cols = math.ceil(math.ceil(width * luma_h / hmax) / 8)
+        rows = math.ceil(math.ceil(height * luma_v / vmax) / 8)
+        mcu_cols, mcu_rows = cols, rows
+        grid_cols, step_h, step_v = cols, 1, 1
+        plan = [(0, 0, True)]
+    else:
+        mcu_cols, mcu_rows = math.ceil(width / (8 * hmax)), math.ceil(height / (8 * vmax))
+        grid_cols, step_h, step_v = mcu_cols * luma_h, luma_h, luma_v
+        cols = math.ceil(math.ceil(width * luma_h / hmax) / 8)
+        rows = math.ceil(math.ceil(height * luma_v / vmax) / 8)
+        plan = []
+        for index, _, _ in scan:
+            _, h, v, _ = components[index]
+            for dy in range(v):
+                for dx in range(h):
+                    plan.append((index, dy * grid_cols + dx, index == 0))
+    tables = {index: (huffman.get((0, dc)), huffman.get((1, ac))) for index, dc, ac in scan}
+    if any(dc is None or ac is None for dc, ac in tables.values()):
+        raise UnsupportedJpeg("Missing Huffman table")
+    blocks = [(index, offset, store) + tables[index] for index, offset, store in plan]
+
+    match = _SCAN_END.search(data, info["scan_start"])
+    stream = bytes(data[info["scan_start"]:match.start() if match else len(data)])
+    total_mcus = mcu_cols * mcu_rows
+    interval = info["restart"] or total_mcus
+    segments = _RESTART.split(stream) if info["restart"] else [stream]
+
+    grid_rows = mcu_rows * step_v
+    flat = array.array("i", bytes(4 * grid_rows * grid_cols * 64))
+    start = 0
+    for segment in segments:
+        if start >= total_mcus:
+            break
+        stop = min(start + interval, total_mcus)
+        win = _windows(segment)
+        limit = len(segment) * 8
+        pos = 0
+        predictors = [0] * len(components)
+        for mcu in range(start, stop):
+            row, col = divmod(mcu, mcu_cols)
+            if not col:
+                check()  # a large image takes seconds in this loop
+            base = row * step_v * grid_cols + col * step_h
+            for index, offset, store, dct, act in blocks:
+                n, size, diff = dct[(win[pos >> 3] >> (16 - (pos & 7))) & 0xFFFF]
+                pos += n
+                if diff is None:
+                    pos, diff = _read_extra(win, pos, size)
+                predictors[index] += diff
+                k = 1
+                # The hot loop: one table lookup per coefficient, chroma decoded but not kept
+                if store:
+                    first = (base + offset) * 64
+                    flat[first] = predictors[index]
+                    while k < 64:
+                        n, run, value = act[(win[pos >> 3] >> (16 - (pos & 7))) & 0xFFFF]
+                        pos += n
+                        if value is None:
+                            pos, value = _read_extra(win, pos, run & 15)
+                            run >>= 4
+                        elif not value and run != 15:
+                            break
+                        k += run
+                        flat[first + k] = value
+                        k += 1
+                else:
+                    while k < 64:
+                        n, run, value = act[(win[pos >> 3] >> (16 - (pos & 7))) & 0xFFFF]
+                        pos += n
+                        if value is None:
+                            pos, _ = _read_extra(win, pos, run & 15)
+                            run >>= 4
+                        elif not value and run != 15:
+                            break
+                        k += run + 1
+                if k > 64:
+                    raise ValueError("Corrupt JPEG scan")
+            if pos > limit:
+                raise ValueError("Truncated JPEG scan")
+        start = stop
+
+    flat = np.frombuffer(flat, np.int32).astype(np.int16)
+    zigzag = flat.reshape(grid_rows, grid_cols, 64)[:rows, :cols]
+    natural = np.empty_like(zigzag)
+    natural[..., ZIGZAG] = zigzag
+    return natural
+
+
+def _read_extra(win, pos, size):
+    if size == 0:
+        return pos, 0
+    w = win[pos >> 3]
+    extra = (w >> (32 - (pos & 7) - size)) & ((1 << size) - 1)
+    return pos + size, _extend(extra, size)
+
+
+def _ijg_tables(base):
+    # Every quality's table exactly as libjpeg's jpeg_set_quality scales it (integer arithmetic)
+    base = base.astype(np.int64)
+    tables = []
+    for quality in range(1, 101):
+        scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+        tables.append(np.clip((base * scale + 50) // 100, 1, 255))
+    return np.stack(tables).astype(np.int32)
+
+
+_IJG_LUMA = _ijg_tables(_LUMA_TABLE)
+_IJG_CHROMA = _ijg_tables(_CHROMA_TABLE)
+
+
+def estimate_quality(table, chroma=False):
+    """
+    (quality, exact) for a row-major quantization table.
+
+    exact means the table is the standard one scaled to that quality, as
+    libjpeg writes it. Other tables get the quality whose standard table is
+    closest in log scale.
+    """
+    candidates = _IJG_CHROMA if chroma else _IJG_LUMA
+    table = np.asarray(table, np.int32)
+    exact = np.flatnonzero((candidates == table).all(axis=1))
+    if exact.size:
+        return int(exact[-1]) + 1, True
+    error = np.abs(np.log(candidates) - np.log(np.maximum(table, 1))).sum(axis=1)
+    return int(np.argmin(error)) + 1, False
+
+
+def table_digest(tables):
+    """
+    Short fingerprint of a file's quantization tables, independent of their slot order in the file.
+    """
+    digest = hashlib.sha256()
+    for table_id in sorted(tables):
+        digest.update(np.asarray(tables[table_id], ">u2").tobytes())
+    return digest.hexdigest()[:16]
+
+
+_known_tables = {}
+
+
+def load_known_tables(path):
+    """
+    {table digest: label} from a JSON file, re-read when it changes.
+
+    The file maps the "digest" values this module reports to the camera or
+    program that writes those tables, so encoders met in practice can be
+    catalogued without a code change.
+    """
+    if not path:
+        return {}
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    cached = _known_tables.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as fh:
+            cached = (mtime, {str(digest): str(label) for digest, label in json.load(fh).items()})
+        _known_tables[path] = cached
+    return cached[1]
+
+
+def identify_tables(info, known=None):
+    """
+    Describe a file's quantization tables: estimated quality, whether they
+    are libjpeg's standard tables, their digest and the encoder they match.
+    """
+    components = info["components"]
+    luma = info["tables"][components[0][3]]
+    quality, standard = estimate_quality(luma)
+    if len(components) > 1 and components[1][3] in info["tables"]:
+        chroma_quality, chroma_standard = estimate_quality(info["tables"][components[1][3]], chroma=True)
+        standard = standard and chroma_standard and chroma_quality == quality
+    digest = table_digest({components[i][3]: info["tables"][components[i][3]]
+                           for i in range(len(components)) if components[i][3] in info["tables"]})
+    match = (known or {}).get(digest)
+    if match is None and standard:
+        match = f"libjpeg standard tables, quality {quality}"
+    return {"quality": quality, "standard": standard, "digest": digest, "match": match}
+
+
+# Double compression is judged on the first 15 AC coefficients in zigzag order
+DQ_FREQUENCIES = ZIGZAG[1:16]
+HISTOGRAM_BINS = 128
+MAX_STEP = 255
+TOLERANCE = 0.75  # rounding noise of a decoded and re-encoded coefficient, in dequantized units
+OFF_LATTICE = 0.02  # share of a double compressed image's coefficients off the lattice
+UNINFORMATIVE = 0.9  # lattices that hold this much of a smooth histogram prove nothing
+MIN_LLR = 30.0  # nats of evidence for a frequency to count as double compressed
+MIN_FREQUENCIES = 2  # double compressed frequencies for an image to count as such
+
+# Block evidence is summed over WINDOW x WINDOW blocks; see find_regions
+WINDOW = 4
+NON_ALIGNED_LLR = 6.0
+REGION_Z = 4.0
+MIN_REGION_BLOCKS = 16
+
+
+def lattice_fit(hist, step):
+    """
+    Score every candidate first-save step for one frequency.
+
+    hist[x] counts coefficients with |value| == x, quantized with step. A
+    coefficient first quantized with q1 lands, once requantized with step,
+    on the lattice x * step ~ k * q1 (within step / 2 plus TOLERANCE). Each
+    q1 is scored by the log-likelihood ratio of the histogram under "on the
+    q1 lattice but for OFF_LATTICE strays" against a single compression,
+    modelled as a geometric falloff with the histogram's mean. Bin 0 is on
+    every lattice and ignored.
+
+    Returns (candidates, llr, on, share): the candidate steps, their
+    log-likelihood ratios (-inf where the lattice is uninformative), the
+    per-bin lattice membership and the share of a smooth histogram each
+    lattice holds.
+    """
+    bins = np.arange(1, len(hist))
+    counts = hist[1:].astype(np.float64)
+    total = counts.sum()
+    candidates = np.arange(step + 1, MAX_STEP + 1)
+    if total == 0 or candidates.size == 0:
+        return candidates, np.full(candidates.size, -np.inf), None, None
+    ratio = 1.0 - 1.0 / max(float((bins * counts).sum() / total), 1.0)
+    smooth = ratio ** (bins - 1.0)
+    smooth /= smooth.sum()
+    values = bins[None, :] * float(step)
+    on = np.abs(values - np.round(values / candidates[:, None]) * candidates[:, None]) <= step / 2 + TOLERANCE
+    share = np.minimum(on @ smooth, 1.0)
+    on_count = on @ counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        llr = (on_count * np.log((1 - OFF_LATTICE) / share)
+               + (total - on_count) * np.log(OFF_LATTICE / (1 - share)))
+    llr[share >= UNINFORMATIVE] = -np.inf
+    return candidates, llr, on, share
+
+
+def primary_quality(fits, table):
+    """
+    The first save's quality: the standard table whose steps best explain
+    every double compressed frequency, by summed log-likelihood ratio.
+
+    Adjacent qualities can share a table; of a tied run the middle one is taken.
+    """
+    totals = np.zeros(100)
+    for frequency, (candidates, llr, _, _) in fits.items():
+        steps = _IJG_LUMA[:, frequency]
+        index = steps - candidates[0]
+        valid = (index >= 0) & (index < candidates.size)
+        gains = np.where(valid, llr[np.clip(index, 0, candidates.size - 1)], 0.0)
+        totals += np.where(np.isfinite(gains), gains, 0.0)
+    if totals.max() <= 0:
+        return None
+    best = np.flatnonzero(totals == totals.max())
+    return int(best[len(best) // 2]) + 1
+
+
+def block_evidence(coefs, steps, fits):
+    """
+    Per-block log-likelihood ratio of aligned double compression and the
+    number of coefficients it rests on, both summed over WINDOW x WINDOW blocks.
+    """
+    rows, cols = coefs.shape[:2]
+    llr = np.zeros((rows, cols), np.float32)
+    support = np.zeros((rows, cols), np.float32)
+    for frequency, step in steps.items():
+        candidates, _, on, share = fits[frequency]
+        row = step - candidates[0]
+        # Per-bin evidence for the chosen lattice; bin 0 and values past the histogram carry none
+        gain = np.zeros(HISTOGRAM_BINS + 1, np.float32)
+        gain[1:HISTOGRAM_BINS] = np.where(on[row], math.log((1 - OFF_LATTICE) / share[row]),
+                                          math.log(OFF_LATTICE / (1 - share[row])))
+        values = np.minimum(np.abs(coefs[..., frequency].astype(np.int32)), HISTOGRAM_BINS)
+        llr += gain[values]
+        support += (values > 0) & (values < HISTOGRAM_BINS)
+    window = (WINDOW, WINDOW)
+    return (cv2.boxFilter(llr, -1, window, normalize=False, borderType=cv2.BORDER_CONSTANT),
+            cv2.boxFilter(support, -1, window, normalize=False, borderType=cv2.BORDER_CONSTANT))
+
+
+def find_regions(llr, support, max_regions=8):
+    """
+    Connected runs of non-aligned blocks, strongest first.
+
+    A block is non-aligned when its window's log-likelihood ratio is below
+    -NON_ALIGNED_LLR and a robust z-score of REGION_Z or more under the
+    image's typical window, so a weak image-wide pattern doesn't turn every
+    poorly fitting window into a region. Each region is {"box": [x, y, w, h]
+    in pixels, "score": mean negative z, "area": fraction of the image}.
+    """
+    informed = llr[support >= WINDOW * WINDOW]
+    if informed.size < MIN_REGION_BLOCKS:
+        return []
+    center = float(np.median(informed))
+    spread = max(1.4826 * float(np.median(np.abs(informed - center))), 1.0)
+    z = (llr - center) / spread
+    mask = ((llr <= -NON_ALIGNED_LLR) & (z <= -REGION_Z)).astype(np.uint8)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    regions = []
+    for label in range(1, count):
+        x, y, w, h, blocks = stats[label]
+        if blocks < MIN_REGION_BLOCKS:
+            continue
+        regions.append({
+            "box": [int(x * 8), int(y * 8), int(w * 8), int(h * 8)],
+            "score": round(float(-z[labels == label].mean()), 2),
+            "area": round(float(blocks) / llr.size, 4),
+        })
+    regions.sort(key=lambda region: region["score"] * math.sqrt(region["area"]), reverse=True)
+    return regions[:max_regions]
+
+
+def calibrated_score(regions):
+    """
+    Map the strongest region's z-score onto 0..1 (0.5 at REGION_Z).
+    """
+    if not regions:
+        return 0.0
+    strongest = max(region["score"] for region in regions)
+    return round(1.0 / (1.0 + math.exp(-(strongest - REGION_Z))), 3)
+
+
+def double_compression(coefs, table):
+    """
+    Aligned double compression analysis of quantized luma coefficients.
+
+    Returns {"double_compressed", "primary_quality", "primary_steps",
+    "llr", "support", "regions", "score"}. primary_steps maps each double
+    compressed frequency (row-major index) to its estimated first-save
+    step. The block maps and regions are only computed for double
+    compressed images: without an aligned pattern there is nothing to
+    deviate from.
+    """
+    fits, steps = {}, {}
+    for frequency in DQ_FREQUENCIES:
+        frequency = int(frequency)
+        values = np.minimum(np.abs(coefs[..., frequency].astype(np.int32)).ravel(), HISTOGRAM_BINS)
+        hist = np.bincount(values, minlength=HISTOGRAM_BINS + 1)[:HISTOGRAM_BINS]
+        fit = lattice_fit(hist, int(table[frequency]))
+        candidates, llr = fit[0], fit[1]
+        if candidates.size and llr.max() >= MIN_LLR:
+            fits[frequency] = fit
+            # Divisors of the true step fit too, with less to gain; the best fit is the coarsest
+            steps[frequency] = int(candidates[int(np.argmax(llr))])
+    result = {"double_compressed": len(steps) >= MIN_FREQUENCIES, "primary_quality": None,
+              "primary_steps": steps, "llr": None, "support": None, "regions": [], "score": 0.0}
+    if not result["double_compressed"]:
+        return result
+    result["primary_quality"] = primary_quality(fits, table)
+    llr, support = block_evidence(coefs, steps, fits)
+    regions = find_regions(llr, support)
+    result.update(llr=llr, support=support, regions=regions, score=calibrated_score(regions))
+    return result
+
+
+def detect_jpeg(data, known_tables=None, max_pixels=None):
+    """
+    JPEG-domain analysis of an upload's original bytes.
+
+    Returns {"width", "height", "progressive", "tables", "dct", ...}:
+    tables comes from identify_tables; with "dct" True the keys of
+    double_compression follow. DCT analysis is skipped ("dct_error" says
+    why) for files the decoder can't read and, with the built-in decoder,
+    for images over max_pixels. Raises ValueError for non-JPEG data.
+    """
+    info = parse_jpeg(data)
+    result = {
+        "width": info["width"],
+        "height": info["height"],
+        "progressive": info["progressive"],
+        "tables": identify_tables(info, known_tables),
+        "dct": False,
+    }
+    if jpegio is None and max_pixels and info["width"] * info["height"] > max_pixels:
+        result["dct_error"] = f"Larger than {max_pixels} pixels; install jpegio to analyze its coefficients"
+        return result
+    try:
+        coefs, table = read_luma_coefficients(data, info)
+    except (UnsupportedJpeg, ValueError) as e:
+        result["dct_error"] = str(e)
+        return result
+    result["dct"] = True
+    result.update(double_compression(coefs, table))
+    return result
+
+
+def map_values(result):
+    """
+    Block map of aligned double compression as uint8 heatmap values, one per 8x8 block.
+
+    Low where blocks follow the image's double compression pattern, high
+    where they don't, mid-range where there is too little texture to tell.
+    Read with the "inferno" colormap.
+    """
+    llr, support = result["llr"], result["support"]
+    misaligned = 1.0 / (1.0 + np.exp(np.clip(llr, -30, 30) / 2))
+    misaligned[support < WINDOW] = 0.5
+    return (misaligned * 255).astype(np.uint8)
@@ -0,0 +1,558 @@
+"""
+Header-only metadata reader: EXIF, XMP and ICC straight from the upload bytes.
+
+extract_segments walks the container (JPEG APP segments, PNG chunks, HEIF
+boxes) and slices out the raw metadata blocks without decoding any pixels;
+summarize turns them into a compact, JSON-safe tag table plus cheap tamper
+signals (editing software, edit history, inconsistent dates, a thumbnail
+that does not fit the image). Everything works on bytes or a memoryview and
+copies only the metadata blocks, so a typical camera JPEG is read in well
+under a millisecond.
+"""
+import datetime
+import hashlib
+import io
+import re
+import struct
+import zlib
+
+import numpy as np
+from PIL import ExifTags, Image
+
+from .intake import _JPEG_SOF, InvalidImageUpload, _boxes
+
+XMP_NS = b"http://ns.adobe.com/xap/1.0/\x00"
+ICC_TAG = b"ICC_PROFILE\x00"
+
+# Substrings of Software / CreatorTool values written by image editors (matched lowercase)
+EDITORS = (
+    "photoshop", "gimp", "lightroom", "affinity", "pixelmator", "paint.net", "snapseed",
+    "picsart", "facetune", "canva", "photopea", "krita", "darktable", "capture one",
+    "luminar", "photoscape", "fotor", "corel", "paintshop", "acdsee",
+)
+
+MAX_STRING = 256  # longer strings are cut short in the output
+MAX_VALUES = 16  # longer arrays are summarized as "<n values>"
+MAX_TAGS = 512  # entries read per IFD; more means a corrupt or hostile file
+
+# TIFF field type -> (struct code, size)
+_TIFF_TYPES = {
+    1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1),
+    7: ("s", 1), 8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8), 13: ("I", 4),
+}
+
+_EXIF_IFD, _GPS_IFD = 0x8769, 0x8825
+_MAKER_NOTE, _USER_COMMENT = 0x927C, 0x9286
+_THUMB_OFFSET, _THUMB_LENGTH = 0x0201, 0x0202
+
+_DATE_TAGS = ("DateTime", "DateTimeOriginal", "DateTimeDigitized")
+
+
+def extract_segments(data):
+    """
+    Slice the metadata blocks out of an image file without decoding pixels.
+
+    Returns {"format", "width", "height", "exif", "xmp", "icc", "text",
+    "photoshop"} where exif/xmp/icc are raw bytes (b"" when absent), text
+    holds PNG text chunks and photoshop tells whether Photoshop image
+    resources (JPEG APP13) are present.
+    """
+    segments = {
+        "format": None, "width": None, "height": None,
+        "exif": b"", "xmp": b"", "icc": b"", "text": {}, "photoshop": False,
+    }
+    head = bytes(data[:12])
+    try:
+        if head.startswith(b"\xff\xd8"):
+            segments["format"] = "JPEG"
+            _jpeg_segments(data, segments)
+        elif head.startswith(b"\x89PNG\r\n\x1a\n"):
+            segments["format"] = "PNG"
+            _png_segments(data, segments)
+        elif head[4:8] == b"ftyp":
+            segments["format"] = "HEIF"
+            _heif_segments(data, segments)
+        elif head[:6] in (b"GIF87a", b"GIF89a"):
+            segments["format"] = "GIF"
+            segments["width"], segments["height"] = struct.unpack_from("<HH", data, 6)
+    except (struct.error, IndexError, ValueError, zlib.error, InvalidImageUpload):
+        pass  # keep whatever was found before the damage
+    return segments
+
+
+def _jpeg_segments(buf, segments):
+    icc_chunks = {}
+    pos = 2
+    end = len(buf)
+    while pos + 4 <= end:
+        if buf[pos] != 0xFF:
+            break
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # fill byte
+            continue
+        pos += 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker in (0xD9, 0xDA):
+            break  # entropy-coded data follows; metadata always comes before it
+        (length,) = struct.unpack_from(">H", buf, pos)
+        start, stop = pos + 2, min(end, pos + length)
+        if marker == 0xE1:
+            lead = bytes(buf[start:start + len(XMP_NS)])
+            if lead.startswith(b"Exif\x00\x00") and not segments["exif"]:
+                segments["exif"] = bytes(buf[start + 6:stop])
+            elif lead == XMP_NS and not segments["xmp"]:
+                segments["xmp"] = bytes(buf[start + len(XMP_NS):stop])
+        elif marker == 0xE2 and bytes(buf[start:start + 12]) == ICC_TAG:
+            icc_chunks[buf[start + 12]] = bytes(buf[start + 14:stop])
+        elif marker == 0xED and bytes(buf[start:start + 13]) == b"Photoshop 3.0":
+            segments["photoshop"] = True
+        elif marker == 0xFE:
+            segments["text"]["Comment"] = bytes(buf[start:stop]).decode("latin-1")
+        elif marker in _JPEG_SOF and segments["width"] is None:
+            segments["height"], segments["width"] = struct.unpack_from(">HH", buf, start + 1)
+        pos += length
+    segments["icc"] = b"".join(icc_chunks[seq] for seq in sorted(icc_chunks))
+
+
+def _png_segments(buf, segments):
+    pos = 8
+    end = len(buf)
+    while pos + 8 <= end:
+        length, kind = struct.unpack_from(">I4s", buf, pos)
+        start, stop = pos + 8, pos + 8 + length
+        if stop > end:
+            break
+        if kind == b"IHDR":
+            segments["width"], segments["height"] = struct.unpack_from(">II", buf, start)
+        elif kind == b"eXIf":
+            segments["exif"] = bytes(buf[start:stop])
+        elif kind == b"iCCP":
+            payload = bytes(buf[start:stop])
+            segments["icc"] = zlib.decompress(payload[payload.index(b"\x00") + 2:])
+        elif kind in (b"tEXt", b"zTXt", b"iTXt") and len(segments["text"]) < 32:
+            keyword, text = _png_text(kind, bytes(buf[start:stop]))
+            if keyword == "XML:com.adobe.xmp":
+                segments["xmp"] = text.encode("utf-8")
+            elif keyword.startswith("Raw profile type ") and keyword[17:] in ("exif", "APP1"):
+                # ImageMagick's hex dump: "\nexif\n    <length>\n<hex lines>"
+                blob = bytes.fromhex("".join(text.split("\n")[3:]))
+                segments["exif"] = blob[6:] if blob.startswith(b"Exif\x00\x00") else blob
+            else:
+                segments["text"][keyword] = text
+        elif kind == b"IEND":
+            break
+        pos = stop + 4  # skip the CRC
+
+
+def _png_text(kind, payload):
+    keyword, _, rest = payload.partition(b"\x00")
+    if kind == b"tEXt":
+        text = rest
+    elif kind == b"zTXt":
+        text = zlib.decompress(rest[1:])
+    else:
+        compressed = rest[0] == 1
+        # compression flag, method, language tag\0, translated keyword\0, text
+        text = rest[2:].split(b"\x00", 2)[-1]
+        if compressed:
+            text = zlib.decompress(text)
+        return keyword.decode("latin-1"), text.decode("utf-8", "replace")
+    return keyword.decode("latin-1"), text.decode("latin-1")
+
+
+def _heif_segments(buf, segments):
+    for kind, start, end in _boxes(buf, 0, len(buf)):
+        if kind != b"meta":
+            continue
+        items = {}  # item id -> item type or mime content type
+        locations = {}  # item id -> [(offset, length), ...]
+        sizes = []
+        for kind, start, end in _boxes(buf, start + 4, end):  # meta is a full box
+            if kind == b"iinf":
+                _heif_item_info(buf, start, end, items)
+            elif kind == b"iloc":
+                _heif_item_locations(buf, start, end, locations)
+            elif kind == b"iprp":
+                for kind, start, end in _boxes(buf, start, end):
+                    if kind != b"ipco":
+                        continue
+                    for kind, start, end in _boxes(buf, start, end):
+                        if kind == b"ispe" and start + 12 <= end:
+                            sizes.append(struct.unpack_from(">II", buf, start + 4))
+                        elif kind == b"colr" and bytes(buf[start:start + 4]) in (b"prof", b"rICC"):
+                            segments["icc"] = segments["icc"] or bytes(buf[start + 4:end])
+        if sizes:
+            segments["width"], segments["height"] = max(sizes, key=lambda size: size[0] * size[1])
+        for item_id, item_type in items.items():
+            extents = locations.get(item_id)
+            if not extents or item_type not in ("Exif", "application/rdf+xml"):
+                continue  # image and thumbnail items: never copy pixel data
+            blob = b"".join(bytes(buf[offset:offset + length]) for offset, length in extents)
+            if item_type == "Exif" and not segments["exif"] and len(blob) > 4:
+                # Starts with the offset of the TIFF header, usually past an "Exif\0\0" prefix
+                (skip,) = struct.unpack_from(">I", blob, 0)
+                segments["exif"] = blob[4 + skip:]
+            elif item_type == "application/rdf+xml" and not segments["xmp"]:
+                segments["xmp"] = blob
+        return
+
+
+def _heif_item_info(buf, start, end, items):
+    version = buf[start]
+    pos = start + 4 + (2 if version == 0 else 4)
+    for kind, entry, entry_end in _boxes(buf, pos, end):
+        if kind != b"infe" or buf[entry] < 2:
+            continue
+        if buf[entry] == 2:
+            (item_id,) = struct.unpack_from(">H", buf, entry + 4)
+            pos = entry + 8
+        else:
+            (item_id,) = struct.unpack_from(">I", buf, entry + 4)
+            pos = entry + 10
+        item_type = bytes(buf[pos:pos + 4]).decode("latin-1")
+        if item_type == "mime":
+            # item_name\0 content_type\0
+            strings = bytes(buf[pos + 4:entry_end]).split(b"\x00")
+            item_type = strings[1].decode("latin-1") if len(strings) > 1 else item_type
+        items[item_id] = item_type
+
+
+def _read_uint(buf, pos, size):
+    if size == 0:
+        return 0, pos
+    return int.from_bytes(bytes(buf[pos:pos + size]), "big"), pos + size
+
+
+def _heif_item_locations(buf, start, end, locations):
+    version = buf[start]
+    offset_size, length_size = buf[start + 4] >> 4, buf[start + 4] & 0x0F
+    base_offset_size, index_size = buf[start + 5] >> 4, buf[start + 5] & 0x0F
+    if version not in (1, 2):
+        index_size = 0
+    pos = start + 6
+    count, pos = _read_uint(buf, pos, 2 if version < 2 else 4)
+    for _ in range(count):
+        item_id, pos = _read_uint(buf, pos, 2 if version < 2 else 4)
+        method = 0
+        if version in (1, 2):
+            method, pos = _read_uint(buf, pos, 2)
+            method &= 0x0F
+        pos += 2  # data_reference_index
+        base, pos = _read_uint(buf, pos, base_offset_size)
+        extent_count, pos = _read_uint(buf, pos, 2)
+        extents = []
+        for _ in range(extent_count):
+            _, pos = _read_uint(buf, pos, index_size)
+            offset, pos = _read_uint(buf, pos, offset_size)
+            length, pos = _read_uint(buf, pos, length_size)
+            extents.append((base + offset, length))
+        if pos > end:
+            return
+        if method == 0:  # only items stored at file offsets; idat/item references are not metadata
+            locations[item_id] = extents
+
+
+def segments_digest(segments):
+    """
+    Hash of everything summarize reads, for cache keys.
+    """
+    digest = hashlib.sha256()
+    for name in ("exif", "xmp", "icc"):
+        digest.update(struct.pack(">I", len(segments[name])))
+        digest.update(segments[name])
+    digest.update(repr((segments["photoshop"], sorted(segments["text"].items()))).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def parse_exif(exif):
+    """
+    Parse a TIFF-structured EXIF blob into named tags.
+
+    Returns {"ifd0", "exif", "gps", "thumbnail"} where thumbnail is the
+    embedded JPEG preview's bytes (or None). Only the directories are read;
+    MakerNote and other large blobs are reported by size.
+    """
+    parsed = {"ifd0": {}, "exif": {}, "gps": {}, "thumbnail": None}
+    if len(exif) < 8 or exif[:2] not in (b"II", b"MM"):
+        return parsed
+    order = "<" if exif[:2] == b"II" else ">"
+    (ifd0,) = struct.unpack_from(order + "I", exif, 4)
+    seen = set()
+    tags, next_ifd = _read_ifd(exif, order, ifd0, seen)
+    parsed["ifd0"] = _named(tags, ExifTags.TAGS)
+    if _EXIF_IFD in tags:
+        parsed["exif"] = _named(_read_ifd(exif, order, tags[_EXIF_IFD], seen)[0], ExifTags.TAGS)
+    if _GPS_IFD in tags:
+        parsed["gps"] = _named(_read_ifd(exif, order, tags[_GPS_IFD], seen)[0], ExifTags.GPSTAGS)
+    if next_ifd:
+        ifd1 = _read_ifd(exif, order, next_ifd, seen)[0]
+        offset, length = ifd1.get(_THUMB_OFFSET), ifd1.get(_THUMB_LENGTH)
+        if isinstance(offset, int) and isinstance(length, int) and 0 < offset < offset + length <= len(exif):
+            parsed["thumbnail"] = exif[offset:offset + length]
+    return parsed
+
+
+def _read_ifd(exif, order, offset, seen):
+    """
+    Read one IFD as {tag: value}, plus the offset of the next IFD (0 if none).
+    """
+    if offset in seen or offset + 2 > len(exif):
+        return {}, 0
+    seen.add(offset)
+    (count,) = struct.unpack_from(order + "H", exif, offset)
+    tags = {}
+    pos = offset + 2
+    for _ in range(min(count, MAX_TAGS)):
+        if pos + 12 > len(exif):
+            return tags, 0
+        tag, kind, n = struct.unpack_from(order + "HHI", exif, pos)
+        pos += 12
+        if kind not in _TIFF_TYPES:
+            continue
+        code, size = _TIFF_TYPES[kind]
+        total = size * n
+        start = pos - 4 if total <= 4 else struct.unpack_from(order + "I", exif, pos - 4)[0]
+        if start + total > len(exif):
+            continue
+        if tag == _MAKER_NOTE:
+            tags[tag] = f"<{n} bytes>"
+        elif code == "s":
+            tags[tag] = exif[start:start + n]
+        else:
+            values = struct.unpack_from(order + code * n, exif, start)
+            if len(code) == 2:  # rationals come as numerator, denominator pairs
+                values = [num / den if den else None for num, den in zip(values[::2], values[1::2])]
+            tags[tag] = values[0] if n == 1 else list(values)
+    (next_ifd,) = struct.unpack_from(order + "I", exif, pos) if pos + 4 <= len(exif) else (0,)
+    return tags, next_ifd
+
+
+def _named(tags, names):
+    named = {}
+    for tag, value in tags.items():
+        name = names.get(tag)
+        if name is None or tag in (_EXIF_IFD, _GPS_IFD, 0xA005):  # unknown tags and sub-IFD pointers
+            continue
+        if tag == _USER_COMMENT and isinstance(value, bytes):
+            value = value[8:]  # 8-byte character code prefix
+        named[name] = _compact(value)
+    return named
+
+
+def _compact(value):
+    """
+    Make a tag value JSON-safe and small.
+    """
+    if isinstance(value, bytes):
+        text = value.rstrip(b"\x00")
+        if text and all(32 <= c < 127 or c in (9, 10, 13) for c in text):
+            value = text.decode("ascii")
+        elif len(value) <= 8:
+            return list(value)
+        else:
+            return f"<{len(value)} bytes>"
+    if isinstance(value, str):
+        value = value.strip()
+        return value if len(value) <= MAX_STRING else value[:MAX_STRING] + "…"
+    if isinstance(value, list):
+        if len(value) > MAX_VALUES:
+            return f"<{len(value)} values>"
+        return [_compact(v) for v in value]
+    if isinstance(value, float):
+        return round(value, 6) if value == value and abs(value) != float("inf") else None
+    return value
+
+
+_XMP_FIELDS = {
+    "CreatorTool": "xmp:CreatorTool",
+    "CreateDate": "xmp:CreateDate",
+    "ModifyDate": "xmp:ModifyDate",
+    "MetadataDate": "xmp:MetadataDate",
+    "DateCreated": "photoshop:DateCreated",
+    "DocumentID": "xmpMM:DocumentID",
+    "OriginalDocumentID": "xmpMM:OriginalDocumentID",
+}
+
+
+def parse_xmp(xmp):
+    """
+    Pull the provenance fields out of an XMP packet, plus the software agents
+    recorded in its edit history. No XML parser: values may be attributes or
+    elements and regular expressions cover both.
+    """
+    text = xmp.decode("utf-8", "replace")
+    fields = {}
+    for name, qualified in _XMP_FIELDS.items():
+        pattern = re.escape(qualified)
+        match = (re.search(pattern + r'\s*=\s*"([^"]*)"', text)
+                 or re.search("<" + pattern + r">([^<]*)</", text))
+        if match:
+            fields[name] = _compact(match.group(1))
+    agents = re.findall(r'stEvt:softwareAgent\s*=\s*"([^"]*)"', text)
+    agents += re.findall(r"<stEvt:softwareAgent>([^<]*)</", text)
+    actions = re.findall(r'stEvt:action\s*=\s*"([^"]*)"', text) + re.findall(r"<stEvt:action>([^<]*)</", text)
+    if agents or actions:
+        fields["History"] = _compact(sorted(set(agents)) or sorted(set(actions)))
+        fields["HistoryActions"] = _compact(sorted(set(actions)))
+    return fields
+
+
+def parse_icc(icc):
+    """
+    Describe an ICC profile from its header and description tag.
+    """
+    if len(icc) < 132:
+        return {}
+    fields = {
+        "Class": icc[12:16].decode("latin-1").strip(),
+        "ColorSpace": icc[16:20].decode("latin-1").strip(),
+        "Version": f"{icc[8]}.{icc[9] >> 4}",
+        "Creator": icc[80:84].decode("latin-1").strip("\x00 "),
+    }
+    (count,) = struct.unpack_from(">I", icc, 128)
+    for i in range(min(count, 64)):
+        signature, offset, size = struct.unpack_from(">4sII", icc, 132 + 12 * i)
+        if signature != b"desc" or offset + size > len(icc):
+            continue
+        kind = icc[offset:offset + 4]
+        if kind == b"desc":  # v2: ASCII count then text
+            (n,) = struct.unpack_from(">I", icc, offset + 8)
+            fields["Description"] = _compact(icc[offset + 12:offset + 12 + n].rstrip(b"\x00").decode("latin-1"))
+        elif kind == b"mluc":  # v4: first localized UTF-16 record
+            length, record = struct.unpack_from(">II", icc, offset + 20)
+            raw = icc[offset + record:offset + record + length]
+            fields["Description"] = _compact(raw.decode("utf-16-be", "replace"))
+        break
+    return fields
+
+
+def _parse_date(value):
+    """
+    EXIF ("2023:01:02 10:11:12") or XMP/ISO date as a naive local datetime, or None.
+    """
+    if not isinstance(value, str) or not value.strip("0: -T"):
+        return None
+    match = re.match(r"(\d{4})[:-](\d{2})[:-](\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?", value)
+    if not match:
+        return None
+    parts = [int(part) if part else 0 for part in match.groups()]
+    try:
+        return datetime.datetime(*parts)
+    except ValueError:
+        return None
+
+
+def _date_signals(tags, xmp, now):
+    signals = []
+    dates = {name: _parse_date(tags.get(name)) for name in _DATE_TAGS}
+    dates["XMP ModifyDate"] = _parse_date(xmp.get("ModifyDate"))
+    original = dates["DateTimeOriginal"]
+    slack = datetime.timedelta(seconds=60)
+    for name in ("DateTime", "XMP ModifyDate"):
+        if original and dates[name] and dates[name] - original > slack:
+            signals.append({"signal": "date_mismatch",
+                            "detail": f"{name} ({dates[name]}) is later than DateTimeOriginal ({original})"})
+    digitized = dates["DateTimeDigitized"]
+    if original and digitized and abs(digitized - original) > slack:
+        signals.append({"signal": "date_mismatch",
+                        "detail": f"DateTimeDigitized ({digitized}) differs from DateTimeOriginal ({original})"})
+    for name, value in dates.items():
+        if value and value > now + datetime.timedelta(days=1):
+            signals.append({"signal": "future_date", "detail": f"{name} is in the future ({value})"})
+    return signals
+
+
+def _editor(value):
+    if isinstance(value, str):
+        lowered = value.lower()
+        return any(name in lowered for name in EDITORS)
+    return False
+
+
+def summarize(segments, now=None):
+    """
+    Turn extract_segments output into (metadata, signals, thumbnail).
+
+    metadata is a flat {name: value} table (EXIF tags by name, XMP and ICC
+    fields prefixed "XMP " and "ICC "); signals lists {"signal", "detail"}
+    tamper hints that need nothing but the headers; thumbnail is the raw
+    embedded EXIF preview for the caller to compare against the pixels.
+    """
+    now = now or datetime.datetime.now()
+    parsed = parse_exif(segments["exif"]) if segments["exif"] else parse_exif(b"")
+    xmp = parse_xmp(segments["xmp"]) if segments["xmp"] else {}
+    icc = parse_icc(segments["icc"]) if segments["icc"] else {}
+
+    metadata = {}
+    metadata.update(parsed["ifd0"])
+    metadata.update(parsed["exif"])
+    metadata.update(parsed["gps"])
+    metadata.update(("XMP " + name, value) for name, value in xmp.items())
+    metadata.update(("ICC " + name, value) for name, value in icc.items())
+    metadata.update((name, _compact(value)) for name, value in segments["text"].items())
+
+    signals = []
+    for source, value in (("Software", metadata.get("Software")),
+                          ("XMP CreatorTool", xmp.get("CreatorTool")),
+                          ("PNG Software", segments["text"].get("Software"))):
+        if _editor(value):
+            signals.append({"signal": "editing_software", "detail": f"{source}: {value}"})
+    history = xmp.get("History")
+    if isinstance(history, list) and any(_editor(agent) for agent in history):
+        signals.append({"signal": "edit_history", "detail": "XMP history: " + ", ".join(history)})
+    if segments["photoshop"]:
+        signals.append({"signal": "photoshop_resources", "detail": "JPEG carries Photoshop image resources (APP13)"})
+    signals.extend(_date_signals(metadata, xmp, now))
+
+    thumbnail = parsed["thumbnail"]
+    if thumbnail is not None:
+        metadata["Thumbnail"] = f"<{len(thumbnail)} bytes>"
+    return metadata, signals, thumbnail
+
+
+def _trim_borders(gray, level=16):
+    # Camera thumbnails are often letterboxed to 4:3 or 16:9 with black bars
+    rows = np.flatnonzero(gray.mean(axis=1) > level)
+    cols = np.flatnonzero(gray.mean(axis=0) > level)
+    if len(rows) < 8 or len(cols) < 8:
+        return gray
+    return gray[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+
+def thumbnail_signals(thumbnail, image, cell=16, cell_limit=40.0, mean_limit=12.0):
+    """
+    Compare the embedded EXIF thumbnail with the decoded image (a PIL image).
+
+    A thumbnail whose shape or content does not match the image suggests
+    the image was edited by software that left the original preview in place.
+    """
+    try:
+        thumb = Image.open(io.BytesIO(thumbnail)).convert("L")
+        thumb = _trim_borders(np.asarray(thumb, dtype=np.float32))
+    except Exception:
+        return [{"signal": "thumbnail_mismatch", "detail": "Embedded thumbnail is not a readable JPEG"}]
+    height, width = thumb.shape
+    image_ratio = image.width / float(image.height)
+    thumb_ratio = width / float(height)
+
+    def close(ratio):
+        return abs(ratio - image_ratio) / image_ratio <= 0.1
+
+    if not close(thumb_ratio):
+        if close(1 / thumb_ratio):
+            return []  # thumbnail stored rotated; its shape fits but the pixels don't line up
+        return [{"signal": "thumbnail_mismatch",
+                 "detail": f"Thumbnail aspect ratio {thumb_ratio:.2f} differs from the image's {image_ratio:.2f}"}]
+    scaled = np.asarray(image.convert("L").resize((width, height), Image.Resampling.BILINEAR, reducing_gap=2.0),
+                        dtype=np.float32)
+    diff = np.abs(scaled - thumb)
+    worst = 0.0
+    for top in range(0, height - cell + 1, cell):
+        for left in range(0, width - cell + 1, cell):
+            worst = max(worst, float(diff[top:top + cell, left:left + cell].mean()))
+    if diff.mean() > mean_limit or worst > cell_limit:
+        return [{"signal": "thumbnail_mismatch",
+                 "detail": f"Thumbnail differs from the image (mean difference {diff.mean():.1f}, worst area {worst:.1f})"}]
+    return []
@@ -0,0 +1,196 @@
+"""
+In-process counters, histograms and per-request stage timers.
+
+The analysis pipeline only measures: analyze_bytes returns the seconds each
+stage took in results["timings"]. Whoever receives those results (the
+/analyze view, the job queue's done callback, the batch endpoint) records
+them here, so work done in a job worker process is still counted by the web
+process that serves /metrics. render() produces the Prometheus text format.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_registry = []
+
+# Seconds; spans sub-millisecond metadata reads up to full-resolution copy-move
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+    """
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = self._values or ({(): 0} if not self.labels else {})
+            for key, value in sorted(values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, or be read from a callback at scrape time.
+    """
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.callback is not None:
+            self.set(self.callback())
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram, optionally split by labels.
+    """
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                names = self.labels + ("le",)
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_label_text(names, key + (repr(bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(names, key + ('+Inf',))} {series[-2]}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {series[-2]}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {series[-1]:.6f}")
+        return lines
+
+
+def render():
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "analysis_stage_seconds", "Time spent in each analysis stage.", labels=("stage",))
+REQUESTS = Counter(
+    "analysis_requests_total", "Analysis requests by mode and outcome.", labels=("mode", "status"))
+DETECTOR_RUNS = Counter(
+    "analysis_detector_runs_total", "Detector runs by outcome (ok, error, timeout or cached).",
+    labels=("detector", "status"))
+QUEUE_REJECTED = Counter(
+    "analysis_queue_rejected_total", "Async analyses turned away because the job queue was full.")
+RATE_LIMITED = Counter(
+    "analysis_rate_limited_total", "Analyses refused by a client's token bucket, by bucket scope (user or ip).",
+    labels=("scope",))
+ANALYSES_SHED = Counter(
+    "analysis_shed_total", "Analyses shed because the wait for a slot stood above target (latency) or ran out (timeout).",
+    labels=("reason",))
+ANALYSES_ACTIVE = Gauge(
+    "analysis_slots_active", "Synchronous analyses and previews running in this process.", callback=lambda: 0)
+ANALYSES_WAITING = Gauge(
+    "analysis_slots_waiting", "Synchronous analyses and previews waiting for a slot in this process.", callback=lambda: 0)
+JOBS_PENDING = Gauge(
+    "analysis_jobs_pending", "Async analyses queued or running in this process.", callback=lambda: 0)
+ARTIFACT_GC_REMOVED = Counter(
+    "artifact_gc_removed_total", "Artifacts and stale scratch files deleted by the garbage collector.")
+ARTIFACT_STORE_BYTES = Gauge(
+    "artifact_store_bytes", "Size of the artifact store after the last garbage collection.")
+
+
+class StageTimer:
+    """
+    Collects how long each stage of one analysis took, in seconds.
+
+    A stage entered more than once accumulates. Safe to share with the
+    detector threads of the same analysis.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+def observe_results(results, mode):
+    """
+    Record the stage timings and detector outcomes carried by an analysis result.
+    """
+    for stage, seconds in (results.get("timings") or {}).items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    cached = set(results.get("cache_hits") or ())
+    for name, status in (results.get("method_status") or {}).items():
+        DETECTOR_RUNS.inc(detector=name, status="cached" if name in cached else status)
+    REQUESTS.inc(mode=mode, status="ok")
+
+
+def server_timing(timings):
+    """
+    Format {stage: seconds} as a Server-Timing header value.
+    """
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
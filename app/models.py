@@ -1,3 +1,4 @@
+from datetime import datetime
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
@@ -23,3 +24,61 @@ class User(UserMixin, db.Model):
         return bcrypt.check_password_hash(self.password_hash, password)
 
 
+
+class ImageFingerprint(db.Model):
+    """
+    Perceptual hashes of an analyzed image, keyed by the hash of its decoded pixels.
+
+    The 64-bit hashes are stored as signed BIGINTs (see fingerprint.py);
+    block_hashes packs one pHash per cell of a BLOCK_GRID x BLOCK_GRID grid
+    and flat_blocks flags the cells too flat for their pHash to mean anything.
+    """
+    __tablename__ = "image_fingerprint"
+
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False, unique=True)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    phash = db.Column(db.BigInteger, nullable=False)
+    dhash = db.Column(db.BigInteger, nullable=False)
+    block_hashes = db.Column(db.LargeBinary, nullable=False)
+    flat_blocks = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ImageFingerprint {self.digest[:16]}>'
+
+class Analysis(db.Model):
+    """
+    One finished analysis of an upload, as shown in the history views.
+
+    Rows are written in batches by history.HistoryRecorder, off the request
+    path. The scores are copied out of results so the history can be
+    filtered and sorted without loading the JSON.
+    """
+    __tablename__ = "analysis"
+    __table_args__ = (
+        # A user's history, newest first, is a range scan of this index
+        db.Index("ix_analysis_user_id_id", "user_id", "id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    image_hash = db.Column(db.String(64), index=True)  # decoded-pixel digest, as in the result cache
+    filename = db.Column(db.String(255))
+    mode = db.Column(db.String(16), nullable=False)  # "sync", "async", "progressive" or "batch"
+    methods = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(16), nullable=False)  # "ok", or "error" if any detector failed
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    seconds = db.Column(db.Float)
+    ela_score = db.Column(db.Float, index=True)
+    noise_score = db.Column(db.Float, index=True)
+    copy_move_regions = db.Column(db.Integer)
+    metadata_signals = db.Column(db.Integer)
+    near_duplicates = db.Column(db.Integer)
+    results = db.Column(db.JSON)
+
+    user = db.relationship("User", backref=db.backref("analyses", lazy="dynamic"))
+
+    def __repr__(self):
+        return f'<Analysis {self.id} {self.filename}>'
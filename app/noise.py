@@ -0,0 +1,230 @@
+"""
+Noise-residual analysis: where is the image noisier or smoother than the rest?
+
+A camera leaves noise of a consistent level all over a photo (for a given
+brightness); a region pasted from another photo, or airbrushed, blurred or
+denoised, usually doesn't match it. The residual of a second-order high-pass
+filter (it cancels flat and linearly shaded areas, leaving noise and edges)
+is clipped so edges don't dominate, and summed per 8x8 cell. Integral images
+of those cell sums give the residual variance of every sliding window in
+O(1), and each window's noise level is compared with windows of similar
+brightness elsewhere. Connected runs of outlying windows become ranked
+regions.
+
+Cell sums only need a one-pixel margin, so large images are processed tile
+by tile and the stitched cell grids are exactly the whole-image ones.
+"""
+import math
+
+import cv2
+import numpy as np
+
+from .tiling import iter_tiles
+
+CELL = 8
+WINDOW = 4  # cells per window side: 32x32 pixel windows, one per cell
+BRIGHTNESS_BINS = 8
+
+# A second-order difference in both directions; unit gain on white noise
+RESIDUAL_KERNEL = np.array([[-1, 2, -1],
+                            [2, -4, 2],
+                            [-1, 2, -1]], np.float32) / 6.0
+# Residuals past this many gray levels are edges or texture, not noise
+RESIDUAL_CLIP = 12.0
+
+REGION_Z = 3.0
+SCORE_CENTER = 3.0
+SCORE_SLOPE = 2.5
+
+
+def cell_sums(gray, color=None):
+    """
+    Per-cell (sum, sum of squares, mean brightness, clipped) grids for a
+    grayscale array whose sides are multiples of CELL plus a one-pixel margin
+    all round.
+
+    A cell is clipped if any of its pixels is at 0 or 255, in any channel of
+    color (same shape and margin as gray) when given: a saturated channel
+    flattens the luma noise too.
+    """
+    residual = cv2.filter2D(gray.astype(np.float32), -1, RESIDUAL_KERNEL)[1:-1, 1:-1]
+    np.clip(residual, -RESIDUAL_CLIP, RESIDUAL_CLIP, out=residual)
+    inner = gray[1:-1, 1:-1]
+    rows, cols = inner.shape[0] // CELL, inner.shape[1] // CELL
+    area = CELL * CELL
+
+    def per_cell(values):
+        # INTER_AREA with an integer factor is an exact box average
+        return cv2.resize(values, (cols, rows), interpolation=cv2.INTER_AREA) * area
+
+    first = per_cell(residual)
+    second = per_cell(residual * residual)
+    brightness = cv2.resize(inner.astype(np.float32), (cols, rows), interpolation=cv2.INTER_AREA)
+    if color is None:
+        unclipped = cv2.inRange(inner, 1, 254)
+    else:
+        unclipped = cv2.inRange(color[1:-1, 1:-1], (1, 1, 1), (254, 254, 254))
+    clipped = cv2.resize(unclipped, (cols, rows), interpolation=cv2.INTER_AREA) < 255
+    return first, second, brightness, clipped
+
+
+def _with_margin(gray):
+    # Reflect one pixel all round so the filter sees the image edge like cv2 does,
+    # and pad partial cells at the bottom/right
+    height, width = gray.shape[:2]
+    return cv2.copyMakeBorder(gray, 1, 1 + (-height % CELL), 1, 1 + (-width % CELL), cv2.BORDER_REFLECT_101)
+
+
+def window_sigma(first, second):
+    """
+    Residual standard deviation of the WINDOW x WINDOW cell window centered on every cell.
+    """
+    half = WINDOW // 2
+    padded = [cv2.copyMakeBorder(grid.astype(np.float64), half, half, half, half, cv2.BORDER_REFLECT)
+              for grid in (first, second)]
+    integral_first = cv2.integral(padded[0], sdepth=cv2.CV_64F)
+    integral_second = cv2.integral(padded[1], sdepth=cv2.CV_64F)
+    rows, cols = first.shape
+
+    def window_sum(integral):
+        # Sum over [y, y + WINDOW) x [x, x + WINDOW) for every cell at once
+        return (integral[WINDOW:WINDOW + rows, WINDOW:WINDOW + cols] - integral[:rows, WINDOW:WINDOW + cols]
+                - integral[WINDOW:WINDOW + rows, :cols] + integral[:rows, :cols])
+
+    count = float(WINDOW * WINDOW * CELL * CELL)
+    mean = window_sum(integral_first) / count
+    variance = window_sum(integral_second) / count - mean * mean
+    return np.sqrt(np.maximum(variance, 0)).astype(np.float32)
+
+
+def score_windows(sigma, brightness, clipped, mad_floor=0.05):
+    """
+    Signed robust z-score of each window's log noise level.
+
+    Windows are compared with the median of windows in the same brightness
+    bin (sensor noise grows with brightness) and scaled by the median
+    absolute deviation. Windows touching clipped pixels, which carry no
+    noise, score 0.
+    """
+    half = WINDOW // 2
+    # A window is unusable if any of its cells holds clipped pixels
+    excluded = cv2.dilate(clipped.astype(np.uint8), np.ones((WINDOW, WINDOW), np.uint8), anchor=(half, half)) > 0
+    usable = np.flatnonzero(~excluded.ravel())
+    z = np.zeros(sigma.size, np.float32)
+    if usable.size < BRIGHTNESS_BINS * 4:
+        return z.reshape(sigma.shape)
+    level = np.log(sigma.ravel() + 0.1)
+    smoothed = cv2.blur(brightness, (WINDOW, WINDOW)).ravel()
+    order = usable[np.argsort(smoothed[usable], kind="stable")]
+    residual = np.zeros(sigma.size, np.float32)
+    for members in np.array_split(order, BRIGHTNESS_BINS):
+        residual[members] = level[members] - np.median(level[members])
+    scale = max(1.4826 * float(np.median(np.abs(residual[usable]))), mad_floor)
+    z[usable] = residual[usable] / scale
+    return z.reshape(sigma.shape)
+
+
+def find_regions(z, sigma, threshold=REGION_Z, min_cells=4 * WINDOW * WINDOW, max_regions=8):
+    """
+    Group outlying windows into regions, strongest first.
+
+    Each region is {"box": [x, y, w, h] in pixels, "score": mean |z|,
+    "noise": median noise level inside, "direction": "high" (noisier than
+    the rest) or "low" (smoother), "area": fraction of the image}.
+    """
+    regions = []
+    for direction, mask in (("high", z >= threshold), ("low", z <= -threshold)):
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+        for label in range(1, count):
+            x, y, w, h, cells = stats[label]
+            if cells < min_cells:
+                continue
+            members = labels == label
+            regions.append({
+                "box": [int(x * CELL), int(y * CELL), int(w * CELL), int(h * CELL)],
+                "score": round(float(np.abs(z[members]).mean()), 2),
+                "noise": round(float(np.median(sigma[members])), 2),
+                "direction": direction,
+                "area": round(float(cells) / z.size, 4),
+            })
+    regions.sort(key=lambda region: region["score"] * math.sqrt(region["area"]), reverse=True)
+    return regions[:max_regions]
+
+
+def calibrated_score(regions):
+    """
+    Map the strongest region's z-score onto 0..1 (0.5 at REGION_Z).
+    """
+    if not regions:
+        return 0.0
+    strongest = max(region["score"] for region in regions)
+    return round(1.0 / (1.0 + math.exp(-SCORE_SLOPE * (strongest - SCORE_CENTER))), 3)
+
+
+def _finish(first, second, brightness, clipped):
+    sigma = window_sigma(first, second)
+    z = score_windows(sigma, brightness, clipped)
+    regions = find_regions(z, sigma)
+    usable = z != 0
+    return {
+        "sigma": sigma,
+        "z": z,
+        "regions": regions,
+        "score": calibrated_score(regions),
+        "noise_level": round(float(np.median(sigma[usable] if usable.any() else sigma)), 2),
+    }
+
+
+def detect_noise(gray, color=None):
+    """
+    Whole-image noise analysis of a grayscale array (and optionally the color
+    array it came from, for the clipping check).
+
+    Returns {"sigma", "z", "regions", "score", "noise_level"}: per-cell
+    window noise levels and z-scores, the ranked regions, a 0..1 score and
+    the image's median noise level in gray levels.
+    """
+    return _finish(*cell_sums(_with_margin(gray), None if color is None else _with_margin(color)))
+
+
+def detect_noise_tiled(pil_image, tile=1024):
+    """
+    detect_noise over full-resolution tiles; the results are identical.
+    """
+    width, height = pil_image.size
+    rows, cols = -(-height // CELL), -(-width // CELL)
+    first = np.zeros((rows, cols), np.float32)
+    second = np.zeros((rows, cols), np.float32)
+    brightness = np.zeros((rows, cols), np.float32)
+    clipped = np.zeros((rows, cols), bool)
+    tile = max(CELL, tile - tile % CELL)
+    for core, padded in iter_tiles(width, height, tile, overlap=1):
+        crop = pil_image.crop(padded)
+        gray, color = np.asarray(crop.convert("L")), np.asarray(crop.convert("RGB"))
+        # Inside the image the crop has a one-pixel margin of real neighbours;
+        # at the image edge, pad it the way _with_margin pads the whole image
+        top, left = 1 - (core[1] - padded[1]), 1 - (core[0] - padded[0])
+        bottom = 1 - (padded[3] - core[3]) + (-height % CELL if core[3] == height else 0)
+        right = 1 - (padded[2] - core[2]) + (-width % CELL if core[2] == width else 0)
+        if top or left or bottom or right:
+            gray, color = (cv2.copyMakeBorder(values, top, bottom, left, right, cv2.BORDER_REFLECT_101)
+                           for values in (gray, color))
+        sums = cell_sums(gray, color)
+        r0, c0 = core[1] // CELL, core[0] // CELL
+        r1, c1 = r0 + sums[0].shape[0], c0 + sums[0].shape[1]
+        for target, values in zip((first, second, brightness, clipped), sums):
+            target[r0:r1, c0:c1] = values
+    return _finish(first, second, brightness, clipped)
+
+
+def heatmap_values(result, width, height):
+    """
+    Noise level per cell as uint8 heatmap values, for a width x height image.
+
+    One value per CELL x CELL cell (the padded edge cells hang over the
+    image by less than a cell), stretched so the 99th percentile is the
+    hottest. Read with the "jet" colormap: blue is smooth, red noisy.
+    """
+    sigma = result["sigma"][:-(-height // CELL), :-(-width // CELL)]
+    top = max(float(np.percentile(sigma, 99)), 1e-3)
+    return cv2.convertScaleAbs(sigma, alpha=255.0 / top)
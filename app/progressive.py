@@ -0,0 +1,240 @@
+"""
+Progressive analysis: quick verdicts on a small proxy first, the full analysis after.
+
+POST /analyze?progressive=1 queues the full analysis as background jobs and,
+while they run, analyzes a proxy of the upload shrunk to PREVIEW_MAX_SIDE
+with the detectors registered as preview ones (ELA, noise, metadata). Those
+preview results are the response. Each expensive detector (copy-move, and
+JPEG analysis without jpegio) gets a stage of its own, so the full-size ELA
+and noise results are not held back by it. The stages are chained: each
+runs once the one before it is done, on the image that one decoded
+(analyze_stage), so the upload is decoded once. Clients follow the stages through a server-sent event stream or by polling,
+and every finished stage replaces the matching preview results.
+"""
+import json
+import os
+import time
+
+from .analysis import (
+    AnalysisError,
+    _execute,
+    analyze_bytes,
+    resize_image_dimensions,
+    resolve_settings,
+)
+from .detectors import plan, resolve
+from .metadata import extract_segments
+from .metrics import StageTimer
+from .storage import get_artifact_store, publish_artifacts, scratch_name
+from .utils import DecodedImage, open_image
+
+# Stage of the full analysis that runs everything but the expensive detectors
+FULL_STAGE = "full"
+
+
+def decode_preview(data, filename, max_side, name="preview"):
+    """
+    Decode upload bytes straight to a proxy whose long side is at most max_side.
+
+    JPEGs are decoded at a reduced DCT scale and HEIC/HEIF uploads may use an
+    embedded thumbnail, so large uploads are never decoded at full size.
+    """
+    # A stale HEIF thumbnail can only mislead the preview; the full stages use the primary image
+    img, exif = open_image(data, filename, max_side=max_side, heif_thumbnails=True)
+    if img is None:
+        raise AnalysisError("Could not process image file")
+    source_format = img.format
+    if source_format == "JPEG":
+        # draft() keeps both sides at least this large, so give it the target shape
+        ratio = max_side / float(max(img.size))
+        if ratio < 1:
+            img.draft("RGB", (int(img.width * ratio), int(img.height * ratio)))
+    img.load()
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img = resize_image_dimensions(img, max_side)
+    return DecodedImage(img, exif=exif, name=name, source_format=source_format,
+                        segments=extract_segments(data), source=data)
+
+
+def preview_analysis(data, filename, selected_methods, output_folder, settings=None,
+                     max_side=640, timeout=None, upload_digest=None, storage_settings=None,
+                     load=0.0, shed_load=None):
+    """
+    Run the selected preview detectors on a small proxy of the upload.
+
+    The proxy takes milliseconds per detector, so they run one after another
+    in the calling thread rather than waiting for threads of their own.
+    Detectors still running after timeout seconds are reported as "timeout"
+    rather than delaying the preview. results["preview"] describes the proxy;
+    artifacts are named after upload_digest (see storage.scratch_name) with
+    a "_preview" suffix so the full-size ones never overwrite them, and go to
+    the artifact store like analyze_bytes' when storage_settings is given.
+    Under load, detectors are shed from the preview like from the full analysis.
+    """
+    started = time.perf_counter()
+    timer = StageTimer()
+    # The proxy is small enough to analyze whole; tiling would only add overhead
+    settings = resolve_settings(settings)
+    settings["tiled"] = False
+    detectors = [detector for detector in resolve(selected_methods) if detector.preview]
+    methods = [detector.name for detector in detectors]
+    name = scratch_name((upload_digest or "upload")[:16]) + "_preview"
+    with timer.stage("decode"):
+        image = decode_preview(data, filename, max_side, name=name)
+    per_method, status = _execute(
+        image, plan(detectors, settings, load, shed_load), output_folder, settings, "inline", 1, timeout, timer)
+    store = get_artifact_store(storage_settings)
+    if store is not None:
+        with timer.stage("store"):
+            for method in methods:
+                publish_artifacts(per_method[method], output_folder, store)
+
+    results = {}
+    for method in methods:
+        results.update(per_method[method])
+    results["method_status"] = {method: status[method] for method in methods}
+    results["preview"] = {"max_side": max_side, "size": list(image.size)}
+    timer.add("total", time.perf_counter() - started)
+    results["timings"] = {stage: round(seconds, 6) for stage, seconds in timer.timings.items()}
+    return results
+
+
+def analyze_stage(path, filename, selected_methods, output_folder, settings=None, handoff=None, final=False,
+                  **options):
+    """
+    analyze_bytes for one stage of a chained progressive analysis. Returns (results, handoff).
+
+    The upload is read from path, a scratch file written once for all the
+    stages, and final marks the last stage, which removes it. handoff (see
+    JobQueue.submit_group) carries no pixels between job processes: the
+    stage that decodes the upload parks the image next to path (see
+    DecodedImage.park) and hands on its digests and where to find it. A
+    tiled analysis hands on only its digests, since its full-resolution
+    image costs more to write out than to decode again.
+    """
+    with open(path, "rb") as fh:
+        data = fh.read()
+    parked = (handoff or {}).get("parked")
+    current = {}
+    if parked is not None:
+        current.update(image=DecodedImage.from_parked(parked, source=data), digests=handoff["digests"])
+    try:
+        results = analyze_bytes(data, filename, selected_methods, output_folder, settings, handoff=current, **options)
+    finally:
+        if final:
+            for scratch in (path, path + ".npy"):
+                try:
+                    os.remove(scratch)
+                except FileNotFoundError:
+                    pass
+    if final or "digests" not in current:
+        return results, None
+    if parked is None and not resolve_settings(settings)["tiled"]:
+        parked = current["image"].park(path + ".npy")
+    return results, {"digests": current["digests"], "parked": parked}
+
+
+def plan_stages(selected_methods):
+    """
+    Split the selected detectors into {stage: [detector name, ...]} for the full analysis.
+
+    Expensive detectors each get a stage named after them, after the
+    FULL_STAGE that runs all the others; stages are in the order they usually finish.
+    """
+    stages = {}
+    for detector in resolve(selected_methods):
+        stage = detector.name if detector.cost == "expensive" else FULL_STAGE
+        stages.setdefault(stage, []).append(detector.name)
+    if FULL_STAGE in stages:
+        stages = dict({FULL_STAGE: stages.pop(FULL_STAGE)}, **stages)
+    return stages
+
+
+def merge_results(preview, stage_results):
+    """
+    Combine preview results with the results of finished stages.
+
+    Stages override the preview for the detectors they ran; method_status is
+    merged and "timings" becomes {stage: timings} per source.
+    """
+    merged = {}
+    method_status = {}
+    timings = {}
+    cache_hits = []
+    for stage, results in ([("preview", preview)] if preview else []) + list(stage_results.items()):
+        for key, value in results.items():
+            if key == "method_status":
+                method_status.update(value)
+            elif key == "timings":
+                timings[stage] = value
+            elif key == "cache_hits":
+                cache_hits.extend(value)
+            elif key != "preview":
+                merged[key] = value
+    merged["method_status"] = method_status
+    merged["cache_hits"] = cache_hits
+    merged["timings"] = timings
+    return merged
+
+
+def group_progress(stages):
+    """
+    Summarize {stage: job snapshot} as {"status", "stages", "results", "errors"}.
+
+    The group is "done" once every stage has ended, even if some failed.
+    """
+    finished = {stage: job["result"] for stage, job in stages.items() if job and job["status"] == "done"}
+    errors = {stage: job["error"] for stage, job in stages.items() if job and job["status"] == "failed"}
+    states = {stage: job["status"] if job else "expired" for stage, job in stages.items()}
+    pending = [stage for stage, state in states.items() if state in ("queued", "running")]
+    return {
+        "status": "running" if pending else "done",
+        "stages": states,
+        "results": merge_results(None, finished),
+        "errors": errors,
+    }
+
+
+def sse_event(event, payload):
+    """
+    Format one server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+def stream_progress(queue, group_id, keepalive=15.0, max_seconds=600.0):
+    """
+    Yield server-sent events for a job group until every stage has ended.
+
+    One "stage" event carries each stage's results (or its error) as it
+    finishes, then a final "done" event follows. Comment lines keep idle
+    connections open through proxies.
+    """
+    sent = set()
+    deadline = time.monotonic() + max_seconds
+    while True:
+        seen = queue.changes()
+        stages = queue.get_group(group_id)
+        if stages is None:
+            yield sse_event("error", {"error": "Unknown or expired analysis"})
+            return
+        for stage, job in stages.items():
+            if stage in sent or (job is not None and job["status"] in ("queued", "running")):
+                continue
+            sent.add(stage)
+            if job is None:
+                payload = {"stage": stage, "status": "expired", "error": "Result expired"}
+            elif job["status"] == "done":
+                payload = {"stage": stage, "status": "done", "results": job["result"]}
+            else:
+                payload = {"stage": stage, "status": job["status"], "error": job["error"]}
+            yield sse_event("stage", payload)
+        if len(sent) == len(stages):
+            yield sse_event("done", {"stages": sorted(sent)})
+            return
+        if time.monotonic() > deadline:
+            yield sse_event("error", {"error": "Timed out waiting for the analysis"})
+            return
+        if not queue.wait_for_change(seen, keepalive):
+            yield ": keepalive\n\n"
@@ -0,0 +1,411 @@
+"""
+Admission control for the analysis endpoints: rate limits and load shedding.
+
+Every client has a token bucket per user (when logged in) and per IP
+address. An analysis costs tokens for its upload bytes and for each
+selected detector, by cost class, so one client can't monopolize the
+workers with many large uploads. The declared Content-Length is checked
+before the body is read, and the full cost is charged once the methods are
+known. A request must fit in every bucket it draws on, and a cost larger
+than a bucket's burst needs a full bucket. Buckets live in this process
+("memory") or in Redis or any server speaking its protocol ("redis"), which
+shares them across workers and hosts.
+
+AdmissionController caps the analyses running at once in a process. When
+the wait for a slot stays above its target for a whole interval, the queue
+is standing rather than absorbing a burst. New analyses are then shed with
+a Retry-After instead of joining it, as in CoDel.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .metrics import ANALYSES_ACTIVE, ANALYSES_WAITING, STAGE_SECONDS
+
+# Tokens charged per selected detector, by cost class (see detectors.COSTS)
+METHOD_TOKENS = {"cheap": 0.5, "moderate": 1.0, "expensive": 4.0}
+
+# Clients whose usage is kept for the admin panel, most recently active first
+MAX_TRACKED = 1000
+
+_init_lock = threading.Lock()
+
+# Check (and take) cost from every bucket in KEYS, or from none of them.
+# ARGV: now, cost, consume flag, then rate and burst for each key.
+# Returns {allowed, seconds until allowed, tokens left in the emptiest bucket}.
+# Numbers are written with 17 digits: tostring keeps 14, and the rounding
+# would make the buckets drift from MemoryBuckets'.
+_TAKE_SCRIPT = """
+local function num(x)
+  return string.format('%.17g', x)
+end
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local levels = {}
+local wait = 0
+local left = nil
+for i = 1, #KEYS do
+  local rate = tonumber(ARGV[2 + 2 * i])
+  local burst = tonumber(ARGV[3 + 2 * i])
+  local state = redis.call('HMGET', KEYS[i], 'tokens', 'updated')
+  local tokens = tonumber(state[1]) or burst
+  local updated = tonumber(state[2]) or now
+  tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+  levels[i] = tokens
+  local need = math.min(cost, burst)
+  if tokens < need then
+    wait = math.max(wait, (need - tokens) / rate)
+  end
+  if left == nil or tokens - need < left then
+    left = tokens - need
+  end
+end
+if wait > 0 then
+  return {0, num(wait), num(left)}
+end
+if ARGV[3] == '1' then
+  for i = 1, #KEYS do
+    local rate = tonumber(ARGV[2 + 2 * i])
+    local burst = tonumber(ARGV[3 + 2 * i])
+    redis.call('HSET', KEYS[i], 'tokens', num(levels[i] - math.min(cost, burst)), 'updated', num(now))
+    redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+  end
+end
+return {1, '0', num(left)}
+"""
+
+
+class RateLimited(Exception):
+    """
+    Raised when a client's bucket can't cover a request; scope is the bucket that ran dry.
+    """
+
+    def __init__(self, scope, retry_after=1):
+        super().__init__(f"Rate limit exceeded ({scope})")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """
+    Raised when an analysis is shed because the wait for a slot is too long.
+    """
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__("Server busy")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class MemoryBuckets:
+    """
+    Token buckets kept in this process; full buckets are forgotten.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+
+    def take(self, limits, cost, now, consume=True):
+        """
+        Check cost against {key: (rate, burst)} and, if every bucket covers
+        it and consume is set, take it. Returns (allowed, wait, left).
+        """
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(limits, now)
+            levels = {}
+            wait = 0.0
+            left = None
+            for key, (rate, burst) in limits.items():
+                tokens, updated = self._buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                levels[key] = tokens
+                need = min(cost, burst)
+                if tokens < need:
+                    wait = max(wait, (need - tokens) / rate)
+                left = tokens - need if left is None else min(left, tokens - need)
+            if wait > 0:
+                return False, wait, left
+            if consume:
+                for key, (rate, burst) in limits.items():
+                    self._buckets[key] = [levels[key] - min(cost, burst), now]
+            return True, 0.0, left
+
+    def level(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+        return min(burst, tokens + max(0.0, now - updated) * rate)
+
+    def _prune(self, limits, now):
+        # Called with the lock held. A bucket that has refilled is the same as no bucket.
+        slowest = min((rate / burst for rate, burst in limits.values()), default=1.0)
+        horizon = 1.0 / slowest if slowest > 0 else 3600.0
+        for key in [key for key, (_, updated) in self._buckets.items() if now - updated > horizon]:
+            del self._buckets[key]
+        self._next_prune = now + 60.0
+
+
+class RedisBuckets:
+    """
+    Token buckets in Redis or any server speaking its protocol, updated atomically by a Lua script.
+    """
+
+    def __init__(self, url=None, client=None, prefix="rate-limit:"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, limits, cost, now, consume=True):
+        keys = [self.prefix + key for key in limits]
+        args = [repr(now), repr(float(cost)), "1" if consume else "0"]
+        for rate, burst in limits.values():
+            args.extend((repr(float(rate)), repr(float(burst))))
+        allowed, wait, left = self._take(keys=keys, args=args)
+        return bool(int(allowed)), float(wait), float(left)
+
+    def level(self, key, rate, burst, now):
+        tokens, updated = self.client.hmget(self.prefix + key, "tokens", "updated")
+        if tokens is None or updated is None:
+            return burst
+        return min(burst, float(tokens) + max(0.0, now - float(updated)) * rate)
+
+
+def make_buckets(backend, redis_url=None):
+    """
+    Build the bucket store: "memory" or "redis".
+    """
+    if backend == "memory":
+        return MemoryBuckets()
+    if backend == "redis":
+        return RedisBuckets(redis_url)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+class RateLimiter:
+    """
+    Per-user and per-IP token buckets charged by upload bytes and selected detectors.
+
+    limits maps a scope ("user", "ip") to its (rate in tokens per second,
+    burst). usage() reports what this process has seen of each client.
+    """
+
+    def __init__(self, buckets, limits, bytes_per_token=1024 * 1024):
+        self.buckets = buckets
+        self.limits = dict(limits)
+        self.bytes_per_token = bytes_per_token
+        self._usage = OrderedDict()  # client key -> counters
+        self._lock = threading.Lock()
+
+    def cost(self, nbytes, detectors=(), count=1):
+        """
+        Tokens for nbytes of uploads plus count runs of each of detectors.
+        """
+        return nbytes / float(self.bytes_per_token) + count * sum(METHOD_TOKENS[d.cost] for d in detectors)
+
+    def check(self, clients, cost):
+        """
+        Raise RateLimited unless every client's bucket could cover cost now; nothing is taken.
+        """
+        self._take(clients, cost, consume=False)
+
+    def take(self, clients, cost, nbytes=0):
+        """
+        Take cost from every client's bucket, or raise RateLimited and take nothing.
+
+        clients maps a scope to its key, e.g. {"user": "user:3", "ip": "ip:10.0.0.1"}.
+        """
+        self._take(clients, cost, consume=True, nbytes=nbytes)
+
+    def _take(self, clients, cost, consume, nbytes=0):
+        now = time.time()
+        limits = {key: self.limits[scope] for scope, key in clients.items()}
+        allowed, wait, _ = self.buckets.take(limits, cost, now, consume)
+        scope = None
+        if not allowed:
+            # Name the bucket that is furthest from covering the cost
+            scope = max(clients, key=lambda scope: self._shortfall(clients[scope], self.limits[scope], cost, now))
+        self._record(clients, cost if consume and allowed else 0.0, nbytes if allowed else 0, scope is not None)
+        if scope is not None:
+            raise RateLimited(scope, retry_after=max(1, math.ceil(wait)))
+
+    def _shortfall(self, key, limit, cost, now):
+        rate, burst = limit
+        return (min(cost, burst) - self.buckets.level(key, rate, burst, now)) / rate
+
+    def _record(self, clients, tokens, nbytes, throttled):
+        with self._lock:
+            for scope, key in clients.items():
+                usage = self._usage.pop(key, None) or {
+                    "scope": scope, "requests": 0, "throttled": 0, "tokens": 0.0, "bytes": 0, "last_seen": None}
+                if throttled:
+                    usage["throttled"] += 1
+                elif tokens:
+                    usage["requests"] += 1
+                    usage["tokens"] += tokens
+                    usage["bytes"] += nbytes
+                usage["last_seen"] = time.time()
+                self._usage[key] = usage
+            while len(self._usage) > MAX_TRACKED:
+                self._usage.popitem(last=False)
+
+    def usage(self, limit=50):
+        """
+        The most recently active clients, each with its counters and current bucket level.
+        """
+        with self._lock:
+            recent = list(self._usage.items())[::-1][:limit]
+        now = time.time()
+        rows = []
+        for key, usage in recent:
+            rate, burst = self.limits[usage["scope"]]
+            try:
+                level = round(self.buckets.level(key, rate, burst, now), 1)
+            except Exception:
+                level = None
+            rows.append(dict(usage, key=key, tokens=round(usage["tokens"], 1), level=level, burst=burst))
+        return rows
+
+
+class AdmissionController:
+    """
+    Caps concurrent analyses in this process and sheds new ones once the queue for a slot stands.
+
+    The shortest wait seen over each interval is compared with target: a
+    burst drains within the interval, so some request gets a slot quickly,
+    but if even the quickest waited longer than target, arrivals are shed
+    with Overloaded until a request again gets through fast. A request that
+    waits max_wait without a slot is shed as well.
+    """
+
+    def __init__(self, limit, target=0.5, interval=2.0, max_wait=30.0):
+        self.limit = limit
+        self.target = target
+        self.interval = interval
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.overloaded = False
+        self.last_wait = 0.0
+        self._service = None  # moving average of slot hold times, seconds
+        self._window_start = time.monotonic()
+        self._window_min = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one analysis slot for the with block, or raise Overloaded.
+        """
+        started = time.monotonic()
+        with self._cond:
+            self._roll_window(started)
+            if self.overloaded and self.active >= self.limit:
+                raise Overloaded("latency", self._retry_after())
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = started + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        raise Overloaded("timeout", self._retry_after())
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            admitted = time.monotonic()
+            self._observe(admitted - started)
+        STAGE_SECONDS.observe(admitted - started, stage="admission")
+        try:
+            yield
+        finally:
+            held = time.monotonic() - admitted
+            with self._cond:
+                self.active -= 1
+                self._service = held if self._service is None else 0.8 * self._service + 0.2 * held
+                self._cond.notify()
+
+    def _observe(self, wait):
+        self.last_wait = wait
+        self._window_min = wait if self._window_min is None else min(self._window_min, wait)
+        if wait <= self.target:
+            self.overloaded = False
+
+    def _roll_window(self, now):
+        if now - self._window_start < self.interval:
+            return
+        # No admissions for a whole interval means nothing could be measured, so assume no queue
+        self.overloaded = self._window_min is not None and self._window_min > self.target
+        self._window_min = None
+        self._window_start = now
+
+    def _retry_after(self):
+        # Time for the queue ahead (and this request) to drain through the slots
+        per_slot = (self.waiting + 1) / float(max(1, self.limit))
+        return max(1, math.ceil(per_slot * (self._service or self.target)))
+
+    def state(self):
+        """
+        Slots, queue and shedding state, for the admin panel.
+        """
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "waiting": self.waiting,
+                "overloaded": self.overloaded,
+                "target": self.target,
+                "last_wait": round(self.last_wait, 3),
+                "service": None if self._service is None else round(self._service, 3),
+            }
+
+
+def get_rate_limiter(app):
+    """
+    Return the app's RateLimiter, or None when RATE_LIMIT_ENABLED is off.
+    """
+    if not app.config["RATE_LIMIT_ENABLED"]:
+        return None
+    limiter = app.extensions.get("rate_limiter")
+    if limiter is not None:
+        return limiter
+    with _init_lock:
+        limiter = app.extensions.get("rate_limiter")
+        if limiter is None:
+            limiter = RateLimiter(
+                make_buckets(app.config["RATE_LIMIT_BACKEND"], app.config["RATE_LIMIT_REDIS_URL"]),
+                {
+                    "user": (app.config["RATE_LIMIT_USER_RATE"], app.config["RATE_LIMIT_USER_BURST"]),
+                    "ip": (app.config["RATE_LIMIT_IP_RATE"], app.config["RATE_LIMIT_IP_BURST"]),
+                },
+                bytes_per_token=app.config["RATE_LIMIT_BYTES_PER_TOKEN"],
+            )
+            app.extensions["rate_limiter"] = limiter
+    return limiter
+
+
+def get_admission(app):
+    """
+    Return the app's AdmissionController, created in each worker on first use.
+    """
+    controller = app.extensions.get("admission")
+    if controller is not None:
+        return controller
+    with _init_lock:
+        controller = app.extensions.get("admission")
+        if controller is None:
+            controller = AdmissionController(
+                app.config["ANALYSIS_CAPACITY"],
+                target=app.config["ANALYSIS_QUEUE_TARGET"],
+                interval=app.config["ANALYSIS_QUEUE_INTERVAL"],
+                max_wait=app.config["ANALYSIS_QUEUE_TIMEOUT"],
+            )
+            ANALYSES_ACTIVE.callback = lambda: controller.active
+            ANALYSES_WAITING.callback = lambda: controller.waiting
+            app.extensions["admission"] = controller
+    return controller
@@ -1,30 +1,61 @@
-from flask import Blueprint, render_template, session, flash, redirect, url_for
+from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, jsonify, abort
 from flask_login import login_required, current_user
+import logging
+from . import db
+from .history import analysis_summary, history_page
+from .models import Analysis
 
 main_bp = Blueprint('main', __name__)
+logger = logging.getLogger(__name__)
 
 @main_bp.route('/', methods=["GET"])
 def index():
     if not current_user.is_authenticated:
         return render_template("home.html")
 
-    print("현재 로그인 사용자:", current_user.username)
-    return render_template(
-        "base.html",
-        user=current_user,
-        original_img=session.get("original_filename"),
-        processed_imgs=session.get("processed_filenames", [])
-    )
+    logger.debug("현재 로그인 사용자: %s", current_user.username)
+    return render_template("base.html", user=current_user)
 
 
 @main_bp.route('/home', methods=["GET"])
 def home():
     return render_template("home.html")
 
+@main_bp.route('/history', methods=["GET"])
+@login_required
+def history():
+    """
+    The current user's analyses, newest first, a page at a time (?before=<id> for older ones).
+
+    ?format=json returns the page as JSON.
+    """
+    analyses, next_before = history_page(
+        Analysis.query.filter_by(user_id=current_user.id),
+        request.args.get("before", type=int),
+        current_app.config["HISTORY_PAGE_SIZE"],
+    )
+    if request.args.get("format") == "json":
+        return jsonify({"analyses": [analysis_summary(a) for a in analyses], "next_before": next_before})
+    return render_template("history.html", analyses=analyses, next_before=next_before)
+
+@main_bp.route('/history/<int:analysis_id>', methods=["GET"])
+@login_required
+def history_detail(analysis_id):
+    """
+    One past analysis with its full results, for its owner or an admin.
+    """
+    analysis = Analysis.query.get_or_404(analysis_id)
+    if analysis.user_id != current_user.id and current_user.role != "admin":
+        abort(404)
+    return jsonify({"analysis": analysis_summary(analysis), "results": analysis.results})
+
 @main_bp.route('/clear', methods=["POST"])
 @login_required
 def clear_session():
-    session.pop('original_filename', None)
-    session.pop('processed_filenames', None)
-    flash("Images cleared.")
-    return redirect(url_for('main.base'))
+    """
+    Delete the current user's analysis history.
+    """
+    Analysis.query.filter_by(user_id=current_user.id).delete()
+    db.session.commit()
+    flash("History cleared.")
+    return redirect(url_for('main.history'))
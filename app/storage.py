@@ -0,0 +1,350 @@
+"""
+Artifact storage: content-addressed heatmaps with background garbage collection.
+
+Detectors render their heatmaps (and pyramid tiles, see artifacts.py) into a
+scratch folder; publish_artifacts then moves each file into an artifact
+store under a key derived from its content hash ("<32 hex digits>.webp"),
+so identical heatmaps are stored once and a key never changes meaning. That makes the files safe to cache forever downstream:
+/uploads/<key> serves them with a strong ETag and a long Cache-Control.
+
+Backends share a small interface (put_file/get/exists/delete/entries):
+LocalStore shards keys over two directory levels (ab/cd/abcd...png) so no
+directory gets large, and S3Store talks to any S3-compatible API (MinIO,
+Ceph, a local stub via endpoint_url). A collector thread in each web
+process expires artifacts past their TTL and trims the store back under
+its size quota, oldest first.
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from .metrics import ARTIFACT_GC_REMOVED, ARTIFACT_STORE_BYTES
+
+logger = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]{1,5}$")
+
+CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "json": "application/json"}
+
+_store = None
+_store_settings = None
+_store_lock = threading.Lock()
+
+_collector = None
+
+
+def is_valid_key(key):
+    return bool(KEY_RE.match(key))
+
+
+def content_type(key):
+    return CONTENT_TYPES.get(key.rsplit(".", 1)[-1], "application/octet-stream")
+
+
+def file_key(path):
+    """
+    Content-addressed key for a file: a truncated SHA-256 plus its extension.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    ext = os.path.splitext(path)[1].lstrip(".").lower() or "bin"
+    return f"{digest.hexdigest()[:32]}.{ext}"
+
+
+class LocalStore:
+    """
+    Artifacts on the local filesystem, sharded as root/ab/cd/<key>.
+
+    File mtimes are the artifacts' ages; storing content that is already
+    present just refreshes its mtime.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put_file(self, path):
+        """
+        Move the file at path into the store and return its key.
+        """
+        key = file_key(path)
+        dest = self.path(key)
+        if os.path.exists(dest):
+            os.utime(dest)
+            os.remove(path)
+            return key
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.move(path, dest)
+        return key
+
+    def local_path(self, key):
+        """
+        Path of a stored artifact that can be served directly, or None if missing.
+        """
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """
+        Yield (key, mtime, size) for every stored artifact.
+        """
+        for shard in _shards(self.root):
+            for subshard in _shards(os.path.join(self.root, shard)):
+                directory = os.path.join(self.root, shard, subshard)
+                for key in _listdir(directory):
+                    if not is_valid_key(key):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(directory, key))
+                    except FileNotFoundError:
+                        continue
+                    yield key, stat.st_mtime, stat.st_size
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _shards(path):
+    return [name for name in _listdir(path) if len(name) == 2 and os.path.isdir(os.path.join(path, name))]
+
+
+class S3Store:
+    """
+    Artifacts in an S3-compatible bucket under prefix.
+
+    Objects are re-uploaded when the same content is stored again, which
+    refreshes LastModified, the age the collector goes by.
+    """
+
+    def __init__(self, bucket, prefix="artifacts/", endpoint_url=None, region=None, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put_file(self, path):
+        key = file_key(path)
+        with open(path, "rb") as fh:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.prefix + key, Body=fh, ContentType=content_type(key))
+        os.remove(path)
+        return key
+
+    def local_path(self, key):
+        return None
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if _is_missing(e):
+                return None
+            raise
+        return response["Body"].read()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if _is_missing(e):
+                return False
+            raise
+        return True
+
+    def delete(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):  # DeleteObjects takes at most 1000 keys
+            objects = [{"Key": self.prefix + key} for key in keys[start:start + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+
+    def entries(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", ()):
+                key = item["Key"][len(self.prefix):]
+                if is_valid_key(key):
+                    yield key, item["LastModified"].timestamp(), item["Size"]
+
+
+def _is_missing(error):
+    # botocore reports a missing object as a ClientError carrying the HTTP status
+    code = str(getattr(error, "response", {}).get("Error", {}).get("Code", ""))
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+def make_store(settings):
+    """
+    Build a store from a settings dict (see the ARTIFACT_* config keys).
+    """
+    backend = settings["backend"]
+    if backend == "local":
+        return LocalStore(settings["directory"])
+    if backend == "s3":
+        return S3Store(settings["bucket"], settings["prefix"], settings["endpoint_url"], settings["region"])
+    raise ValueError(f"Unknown artifact storage backend: {backend}")
+
+
+def get_artifact_store(settings):
+    """
+    Return this process's artifact store for settings, or None when settings is empty.
+    """
+    global _store, _store_settings
+    if not settings:
+        return None
+    with _store_lock:
+        if _store is None or _store_settings != settings:
+            _store = make_store(settings)
+            _store_settings = dict(settings)
+    return _store
+
+
+def _artifact_slots(results):
+    # (container, index) of every artifact reference: "*_image" fields and the tiles of "*_pyramid" fields
+    for field, value in results.items():
+        if not value:
+            continue
+        if field.endswith("_image"):
+            yield results, field
+        elif field.endswith("_pyramid"):
+            for level in value["levels"]:
+                for row in level["tiles"]:
+                    for col in range(len(row)):
+                        yield row, col
+
+
+def artifact_names(results):
+    """
+    Every artifact a detector's results reference, heatmaps and pyramid tiles alike.
+    """
+    return [container[index] for container, index in _artifact_slots(results)]
+
+
+def scratch_name(prefix):
+    """
+    Name for one request's renders in the scratch folder: prefix plus a random suffix.
+
+    Concurrent requests for the same image then never write, move or hash
+    each other's files; publish_artifacts dedupes the results by content.
+    """
+    return f"{prefix}_{uuid.uuid4().hex[:8]}"
+
+
+def publish_artifacts(results, scratch_folder, store):
+    """
+    Move the files a detector's results reference into store, in place.
+
+    Each reference (see artifact_names) changes from a filename in
+    scratch_folder to the artifact's key. A file that is missing is left as is.
+    """
+    for container, index in list(_artifact_slots(results)):
+        path = os.path.join(scratch_folder, container[index])
+        if os.path.exists(path):
+            container[index] = store.put_file(path)
+    return results
+
+
+def collect_garbage(store, max_age, max_bytes, scratch_dirs=()):
+    """
+    Delete artifacts older than max_age seconds, then the oldest ones until
+    the store is back under 90% of max_bytes. Files left in scratch_dirs
+    (renders from crashed requests, artifacts from before the store existed)
+    are deleted once older than max_age.
+
+    Returns {"removed", "freed_bytes", "remaining_bytes"}.
+    """
+    entries = sorted(store.entries(), key=lambda entry: entry[1])
+    total = sum(size for _, _, size in entries)
+    cutoff = time.time() - max_age
+    target = max_bytes * 0.9 if max_bytes and total > max_bytes else float("inf")
+    doomed = []
+    freed = 0
+    for key, mtime, size in entries:
+        if mtime >= cutoff and total - freed <= target:
+            break
+        doomed.append(key)
+        freed += size
+    store.delete(doomed)
+    remaining = total - freed
+
+    removed = len(doomed)
+    for directory in scratch_dirs:
+        for name in _listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if os.path.isfile(path) and stat.st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+                    freed += stat.st_size
+            except FileNotFoundError:
+                continue
+
+    ARTIFACT_GC_REMOVED.inc(removed)
+    ARTIFACT_STORE_BYTES.set(remaining)
+    return {"removed": removed, "freed_bytes": freed, "remaining_bytes": remaining}
+
+
+def _collect_forever(settings, interval, max_age, max_bytes, scratch_dirs):
+    while True:
+        try:
+            stats = collect_garbage(get_artifact_store(settings), max_age, max_bytes, scratch_dirs)
+            if stats["removed"]:
+                logger.info("Artifact GC: %s", stats)
+        except Exception:
+            logger.exception("Artifact GC failed")
+        time.sleep(interval)
+
+
+def start_collector(settings, interval, max_age, max_bytes, scratch_dirs=()):
+    """
+    Start the garbage collector thread for this process, once.
+
+    Every web worker runs one; concurrent deletes of the same artifact are
+    harmless, and the store stays in bounds if some workers are idle.
+    """
+    global _collector
+    if not settings or interval <= 0:
+        return
+    with _store_lock:
+        if _collector is not None and _collector.is_alive():
+            return
+        _collector = threading.Thread(
+            target=_collect_forever,
+            args=(dict(settings), interval, max_age, max_bytes, tuple(scratch_dirs)),
+            name="artifact-gc",
+            daemon=True,
+        )
+        _collector.start()
@@ -0,0 +1,71 @@
+"""
+Tiles and heatmap stitching for full-resolution ELA and noise analysis.
+
+Each tile is processed with a margin of overlap so its core is computed
+exactly as it would be on the whole image, and per-tile results are stitched
+into a heatmap canvas (or per-block grids) that is downsampled to at most
+max_side pixels. Working memory is bounded by the tile size and the canvas,
+not by the image.
+"""
+import numpy as np
+import cv2
+
+from .deadlines import check
+
+# JPEG works on 8x8 blocks, 16x16 macroblocks with 4:2:0 chroma subsampling.
+# Tiles start on this grid so re-encoding a tile reproduces the block layout
+# of re-encoding the whole image.
+JPEG_ALIGN = 16
+
+
+def iter_tiles(width, height, tile=1024, overlap=0, align=1):
+    """
+    Yield (core, padded) boxes as (left, top, right, bottom) tuples.
+
+    Cores partition the image; padded boxes extend each core by overlap
+    pixels (clamped to the image) with their origin snapped down to a
+    multiple of align. The running detector's deadline is checked before
+    each tile.
+    """
+    tile = max(align, tile - tile % align)
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            core = (left, top, min(width, left + tile), min(height, top + tile))
+            pad_left = max(0, left - overlap)
+            pad_top = max(0, top - overlap)
+            pad_left -= pad_left % align
+            pad_top -= pad_top % align
+            padded = (
+                pad_left,
+                pad_top,
+                min(width, core[2] + overlap),
+                min(height, core[3] + overlap),
+            )
+            check()
+            yield core, padded
+
+
+class HeatmapCanvas:
+    """
+    Downsampled canvas that tile results are pasted into.
+    """
+
+    def __init__(self, width, height, max_side=2048, channels=1):
+        self.scale = min(1.0, float(max_side) / max(width, height)) if max_side else 1.0
+        self.width = width
+        self.height = height
+        shape = (max(1, round(height * self.scale)), max(1, round(width * self.scale)))
+        if channels > 1:
+            shape += (channels,)
+        self.pixels = np.zeros(shape, np.uint8)
+
+    def paste(self, core, values):
+        left, top, right, bottom = core
+        x0, y0 = round(left * self.scale), round(top * self.scale)
+        x1, y1 = round(right * self.scale), round(bottom * self.scale)
+        if x1 <= x0 or y1 <= y0:
+            return
+        if (x1 - x0, y1 - y0) != (values.shape[1], values.shape[0]):
+            values = cv2.resize(values, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+        self.pixels[y0:y1, x0:x1] = values
+
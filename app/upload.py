@@ -1,66 +1,181 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, request, jsonify, current_app, send_file, send_from_directory, url_for, Response, stream_with_context
+from flask_login import current_user
 from werkzeug.utils import secure_filename
-import os, traceback
-import io
-from PIL import Image, ImageOps
-from .utils import (
-    allowed_file,
-    convert_heic_to_jpeg,
-    ela_analysis,
-    noise_analysis,
-    copy_move_detection,
-    metadata_analysis,
-)
+import functools, gzip, importlib, io, logging, os, time
+from .jobs import QueueFull, get_job_queue
+from .ratelimit import Overloaded, RateLimited, get_admission, get_rate_limiter
+from .intake import ImageTooLarge, InvalidImageUpload, allowed_file
+from .history import get_history_recorder
+from . import db, engines, metrics, storage
+
+# The analysis, progressive and batch modules pull in OpenCV and NumPy, so the
+# views import them on first use (see engines.py) rather than at app creation
 
 bp = Blueprint("upload", __name__)
+logger = logging.getLogger(__name__)
+
+# Detector settings whose config key isn't just the setting's name upper-cased
+SETTING_CONFIG_KEYS = {
+    "tiled": "TILED_ANALYSIS",
+    "jpeg_max_pixels": "JPEG_DCT_MAX_PIXELS",
+}
+
+
+def _detector_settings(app):
+    # Every setting the registered detectors know that the app configures; the rest keep their defaults
+    from .analysis import resolve_settings
+
+    settings = {}
+    for name in resolve_settings():
+        key = SETTING_CONFIG_KEYS.get(name, name.upper())
+        if key in app.config:
+            settings[name] = app.config[key]
+    return settings
+
+def _cache_settings(app):
+    return {
+        "backend": app.config["CACHE_BACKEND"],
+        "max_bytes": app.config["CACHE_MAX_BYTES"],
+        "max_age": app.config["CACHE_MAX_AGE"],
+        "directory": app.config["CACHE_DIR"],
+        "redis_url": app.config["CACHE_REDIS_URL"],
+    }
+
+def _storage_settings(app):
+    backend = app.config["ARTIFACT_STORAGE"]
+    if backend == "none":
+        return None
+    return {
+        "backend": backend,
+        "directory": app.config["ARTIFACT_DIR"] or app.config["UPLOAD_FOLDER"],
+        "bucket": app.config["ARTIFACT_S3_BUCKET"],
+        "prefix": app.config["ARTIFACT_S3_PREFIX"],
+        "endpoint_url": app.config["ARTIFACT_S3_ENDPOINT"],
+        "region": app.config["ARTIFACT_S3_REGION"],
+    }
 
-MAX_IMAGE_SIZE_MB = 10
-MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+def _index_settings(app):
+    if not app.config["FINGERPRINT_INDEX"]:
+        return None
+    # Flask-SQLAlchemy resolves relative SQLite paths against the instance folder; workers need the real URL
+    with app.app_context():
+        database_url = db.engine.url.render_as_string(hide_password=False)
+    return {
+        "database_url": database_url,
+        "radius": app.config["FINGERPRINT_RADIUS"],
+        "block_radius": app.config["FINGERPRINT_BLOCK_RADIUS"],
+        "min_blocks": app.config["FINGERPRINT_MIN_BLOCKS"],
+    }
 
-def resize_image_file(img, max_bytes=MAX_IMAGE_SIZE_BYTES):
+def _detector_options(app):
+    return {
+        "cache_settings": _cache_settings(app),
+        "storage_settings": _storage_settings(app),
+        "index_settings": _index_settings(app),
+        "executor": app.config["DETECTOR_EXECUTOR"],
+        "workers": app.config["DETECTOR_WORKERS"],
+        "timeout": app.config["DETECTOR_TIMEOUT"],
+        "shed_load": _shed_load(app),
+    }
+
+def _shed_load(app):
+    return {"expensive": app.config["SHED_EXPENSIVE_LOAD"], "moderate": app.config["SHED_MODERATE_LOAD"]}
+
+def _server_load(app):
     """
-    Compress image to be under max_bytes by reducing quality.
+    Analyses in progress in this process, synchronous ones (running or
+    waiting for a slot) plus queued or running jobs, per unit of ANALYSIS_CAPACITY.
     """
-    buffer = io.BytesIO()
-    quality = 95
-    img.save(buffer, format="JPEG", quality=quality)
-    size = buffer.tell()
-
-    while size > max_bytes and quality > 20:
-        buffer = io.BytesIO()
-        quality -= 5
-        img.save(buffer, format="JPEG", quality=quality)
-        size = buffer.tell()
+    admission = get_admission(app)
+    queue = app.extensions.get("job_queue")
+    busy = admission.active + admission.waiting + (queue.pending() if queue is not None else 0)
+    return busy / float(max(1, app.config["ANALYSIS_CAPACITY"]))
 
-    buffer.seek(0)
-    return Image.open(buffer)
+def _rate_clients():
+    clients = {"ip": f"ip:{request.remote_addr}"}
+    if current_user.is_authenticated:
+        clients["user"] = f"user:{current_user.id}"
+    return clients
 
-def resize_image_dimensions(img, max_pixels=1920):
+def _admission_check(app):
     """
-    Resize image dimensions to a max width or height of max_pixels.
+    Refusal response for a client that may not start an analysis, checked
+    before the upload is read: login when required, then whether its
+    buckets could cover the declared upload size. None when it may go on.
     """
-    width, height = img.size
-    if max(width, height) <= max_pixels:
-        return img
+    if app.config["ANALYZE_REQUIRE_LOGIN"] and not current_user.is_authenticated:
+        return jsonify({"error": "Log in to analyze images"}), 401
+    limiter = get_rate_limiter(app)
+    if limiter is None:
+        return None
+    try:
+        limiter.check(_rate_clients(), limiter.cost(request.content_length or 0))
+    except RateLimited as e:
+        return _rate_limited(e)
+    return None
+
+def _charge(app, nbytes, selected_methods, count=1):
+    # Take the full cost (bytes plus the detectors that will run) now that the methods are known
+    from .detectors import resolve
+
+    limiter = get_rate_limiter(app)
+    if limiter is not None:
+        limiter.take(_rate_clients(), limiter.cost(nbytes, resolve(selected_methods), count), nbytes)
 
-    ratio = max_pixels / float(max(width, height))
-    new_size = (int(width * ratio), int(height * ratio))
-    return img.resize(new_size, Image.Resampling.LANCZOS)
+def _rate_limited(error):
+    metrics.RATE_LIMITED.inc(scope=error.scope)
+    response = jsonify({"error": f"Too many analyses from this {error.scope}, try again later"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+def _overloaded(error):
+    metrics.ANALYSES_SHED.inc(reason=error.reason)
+    response = jsonify({"error": "Server busy, try again later"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+def _user_id():
+    return current_user.id if current_user.is_authenticated else None
+
+def _history_tag(filename, mode):
+    # Background jobs are recorded when they finish, outside this request
+    return {"user_id": _user_id(), "filename": filename, "mode": mode}
+
+def _record_history(app, results, filename, mode, user_id=None, error=None):
+    recorder = get_history_recorder(app)
+    if recorder is not None:
+        recorder.record(results, user_id, filename, mode, error)
+
+def _selected_methods():
+    # Accept methods as comma-separated string or multiple form fields
+    selected_methods = [method for value in request.form.getlist("methods") for method in value.split(",")]
+    return [method.strip().lower() for method in selected_methods if method.strip()]
+
+def _flag(name):
+    value = request.args.get(name) or request.form.get(name) or ""
+    return value.lower() in ("1", "true", "yes")
+
+def _wants_async():
+    return _flag("async")
+
+def _wants_progressive():
+    return _flag("progressive")
 
 @bp.route("/analyze", methods=["POST"])
 def analyze_image():
+    app = current_app
+    refused = _admission_check(app)
+    if refused is not None:
+        return refused
+    # Must come before request.files is touched: the upload is checked while it streams in
+    request.sniff_uploads(app.config["UPLOAD_MEMORY_BYTES"], app.config["MAX_IMAGE_PIXELS"],
+                          app.config["UPLOAD_SPILL_DIR"])
     if "file" not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
 
     file = request.files["file"]
-    methods = request.form.getlist('methods')
-    # Accept methods as comma-separated string or multiple form fields
-    raw_methods = request.form.get("methods") or ""
-    selected_methods = request.form.getlist("methods") or raw_methods.split(",")
-    selected_methods = [method.strip().lower() for method in selected_methods if method.strip()]
-    print("Selected methods:", selected_methods)
-
-    app = current_app
+    selected_methods = _selected_methods()
+    logger.debug("Selected methods: %s", selected_methods)
 
     if file.filename == "":
         return jsonify({"error": "No selected file"}), 400
@@ -68,103 +183,428 @@ def analyze_image():
     if not allowed_file(file.filename, app.config["ALLOWED_EXTENSIONS"]):
         return jsonify({"error": "File type not allowed"}), 400
 
-    # Save uploaded file
-    original_filename = secure_filename(file.filename)
-    original_filepath = os.path.join(app.config["UPLOAD_FOLDER"], original_filename)
-    file.save(original_filepath)
-    print("Saved uploaded file:", original_filepath)
+    from .analysis import AnalysisError, analyze_bytes, hash_bytes
 
-    # Initialize img to avoid 'referenced before assignment' error
-    img = None
-    try:
-        if file.filename.lower().endswith(".heic"):
-            img = convert_heic_to_jpeg(original_filepath)
-        else:
-            img = Image.open(original_filepath)
-    except Exception as e:
-        print("[ERROR] Could not open image:", e)
-        traceback.print_exc()
-        return jsonify({"error": f"Could not open image: {str(e)}"}), 500
+    started = time.perf_counter()
+    load = _server_load(app)
+    # Everything below works from one zero-copy view of the spooled upload
+    with file.stream.view() as data:
+        logger.debug("Upload: %s, %d bytes, in memory: %s", file.stream.header, len(data), file.stream.in_memory)
+        try:
+            _charge(app, len(data), selected_methods)
+        except RateLimited as e:
+            return _rate_limited(e)
+        upload_digest = hash_bytes(data)
+        intake_seconds = time.perf_counter() - started
+        metrics.STAGE_SECONDS.observe(intake_seconds, stage="intake")
+
+        if _wants_async():
+            return _submit_job(app, bytes(data), file.filename, selected_methods, upload_digest, load)
+        if _wants_progressive():
+            return _submit_progressive(
+                app, data, file.filename, selected_methods, upload_digest, intake_seconds, load)
 
-    if img is None:
-        return jsonify({"error": "Could not process image file"}), 500
+        try:
+            with get_admission(app).slot():
+                results = analyze_bytes(
+                    data,
+                    file.filename,
+                    selected_methods,
+                    app.config["UPLOAD_FOLDER"],
+                    _detector_settings(app),
+                    upload_digest=upload_digest,
+                    load=load,
+                    **_detector_options(app),
+                )
+        except Overloaded as e:
+            return _overloaded(e)
+        except AnalysisError as e:
+            metrics.REQUESTS.inc(mode="sync", status="error")
+            return jsonify({"error": str(e)}), 500
+        except Exception as e:
+            logger.exception("Could not open image")
+            metrics.REQUESTS.inc(mode="sync", status="error")
+            return jsonify({"error": f"Could not open image: {str(e)}"}), 500
 
-    # Resize/compress
-    img = resize_image_dimensions(img)
-    img = resize_image_file(img)
+    metrics.observe_results(results, mode="sync")
+    _record_history(app, results, file.filename, "sync", _user_id())
+    response = jsonify({"message": "Analysis complete", "results": results})
+    if app.config["SERVER_TIMING"]:
+        timings = dict(intake=intake_seconds, **results.get("timings", {}))
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
 
-    try:
-        print("Image mode:", img.mode)
-        print("Image format:", img.format)
-        print("Image size:", img.size)
 
-        if img.mode not in ["RGB", "RGBA"]:
-            print("Converting image mode from", img.mode, "to RGB")
-            img = img.convert("RGB")
+def _submit_job(app, data, filename, selected_methods, upload_digest, load=0.0):
+    from .analysis import analyze_bytes
 
-        converted_filename = "converted_" + original_filename.rsplit(".", 1)[0] + ".jpg"
-        converted_filepath = os.path.join(app.config["UPLOAD_FOLDER"], converted_filename)
+    # The job outlives the request (and may run in another process), so it gets its own copy
+    queue = get_job_queue(app)
+    try:
+        job_id = queue.submit(
+            analyze_bytes,
+            data,
+            filename,
+            selected_methods,
+            app.config["UPLOAD_FOLDER"],
+            _detector_settings(app),
+            upload_digest=upload_digest,
+            load=load,
+            tag=_history_tag(filename, "async"),
+            **_detector_options(app),
+        )
+    except QueueFull as e:
+        return _queue_full(e)
+    return jsonify({
+        "message": "Analysis queued",
+        "job_id": job_id,
+        "status_url": url_for("upload.job_status", job_id=job_id),
+        "result_url": url_for("upload.job_result", job_id=job_id),
+    }), 202
 
-        os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
-        img.save(converted_filepath, format="JPEG")
-        print("Converted image saved to:", converted_filepath)
-    except Exception as e:
-        print("[ERROR] Failed to save converted image:", e)
-        return jsonify({"error": f"Could not save converted image: {str(e)}"}), 500
+def _queue_full(error, status=429):
+    metrics.QUEUE_REJECTED.inc()
+    response = jsonify({"error": "Too many analyses in progress, try again later"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, status
+
 
-    results = {}
+def _submit_progressive(app, data, filename, selected_methods, upload_digest, intake_seconds, load=0.0):
+    from .progressive import analyze_stage, plan_stages, preview_analysis
 
+    # Queue the full analysis first so it is already running while the preview is computed
+    queue = get_job_queue(app)
+    # The stages read the upload from a scratch file rather than each getting a copy through the pool
+    path = os.path.join(app.config["STAGE_FOLDER"], storage.scratch_name(upload_digest[:16]))
+    with open(path, "wb") as fh:
+        fh.write(data)
+    stages = plan_stages(selected_methods)
+    calls = {
+        stage: (
+            analyze_stage,
+            (path, filename, methods, app.config["UPLOAD_FOLDER"], _detector_settings(app)),
+            dict(upload_digest=upload_digest, load=load, final=stage == list(stages)[-1], **_detector_options(app)),
+        )
+        for stage, methods in stages.items()
+    }
     try:
-        print("Starting ELA analysis...")
-        if "ela" in selected_methods or not selected_methods:
-            ela_output_path, ela_result_text = ela_analysis(converted_filepath, app.config["UPLOAD_FOLDER"], app.config["ELA_QUALITY"])
-            print("ELA output:", ela_output_path, ela_result_text)
-            if ela_output_path:
-                results["ela_image"] = os.path.basename(ela_output_path)
-            results["ela_result"] = ela_result_text
-
-        print("Starting Noise analysis...")
-        if "noise" in selected_methods or not selected_methods:
-            noise_output_path, noise_result_text = noise_analysis(converted_filepath, app.config["UPLOAD_FOLDER"])
-            print("Noise output:", noise_output_path, noise_result_text)
-            if noise_output_path:
-                results["noise_image"] = os.path.basename(noise_output_path)
-            results["noise_result"] = noise_result_text
-
-        print("Starting Copy-Move detection...")
-        if "copy_move" in selected_methods or not selected_methods:
-            print("Running Copy-Move detection...")
-            copy_move_output_path, copy_move_result_text = copy_move_detection(converted_filepath, app.config["UPLOAD_FOLDER"])
-            print("Copy-Move detection result:", copy_move_result_text)
-            print("Copy-Move image path:", copy_move_output_path)
-            results["copy_move_result"] = copy_move_result_text
-            if copy_move_output_path:
-                results["copy_move_image"] = os.path.basename(copy_move_output_path)
-
-        print("Starting Metadata analysis...")
-        if "metadata" in selected_methods or not selected_methods:
-            metadata = metadata_analysis(converted_filepath)
-            print("Metadata output:", metadata)
-            results["metadata_result"] = metadata
+        analysis_id = queue.submit_group(calls, tag=_history_tag(filename, "progressive"), chain=True)
+    except QueueFull as e:
+        os.remove(path)
+        return _queue_full(e)
 
+    try:
+        with get_admission(app).slot():
+            preview = preview_analysis(
+                data,
+                filename,
+                selected_methods,
+                app.config["UPLOAD_FOLDER"],
+                _detector_settings(app),
+                max_side=app.config["PREVIEW_MAX_SIDE"],
+                timeout=app.config["PREVIEW_TIMEOUT"],
+                upload_digest=upload_digest,
+                storage_settings=_storage_settings(app),
+                load=load,
+                shed_load=_shed_load(app),
+            )
+        metrics.STAGE_SECONDS.observe(preview["timings"]["total"], stage="preview")
+        metrics.REQUESTS.inc(mode="preview", status="ok")
+    except Overloaded as e:
+        metrics.ANALYSES_SHED.inc(reason=e.reason)
+        metrics.REQUESTS.inc(mode="preview", status="shed")
+        preview = {"preview_error": "Server busy, preview skipped", "method_status": {}, "timings": {}}
     except Exception as e:
-        print("=== ERROR DURING ANALYSIS ===")
-        traceback.print_exc()
-        print("=============================")
-        return jsonify({"error": "An error occurred during analysis", "details": str(e)}), 500
+        # The full analysis is already queued, so a failed preview only costs the early answer
+        logger.exception("Preview analysis failed")
+        metrics.REQUESTS.inc(mode="preview", status="error")
+        preview = {"preview_error": str(e), "method_status": {}, "timings": {}}
+
+    response = jsonify({
+        "message": "Preview ready, full analysis queued",
+        "results": preview,
+        "analysis_id": analysis_id,
+        "stages": list(calls),
+        "progress_url": url_for("upload.analysis_progress", analysis_id=analysis_id),
+        "events_url": url_for("upload.analysis_events", analysis_id=analysis_id),
+    })
+    if app.config["SERVER_TIMING"]:
+        timings = {"intake": intake_seconds}
+        timings.update(("preview_" + stage, seconds) for stage, seconds in preview["timings"].items())
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response, 202
+
+
+@bp.route("/analyze/progress/<analysis_id>", methods=["GET"])
+def analysis_progress(analysis_id):
+    """
+    Polling view of a progressive analysis: stage states and the merged results so far.
+    """
+    from .progressive import group_progress
+
+    stages = get_job_queue(current_app).get_group(analysis_id)
+    if stages is None:
+        return jsonify({"error": "Unknown analysis"}), 404
+    return jsonify(dict(analysis_id=analysis_id, **group_progress(stages)))
+
+
+@bp.route("/analyze/progress/<analysis_id>/events", methods=["GET"])
+def analysis_events(analysis_id):
+    """
+    Server-sent events for a progressive analysis: one "stage" event per
+    finished stage, then "done".
+    """
+    from .progressive import stream_progress
+
+    queue = get_job_queue(current_app)
+    if queue.get_group(analysis_id) is None:
+        return jsonify({"error": "Unknown analysis"}), 404
+    events = stream_progress(queue, analysis_id, max_seconds=current_app.config["JOB_RESULT_TTL"])
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # keep nginx from buffering the stream
+    return response
 
-    # Clean up converted file if different from original
-    if converted_filepath != original_filepath:
+
+@bp.errorhandler(InvalidImageUpload)
+@bp.errorhandler(ImageTooLarge)
+def rejected_upload(error):
+    metrics.REQUESTS.inc(mode="sync", status="rejected")
+    return jsonify({"error": error.description}), error.code
+
+
+@bp.route("/analyze/batch", methods=["POST"])
+def analyze_batch():
+    """
+    Analyze a zip archive ("archive") or several files ("files") and stream
+    one JSON Lines record per image as it finishes, then a summary record.
+    """
+    from .batch import Throughput, iter_zip_members, open_zip, run_batch, screen_image, to_jsonl
+
+    app = current_app
+    refused = _admission_check(app)
+    if refused is not None:
+        return refused
+    allowed = app.config["ALLOWED_EXTENSIONS"]
+    limit = app.config["BATCH_MAX_FILES"]
+
+    # Uploads are closed once the view returns, so copy them out before streaming
+    if "archive" in request.files:
         try:
-            os.remove(converted_filepath)
-            print("Deleted temporary file:", converted_filepath)
-        except Exception as e:
-            print("Error deleting temp file:", e)
+            archive = open_zip(io.BytesIO(request.files["archive"].read()))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        items = iter_zip_members(archive, allowed, app.config["MAX_CONTENT_LENGTH"], app.config["MAX_IMAGE_PIXELS"])
+        count = sum(1 for info in archive.infolist() if not info.is_dir())
+    else:
+        files = [f for f in request.files.getlist("files") if f.filename]
+        files = [f for f in files if allowed_file(f.filename, allowed)]
+        if not files:
+            return jsonify({"error": "No image files in the request"}), 400
+        items = [(secure_filename(f.filename), screen_image(f.read(), app.config["MAX_IMAGE_PIXELS"]))
+                 for f in files]
+        count = len(files)
+    if count > limit:
+        return jsonify({"error": f"Too many files in one batch (limit {limit})"}), 400
+    try:
+        _charge(app, request.content_length or 0, _selected_methods(), count)
+    except RateLimited as e:
+        return _rate_limited(e)
+
+    queue = get_job_queue(app)
+    workers = app.config["JOB_WORKERS"]
+    # The images in flight hold job queue slots until the stream ends, so a batch can't crowd out other jobs
+    in_flight = max(1, min(workers, count, queue.max_pending))
+    try:
+        queue.reserve(in_flight)
+    except QueueFull as e:
+        return _queue_full(e, 503)
+    # Images are spread over the pool, so each one runs its detectors inline
+    options = dict(_detector_options(app), executor="inline")
+    records = run_batch(
+        items,
+        queue.executor,
+        _selected_methods(),
+        app.config["UPLOAD_FOLDER"],
+        _detector_settings(app),
+        options,
+        max_in_flight=in_flight,
+    )
+
+    user_id = _user_id()
+
+    def generate():
+        throughput = Throughput(workers)
+        for record in records:
+            throughput.add(record)
+            if record["status"] == "ok":
+                metrics.observe_results(record["results"], mode="batch")
+                _record_history(app, record["results"], record["path"], "batch", user_id)
+            else:
+                metrics.REQUESTS.inc(mode="batch", status="error")
+                _record_history(app, {}, record["path"], "batch", user_id, error=record.get("error"))
+            yield to_jsonl(record)
+        summary = throughput.summary()
+        logger.info("Batch finished: %s", summary)
+        yield to_jsonl({"summary": summary})
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.call_on_close(lambda: queue.release(in_flight))
+    return response
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue(current_app).get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "submitted": job["submitted"],
+        "finished": job["finished"],
+        "error": job["error"],
+        "result_url": url_for("upload.job_result", job_id=job_id),
+    })
+
+
+@bp.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = get_job_queue(current_app).get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": "An error occurred during analysis", "details": job["error"]}), 500
+    if job["status"] != "done":
+        return jsonify({"job_id": job_id, "status": job["status"]}), 202
+    return jsonify({"message": "Analysis complete", "results": job["result"]})
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not current_app.config["METRICS_ENABLED"]:
+        return jsonify({"error": "Not found"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/ready", methods=["GET"])
+def readiness():
+    """
+    Readiness probe: 200 once this worker can analyze without loading the
+    engines first, 503 (with Retry-After) while they load or after a failed load.
 
-    return jsonify({"message": "Analysis complete", "results": results})
+    With ENGINE_LOADING=lazy the engines load on the first analysis, so the
+    worker is always reported ready.
+    """
+    mode = current_app.config["ENGINE_LOADING"]
+    state = engines.status()
+    ready = state["status"] == "ready" or mode == "lazy"
+    response = jsonify({"ready": ready, "mode": mode, "engines": state})
+    if ready:
+        return response
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+@bp.before_app_request
+def _start_engine_loading():
+    # Without the gunicorn post_fork hook, the first request (often a /ready probe) starts the loader
+    if current_app.config["ENGINE_LOADING"] == "background":
+        engines.load_in_background()
+
+
+def start_artifact_gc(app):
+    """
+    Start this process's artifact garbage collector for app.
+
+    Called once per web worker by the gunicorn post_worker_init hook (and by
+    run.py for the development server), never from the preloading master.
+    """
+    storage.start_collector(
+        _storage_settings(app),
+        app.config["ARTIFACT_GC_INTERVAL"],
+        app.config["ARTIFACT_MAX_AGE"],
+        app.config["ARTIFACT_MAX_BYTES"],
+        scratch_dirs=[app.config["UPLOAD_FOLDER"], app.config["STAGE_FOLDER"]],
+    )
 
 
 @bp.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return send_from_directory(current_app.config["UPLOAD_FOLDER"], filename)
+    """
+    Serve an artifact by key, or a file from the upload folder when storage is off.
+
+    Keys are content hashes, so the hash doubles as a strong ETag and the
+    response may be cached for as long as the artifact is kept.
+    """
+    app = current_app
+    settings = _storage_settings(app)
+    if settings is None or not storage.is_valid_key(filename):
+        return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+
+    etag = filename.split(".", 1)[0]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        store = storage.get_artifact_store(settings)
+        path = store.local_path(filename)
+        if path is not None:
+            response = send_file(path, mimetype=storage.content_type(filename), etag=False, conditional=False,
+                                 max_age=app.config["ARTIFACT_MAX_AGE"])
+        else:
+            data = store.get(filename)
+            if data is None:
+                return jsonify({"error": "Not found"}), 404
+            response = Response(data, mimetype=storage.content_type(filename))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["ARTIFACT_MAX_AGE"]
+    response.cache_control.immutable = True
+    return response
+
+
+@functools.lru_cache(maxsize=None)
+def _optional_module(name):
+    # brotli and msgpack are optional; without them responses fall back to gzip and JSON
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+@bp.after_request
+def _negotiate_response(response):
+    """
+    Re-encode JSON responses the way the client asked for.
+
+    "Accept: application/msgpack" gets MessagePack (when msgpack is
+    installed), and bodies of at least RESPONSE_COMPRESS_MIN_BYTES are
+    compressed with the best of br and gzip the client accepts. Streams,
+    artifacts and other responses pass through untouched.
+    """
+    if response.mimetype != "application/json" or response.is_streamed or response.direct_passthrough:
+        return response
+    app = current_app
+    response.vary.add("Accept")
+    msgpack = _optional_module("msgpack")
+    wanted = request.accept_mimetypes.best_match(["application/json", "application/msgpack", "application/x-msgpack"])
+    if msgpack is not None and wanted in ("application/msgpack", "application/x-msgpack"):
+        response.set_data(msgpack.packb(response.get_json(), use_bin_type=True))
+        response.mimetype = "application/msgpack"
+
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < app.config["RESPONSE_COMPRESS_MIN_BYTES"] or "Content-Encoding" in response.headers:
+        return response
+    brotli = _optional_module("brotli")
+    encoding = request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+    level = app.config["RESPONSE_COMPRESS_LEVEL"]
+    if encoding == "br":
+        response.set_data(brotli.compress(data, quality=level))
+    elif encoding == "gzip":
+        response.set_data(gzip.compress(data, compresslevel=level))
+    else:
+        return response
+    response.headers["Content-Encoding"] = encoding
+    return response
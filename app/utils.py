@@ -1,20 +1,32 @@
-import os
-from PIL import Image, ImageChops, ImageEnhance, ExifTags, ImageDraw
-from PIL.ExifTags import TAGS
+import hashlib
+import logging
+import threading
+from PIL import Image, ImageDraw
 import pillow_heif
 import io
 import numpy as np
 import cv2
 import pyheif
 import piexif
+from .artifacts import save_heatmap
+from .copy_move import detect_copy_move
+from .metadata import extract_segments, summarize, thumbnail_signals
+from .ela import SWEEP as ELA_SWEEP, detect_ela, detect_ela_tiled, heatmap_values as ela_values
+from .noise import detect_noise, detect_noise_tiled, heatmap_values as noise_values
+from .jpeg import detect_jpeg, load_known_tables, map_values as jpeg_values
 
 pillow_heif.register_heif_opener()
 
-def allowed_file(filename, allowed_extensions):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
-
+logger = logging.getLogger(__name__)
 
 def convert_heic_to_jpeg(image_path):
+    """
+    Legacy HEIC path: decode with pyheif, then round-trip through a quality 95 JPEG.
+
+    Uploads now go through decode_heif; this is kept as the reference that
+    benchmark.py measures the direct decode against.
+    """
+    # pyheif.read accepts a path, raw bytes or a file-like object
     try:
         heif_file = pyheif.read(image_path)
 
@@ -38,121 +50,401 @@ def convert_heic_to_jpeg(image_path):
         return Image.open(output_buffer)
 
     except Exception as e:
-        print(f"Error converting HEIC: {e}")
+        logger.warning("Error converting HEIC: %s", e)
         return None
 
-def ela_analysis(image_path, output_folder, quality=90):
+def decode_heif(data, max_side=None, use_thumbnails=False):
+    """
+    Decode HEIC/HEIF bytes straight to pixels, returning (image, exif_bytes).
+
+    There is no intermediate JPEG, so no recompression artifacts reach ELA.
+    With max_side the decoded image is immediately reduced by the largest
+    integer factor that keeps its long side at or above max_side, which frees
+    the full-resolution buffer early; the exact resize happens later. With
+    use_thumbnails the smallest embedded thumbnail that is still at least
+    max_side is decoded instead of the primary image. That is much faster,
+    but a thumbnail an editor failed to regenerate can hide an edit, so it
+    is opt-in. Returns (None, b"") when the file can't be decoded.
+    """
     try:
-        original_image = Image.open(image_path).convert("RGB")
-        temp_path = os.path.join(output_folder, "temp_ela.jpg")
-        original_image.save(temp_path, quality=quality)
-
-        recompressed_image = Image.open(temp_path)
-
-        diff = ImageChops.difference(original_image, recompressed_image)
-        extrema = diff.getextrema()
-        max_diff = max([ex[1] for ex in extrema])
-        scale = 255.0 / max_diff if max_diff > 0 else 1
-        ela_image = ImageEnhance.Brightness(diff).enhance(scale)
-
-        ela_output_path = os.path.join(output_folder, os.path.basename(image_path).split(".")[0] + "_ela.jpg")
-        ela_image.save(ela_output_path)
-        os.remove(temp_path)
-
-        if max_diff > 30:
-            result = f"ELA detected high recompression artifacts (max diff: {max_diff}) – possible tampering."
-        else:
-            result = f"ELA showed minimal differences (max diff: {max_diff}) – likely untampered."
-
-        return ela_output_path, result
-    except Exception as e:
-        print(f"Error during ELA analysis: {e}")
-        return None, f"ELA analysis failed: {str(e)}"
-
-def noise_analysis(image_path, output_folder):
-    try:
-        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if img is None: 
-            return None, "Noise analysis failed – image couldn't be loaded."
-
-        kernel = np.array([[-1,-1,-1],
-                           [-1, 9,-1],
-                           [-1,-1,-1]])
-        noise_img = cv2.filter2D(img, -1, kernel)
-
-        noise_output_path = os.path.join(output_folder, os.path.basename(image_path).split(".")[0] + "_noise.jpg")
-        cv2.imwrite(noise_output_path, noise_img)
-        
-        variance = np.var(noise_img)
-        if variance > 1000:
-            result = f"High noise variance detected ({variance:.2f}) – may indicate tampering or poor compression."
-        else:
-            result = f"Low noise variance ({variance:.2f}) – likely consistent with natural image."
-
-        return noise_output_path, result
-    except Exception as e:
-        return None, f"Noise analysis error: {str(e)}"
-
-def copy_move_detection(image_path, output_folder):
-    try:
-        # Load image using OpenCV
-        img_cv = cv2.imread(image_path)
-        if img_cv is None:
-            return None, "Copy-move detection failed – image couldn't be loaded."
-
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-
-        # ORB feature detector
-        orb = cv2.ORB_create(nfeatures=1000)
-        keypoints, descriptors = orb.detectAndCompute(gray, None)
-
-        if descriptors is None or len(keypoints) < 2:
-            return None, "Not enough keypoints for copy-move detection."
-
-        # BFMatcher with Hamming distance
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        matches = bf.match(descriptors, descriptors)
-
-        # Filter matches (remove identical keypoints)
-        matches = [m for m in matches if m.distance > 0 and abs(m.queryIdx - m.trainIdx) > 10]
-
-        # Draw matches on image
-        img_matches = cv2.drawMatches(
-            img_cv, keypoints,
-            img_cv, keypoints,
-            matches[:20], None, flags=2
-        )
-
-        output_path = os.path.join(
-            output_folder,
-            os.path.basename(image_path).split(".")[0] + "_copy_move.jpg"
-        )
-        cv2.imwrite(output_path, img_matches)
-
-        result = f"Copy-move detection completed – {len(matches)} matches found (displaying top 20)."
-        return output_path, result
-
-    except Exception as e:
-        return None, f"Copy-Move detection error: {str(e)}"
-        
-def metadata_analysis(image_path):
-    try:
-        img = Image.open(image_path)
-        print(f"[DEBUG] Format: {img.format}, Info keys: {img.info.keys()}")
-        exif_data = img._getexif()
-        print(f"[DEBUG] EXIF raw: {exif_data}")
-
-        if not exif_data:
-            if img.format in ["HEIC", "HEIF"]:
-                return {"Info": "No metadata found (HEIC format not fully supported for EXIF)"}
-            return {"Info": "No metadata found (Image may lack EXIF)"}
-
-        metadata = {}
-        for tag, value in exif_data.items():
-            decoded = TAGS.get(tag, tag)
-            metadata[decoded] = value
-
-        return metadata
-
+        heif_file = pillow_heif.open_heif(data, convert_hdr_to_8bit=True)
+        primary = heif_file[heif_file.primary_index]
+        exif = primary.info.get("exif") or b""
+
+        source = primary
+        if max_side and use_thumbnails:
+            for index in range(len(primary.info.get("thumbnails", []))):
+                thumbnail = primary.get_thumbnail(index)
+                if max(thumbnail.size) >= max_side and max(thumbnail.size) < max(source.size):
+                    source = thumbnail
+
+        img = source.to_pillow()
+        if max_side:
+            factor = max(img.size) // max_side
+            if factor > 1:
+                img = img.reduce(factor)
+        img.format = "HEIF"
+        img.info["exif"] = exif
+        return img, exif
     except Exception as e:
-        return {"Error": str(e)}
+        logger.warning("Error decoding HEIF: %s", e)
+        return None, b""
+
+class DecodedImage:
+    """
+    An upload decoded once into memory and shared by every detector.
+
+    Holds the decoded RGB image, the raw EXIF blob of the original upload, the
+    metadata segments read from its headers (see metadata.extract_segments),
+    the upload's original bytes for detectors that read the file itself
+    and lazily derived RGB/BGR/grayscale arrays so no detector has to reload
+    the file. Tiled detectors read crops of self.pil and never build the arrays.
+    """
+
+    def __init__(self, pil_image, exif=None, name="image", source_format=None, segments=None, source=None):
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        self.pil = pil_image
+        self.exif = exif or b""
+        self.name = name
+        self.format = source_format
+        self.segments = segments
+        self.source = source
+        self._rgb = None
+        self._bgr = None
+        self._gray = None
+        self._downscaled = {}
+        self.encode_stats = None
+        self._lock = threading.Lock()
+
+    def park(self, path):
+        """
+        Write the decoded pixels to path (a .npy file) and return a small dict
+        that from_parked turns back into this image, in any process.
+        """
+        np.save(path, self.rgb, allow_pickle=False)
+        return {"path": path, "exif": self.exif, "name": self.name, "format": self.format,
+                "segments": self.segments, "encode_stats": self.encode_stats}
+
+    @classmethod
+    def from_parked(cls, parked, source=None):
+        """
+        The image park() wrote, with source (the upload's bytes) attached again.
+        """
+        pixels = np.load(parked["path"], allow_pickle=False)
+        image = cls(Image.fromarray(pixels), exif=parked["exif"], name=parked["name"],
+                    source_format=parked["format"], segments=parked["segments"], source=source)
+        image.encode_stats = parked["encode_stats"]
+        return image
+
+    @property
+    def size(self):
+        return self.pil.size
+
+    def digest(self, strip_rows=256):
+        """
+        SHA-256 of the decoded pixels (and their shape), independent of file name or encoding.
+
+        Hashed in strips of rows so a full-resolution image isn't copied whole.
+        """
+        width, height = self.pil.size
+        h = hashlib.sha256(str((height, width, 3)).encode("ascii"))
+        for top in range(0, height, strip_rows):
+            h.update(self.pil.crop((0, top, width, min(height, top + strip_rows))).tobytes())
+        return h.hexdigest()
+
+    def downscaled(self, max_pixels):
+        """
+        Return a DecodedImage no larger than max_pixels on its long side (self if it already fits).
+        """
+        if max(self.pil.size) <= max_pixels:
+            return self
+        with self._lock:
+            if max_pixels not in self._downscaled:
+                width, height = self.pil.size
+                ratio = max_pixels / float(max(width, height))
+                resized = self.pil.resize((int(width * ratio), int(height * ratio)), Image.Resampling.LANCZOS)
+                self._downscaled[max_pixels] = DecodedImage(
+                    resized,
+                    exif=self.exif,
+                    name=self.name,
+                    source_format=self.format,
+                    segments=self.segments,
+                    source=self.source,
+                )
+            return self._downscaled[max_pixels]
+
+    @property
+    def rgb(self):
+        with self._lock:
+            if self._rgb is None:
+                self._rgb = np.asarray(self.pil)
+        return self._rgb
+
+    @property
+    def bgr(self):
+        # Detectors may run concurrently; convert only once
+        with self._lock:
+            if self._bgr is None:
+                self._bgr = cv2.cvtColor(np.asarray(self.pil), cv2.COLOR_RGB2BGR)
+        return self._bgr
+
+    @property
+    def gray(self):
+        with self._lock:
+            if self._gray is None:
+                self._gray = np.asarray(self.pil.convert("L"))
+        return self._gray
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only, seekable file over a bytes-like object that never copies it whole.
+
+    io.BytesIO(memoryview) would duplicate the upload before decoding starts.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        b[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def open_image(data, filename, max_side=None, heif_thumbnails=False):
+    """
+    Open raw upload bytes (bytes or a memoryview) as a PIL image, returning (image, exif_bytes).
+
+    max_side and heif_thumbnails let HEIC/HEIF uploads shrink while they are
+    decoded (see decode_heif); other formats are opened at full size.
+    """
+    if filename.lower().endswith((".heic", ".heif")):
+        return decode_heif(data, max_side, heif_thumbnails)
+    elif isinstance(data, bytes):
+        img = Image.open(io.BytesIO(data))
+    else:
+        img = Image.open(BufferReader(data))
+    return img, img.info.get("exif") or b""
+
+
+def ela_analysis(image, output_folder, quality=90, sweep=ELA_SWEEP, artifact_options=None):
+    """
+    Multi-quality ELA. Returns (output_path, result_text, details).
+
+    The output image is the luma error at quality as a heatmap (see
+    artifacts.save_heatmap, which artifact_options are passed to); details
+    is {"score", "regions", "qualities", "max_diff", "size", "pyramid"}.
+    Region boxes are in image pixels, and size is the image's [width, height].
+    """
+    found = detect_ela(image.gray, quality, sweep)
+    return _save_ela(image, output_folder, found, quality, sweep, artifact_options)
+
+def tiled_ela_analysis(image, output_folder, quality=90, tile=1024, max_side=2048, sweep=ELA_SWEEP,
+                       artifact_options=None):
+    """
+    ELA on the full-resolution image, one tile at a time.
+
+    Same verdict and regions as ela_analysis; the error map is kept at no
+    more than max_side pixels on its long side, which is also the top of
+    its pyramid.
+    """
+    found = detect_ela_tiled(image.pil, quality, sweep, tile, max_side)
+    return _save_ela(image, output_folder, found, quality, sweep, artifact_options)
+
+def _save_ela(image, output_folder, found, quality, sweep, artifact_options=None):
+    regions = found["regions"]
+    ela_output_path, pyramid = save_heatmap(
+        ela_values(found["diff"], found["max_diff"]), "inferno", output_folder, image.name + "_ela",
+        **(artifact_options or {}))
+
+    score = found["score"]
+    if score >= 0.5:
+        result = (f"ELA found {len(regions)} region(s) with inconsistent compression error "
+                  f"(score {score:.2f}) – possible tampering.")
+    else:
+        result = f"ELA found consistent compression error (score {score:.2f}) – likely untampered."
+    details = {
+        "score": score,
+        "regions": regions,
+        "qualities": sorted({quality, *sweep}),
+        "max_diff": found["max_diff"],
+        "size": list(image.size),
+        "pyramid": pyramid,
+    }
+    return ela_output_path, result, details
+
+def noise_analysis(image, output_folder, artifact_options=None):
+    """
+    Local noise-level consistency. Returns (output_path, result_text, details).
+
+    The output image is the noise level of each 8x8 cell as a palette PNG
+    heatmap (see artifacts.save_heatmap); details is {"score", "regions",
+    "noise_level", "size"}, with region boxes in image pixels and size the
+    image's [width, height].
+    """
+    found = detect_noise(image.gray, image.rgb)
+    return _save_noise(image, output_folder, found, artifact_options)
+
+def tiled_noise_analysis(image, output_folder, tile=1024, artifact_options=None):
+    """
+    Noise analysis on the full-resolution image, one tile at a time.
+
+    Same verdict, regions and heatmap as noise_analysis.
+    """
+    found = detect_noise_tiled(image.pil, tile)
+    return _save_noise(image, output_folder, found, artifact_options)
+
+def _save_noise(image, output_folder, found, artifact_options=None):
+    regions = found["regions"]
+    width, height = image.size
+    # One value per cell is smooth and small: lossless palette PNG, whatever the per-pixel format
+    noise_output_path, _ = save_heatmap(
+        noise_values(found, width, height), "jet", output_folder, image.name + "_noise",
+        **dict(artifact_options or {}, fmt="png"))
+
+    score = found["score"]
+    if score >= 0.5:
+        result = (f"Noise analysis found {len(regions)} region(s) whose noise level doesn't match "
+                  f"the rest of the image (score {score:.2f}) – possible tampering.")
+    else:
+        result = (f"Noise level is consistent across the image ({found['noise_level']:.2f} gray levels, "
+                  f"score {score:.2f}) – likely untampered.")
+    details = {
+        "score": score,
+        "regions": regions,
+        "noise_level": found["noise_level"],
+        "size": [width, height],
+    }
+    return noise_output_path, result, details
+
+def copy_move_detection(image, max_matches=50):
+    """
+    ORB keypoint copy-move matching. Returns (result_text, details).
+
+    details is {"matches", "size"}: the strongest max_matches matches as
+    [x1, y1, x2, y2] pixel pairs for the client to draw over the original,
+    and the [width, height] they are measured in.
+    """
+    gray = image.gray
+
+    # ORB feature detector
+    orb = cv2.ORB_create(nfeatures=1000)
+    keypoints, descriptors = orb.detectAndCompute(gray, None)
+
+    if descriptors is None or len(keypoints) < 2:
+        return "Not enough keypoints for copy-move detection.", {}
+
+    # BFMatcher with Hamming distance
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    matches = bf.match(descriptors, descriptors)
+
+    # Filter matches (remove identical keypoints)
+    matches = [m for m in matches if m.distance > 0 and abs(m.queryIdx - m.trainIdx) > 10]
+    matches.sort(key=lambda m: m.distance)
+
+    shown = [
+        [round(v, 1) for v in (*keypoints[m.queryIdx].pt, *keypoints[m.trainIdx].pt)]
+        for m in matches[:max_matches]
+    ]
+    result = f"Copy-move detection completed – {len(matches)} matches found (showing the best {len(shown)})."
+    return result, {"matches": shown, "size": list(image.size)}
+
+def block_copy_move_detection(image, epsilon=1.5):
+    """
+    Block-DCT copy-move detection. Returns (result_text, details).
+
+    details is {"regions", "polygons", "size"}: each source/target pair of
+    boxes, the outlines of the duplicated areas as [[x, y], ...] polygons
+    (simplified to within epsilon pixels) and the [width, height] they are
+    measured in. The client draws them over the original.
+    """
+    found = detect_copy_move(image.gray)
+    regions = found["regions"]
+    contours, _ = cv2.findContours(found["mask"], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = [cv2.approxPolyDP(contour, epsilon, True).reshape(-1, 2).tolist() for contour in contours]
+
+    if regions:
+        result = f"Copy-move detection found {len(regions)} duplicated region(s) ({found['pairs']} matching blocks) – possible tampering."
+    else:
+        result = "Copy-move detection found no duplicated regions – likely untampered."
+    return result, {"regions": regions, "polygons": polygons, "size": list(image.size)}
+
+def jpeg_analysis(image, output_folder, max_pixels=None, known_tables=None, artifact_options=None):
+    """
+    JPEG-domain analysis of the original upload. Returns (output_path, result_text, details).
+
+    Works from image.source, the bytes as uploaded, since the decoded image
+    has lost its compression history. The output image is the block map of
+    aligned double compression, one palette PNG pixel per 8x8 block, written
+    only for double-compressed uploads.
+    """
+    if image.source is None or image.format != "JPEG":
+        return None, "Not a JPEG upload – JPEG compression analysis skipped.", {}
+    found = detect_jpeg(image.source, load_known_tables(known_tables), max_pixels)
+    tables = found["tables"]
+    saved = f"quality {tables['quality']}" if tables["standard"] else f"about quality {tables['quality']}"
+    if tables["match"] and not tables["standard"]:
+        saved += f", tables of {tables['match']}"
+    details = {"quality": tables["quality"], "tables": tables, "dct": found["dct"]}
+    if not found["dct"]:
+        return None, f"Last saved at {saved}; DCT analysis skipped: {found['dct_error']}", details
+
+    details.update(double_compressed=found["double_compressed"], primary_quality=found["primary_quality"],
+                   score=found["score"], regions=found["regions"], size=[found["width"], found["height"]])
+    if not found["double_compressed"]:
+        return None, f"Compressed once, at {saved} – no sign of an earlier JPEG save.", details
+
+    output_path, _ = save_heatmap(jpeg_values(found), "inferno", output_folder, image.name + "_jpeg",
+                                  **dict(artifact_options or {}, fmt="png"))
+    first = f"quality {found['primary_quality']}" if found["primary_quality"] else "a lower quality"
+    regions = found["regions"]
+    if regions:
+        result = (f"Compressed twice (first at {first}, then at {saved}), but {len(regions)} region(s) "
+                  f"don't share the first compression (score {found['score']:.2f}) – possible splice.")
+    else:
+        result = (f"Compressed twice (first at {first}, then at {saved}) with no region standing out – "
+                  f"re-saved, but no sign of a splice.")
+    return output_path, result, details
+
+def metadata_analysis(image):
+    """
+    Metadata table and tamper signals from the upload's headers. Returns (metadata, signals).
+
+    Reads the segments captured when the upload was decoded, falling back to
+    the EXIF blob alone; the embedded EXIF thumbnail, if any, is checked
+    against the decoded pixels.
+    """
+    segments = image.segments
+    if segments is None:
+        segments = dict(extract_segments(b""), format=image.format, exif=image.exif)
+    metadata, signals, thumbnail = summarize(segments)
+    if thumbnail is not None:
+        signals.extend(thumbnail_signals(thumbnail, image.pil))
+    if not metadata:
+        metadata = {"Info": "No metadata found (Image may lack EXIF)"}
+    return metadata, signals
@@ -0,0 +1,89 @@
+"""
+Offline bulk scan: analyze every image under a directory and write JSON Lines.
+
+    python batch.py /path/to/archive -o results.jsonl --methods ela,noise
+
+Records are appended as images finish; re-running with the same output file
+skips images already recorded as "ok", so an interrupted scan can be resumed.
+"""
+import argparse
+import os
+import sys
+
+from app import create_app
+from app.batch import Throughput, iter_image_files, load_finished, run_batch, to_jsonl
+from app.jobs import make_executor
+from app.upload import _detector_options, _detector_settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run tampering detectors over a directory of images.")
+    parser.add_argument("directory", help="directory to scan (recursively)")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSON Lines file to append records to")
+    parser.add_argument("--methods", default="", help="comma-separated detectors (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--artifacts", default=None, help="folder for heatmaps and the local artifact store (default: the app's upload folder)")
+    return parser.parse_args(argv)
+
+
+def _terminate_last_line(path):
+    # A crash can leave a half-written record; start the next one on its own line
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as fh:
+        fh.seek(-1, os.SEEK_END)
+        if fh.read(1) != b"\n":
+            fh.write(b"\n")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = create_app()
+    methods = [method.strip().lower() for method in args.methods.split(",") if method.strip()]
+    if args.artifacts:
+        # Detectors render there and the local artifact store lives there too
+        app.config["UPLOAD_FOLDER"] = app.config["ARTIFACT_DIR"] = args.artifacts
+    output_folder = app.config["UPLOAD_FOLDER"]
+    os.makedirs(output_folder, exist_ok=True)
+    # Parallelism comes from the process pool, so each image runs its detectors inline
+    options = dict(_detector_options(app), executor="inline")
+
+    finished = load_finished(args.output)
+    throughput = Throughput(args.workers)
+
+    def pending():
+        for key, path in iter_image_files(args.directory, app.config["ALLOWED_EXTENSIONS"]):
+            if key in finished:
+                throughput.skipped += 1
+                continue
+            yield key, path
+
+    if finished:
+        print(f"Resuming: {len(finished)} images already done")
+    _terminate_last_line(args.output)
+    executor = make_executor("process", args.workers)
+    with open(args.output, "a", encoding="utf-8") as out:
+        try:
+            for record in run_batch(pending(), executor, methods, output_folder,
+                                    _detector_settings(app), options, max_in_flight=2 * args.workers):
+                out.write(to_jsonl(record))
+                out.flush()
+                throughput.add(record)
+                print(f"[{throughput.images}] {record['path']}: {record['status']} ({record['seconds']}s)")
+        except KeyboardInterrupt:
+            print("\n🛑 Interrupted; re-run the same command to resume")
+            executor.shutdown(wait=False, cancel_futures=True)
+            return 130
+    executor.shutdown()
+
+    summary = throughput.summary()
+    print("-" * 60)
+    print(f"Images: {summary['images']} ({summary['errors']} errors, {summary['skipped']} skipped)")
+    print(f"Elapsed: {summary['elapsed_seconds']}s on {summary['workers']} workers")
+    print(f"Throughput: {summary['images_per_second']} images/s, "
+          f"{summary['images_per_second_per_core']} images/s per core")
+    return 0 if summary["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+"""
+Offline CPU benchmark for the detectors and the /analyze endpoint.
+
+    python benchmark.py                         # run and print a report
+    python benchmark.py --save-baseline         # also store the results as the baseline
+    python benchmark.py --sizes 640x480 --repeat 3
+
+Synthetic photos are generated in memory at each size and format (JPEG, PNG
+and HEIC when pillow-heif can encode it), plus a JPEG with a copy-move
+forgery; JPEG inputs also time the DCT-domain analysis of their bytes.
+Startup cases time a fresh interpreter importing and building the
+app under each ENGINE_LOADING mode, and up to its first /analyze response.
+Every case reports latency percentiles over --repeat timed runs and,
+from one extra run under tracemalloc (which also records the bytes
+written or sent, for cases that return them), the peak and retained Python/NumPy
+allocations. On Linux a further run reports the peak resident set growth,
+which also covers native buffers (libheif, OpenCV) that tracemalloc misses. Results are compared with the baseline JSON, and the exit status
+is 1 when any case's median latency or peak allocation regressed by more than
+--threshold.
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image, ImageChops, ImageEnhance
+
+from app import create_app
+from app.analysis import (
+    DEFAULT_SETTINGS,
+    MAX_ANALYSIS_PIXELS,
+    prepare_image,
+    resize_image_dimensions,
+    resize_image_file,
+)
+from app.artifacts import save_heatmap
+from app.copy_move import detect_copy_move
+from app.ela import detect_ela, heatmap_values as ela_values
+from app.metadata import extract_segments, summarize
+from app.noise import detect_noise, heatmap_values as noise_values
+from app.storage import artifact_names
+from app.utils import (
+    DecodedImage,
+    convert_heic_to_jpeg,
+    decode_heif,
+    copy_move_detection,
+    block_copy_move_detection,
+    ela_analysis,
+    jpeg_analysis,
+    metadata_analysis,
+    noise_analysis,
+    open_image,
+)
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def synthetic_photo(width, height, seed=0):
+    """
+    A photo-like RGB image: smooth gradients, blobs and sensor-style noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        128 + 100 * np.sin(x / (width / 3.0) + c) * np.cos(y / (height / 2.0) - c) for c in range(3)
+    ], axis=-1)
+    for _ in range(12):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(0.03, 0.15) * max(width, height)
+        blob = np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius * radius))
+        base += blob[..., None] * rng.uniform(-80, 80, 3)
+    base += rng.normal(0, 6, base.shape)
+    return Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+
+def copy_move_forgery(img, seed=0):
+    """
+    Paste a textured patch of img somewhere else in it.
+    """
+    rng = np.random.default_rng(seed)
+    pixels = np.array(img)
+    height, width = pixels.shape[:2]
+    size = max(32, min(width, height) // 6)
+    sx, sy = int(rng.integers(0, width // 2 - size)), int(rng.integers(0, height - size))
+    tx, ty = sx + width // 2, int(rng.integers(0, height - size))
+    pixels[ty:ty + size, tx:tx + size] = pixels[sy:sy + size, sx:sx + size]
+    return Image.fromarray(pixels)
+
+
+def _exif():
+    exif = Image.Exif()
+    exif[0x010F] = "BenchCam"  # Make
+    exif[0x0110] = "Model 1"  # Model
+    exif[0x0131] = "benchmark.py"  # Software
+    return exif.tobytes()
+
+
+def encode(img, fmt):
+    buffer = io.BytesIO()
+    if fmt == "jpeg":
+        img.save(buffer, format="JPEG", quality=92, exif=_exif())
+    elif fmt == "png":
+        img.save(buffer, format="PNG")
+    elif fmt == "heic":
+        # Cameras embed a small preview; the larger one exercises thumbnail decoding
+        img.save(buffer, format="HEIF", quality=90, exif=_exif(), thumbnails=[2048, 320])
+    return buffer.getvalue()
+
+
+def make_inputs(sizes, formats):
+    """
+    Return [(label, filename, data)] for every size and format, plus a copy-move forgery per size.
+    """
+    inputs = []
+    for width, height in sizes:
+        photo = synthetic_photo(width, height)
+        for fmt in formats:
+            inputs.append((f"{fmt}-{width}x{height}", f"bench.{fmt}", encode(photo, fmt)))
+        forged = copy_move_forgery(photo)
+        inputs.append((f"jpeg-copymove-{width}x{height}", "bench.jpeg", encode(forged, "jpeg")))
+    return inputs
+
+
+def percentile_summary(samples):
+    samples = np.asarray(samples) * 1000.0
+    return {
+        "runs": int(len(samples)),
+        "min_ms": round(float(samples.min()), 2),
+        "p50_ms": round(float(np.percentile(samples, 50)), 2),
+        "p90_ms": round(float(np.percentile(samples, 90)), 2),
+        "p99_ms": round(float(np.percentile(samples, 99)), 2),
+        "mean_ms": round(float(samples.mean()), 2),
+    }
+
+
+def _proc_status_kb(field):
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return None
+
+
+def peak_rss_growth(fn):
+    """
+    Resident set growth (MB) at the peak of one fn() run, or None off Linux.
+
+    Writing 5 to clear_refs resets the kernel's high-water mark (VmHWM).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        before = _proc_status_kb("VmRSS")
+    except OSError:
+        return None
+    fn()
+    peak = _proc_status_kb("VmHWM")
+    if before is None or peak is None:
+        return None
+    return round(max(0, peak - before) / 1024.0, 2)
+
+
+def measure(fn, repeat, warmup=1):
+    """
+    Time fn() over repeat runs, then run it once more under tracemalloc
+    and once more for peak resident memory.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    result = percentile_summary(samples)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    produced = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["peak_alloc_mb"] = round((peak - before) / 2 ** 20, 2)
+    result["retained_alloc_mb"] = round((current - before) / 2 ** 20, 2)
+    if isinstance(produced, int) and not isinstance(produced, bool):
+        result["bytes"] = produced
+    rss = peak_rss_growth(fn)
+    if rss is not None:
+        result["peak_rss_mb"] = rss
+    return result
+
+
+def decoded(data, filename):
+    img, exif = open_image(data, filename)
+    img.load()  # PIL decodes lazily; make the decode part of this case
+    image = DecodedImage(img, exif, name="bench", source_format=img.format)
+    return image.downscaled(MAX_ANALYSIS_PIXELS)
+
+
+def legacy_heic_prepare(data):
+    # What prepare_image did for HEIC uploads before the direct decode
+    img = convert_heic_to_jpeg(data)
+    img = resize_image_dimensions(img)
+    return resize_image_file(img, source_size=len(data))
+
+
+def legacy_ela(image, output_folder, quality):
+    # The single-quality ELA that ela_analysis replaced: PIL round trip, full-size diff
+    buffer = io.BytesIO()
+    image.pil.save(buffer, format="JPEG", quality=quality)
+    buffer.seek(0)
+    diff = ImageChops.difference(image.pil, Image.open(buffer))
+    max_diff = max(high for _, high in diff.getextrema())
+    scaled = ImageEnhance.Brightness(diff).enhance(255.0 / max_diff if max_diff else 1)
+    scaled.save(os.path.join(output_folder, image.name + "_ela_legacy.jpg"))
+    return max_diff
+
+
+def legacy_noise(image, output_folder):
+    # The global-variance check that noise_analysis replaced: one sharpening pass, no localization
+    kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    filtered = cv2.filter2D(image.gray, -1, kernel)
+    cv2.imwrite(os.path.join(output_folder, image.name + "_noise_legacy.jpg"), filtered)
+    return float(np.var(filtered))
+
+
+def legacy_artifacts(image, found, output_folder):
+    # What an analysis wrote before the compact artifacts: full-size color JPEGs with the regions burned in
+    ela, noise, copy_move = found
+    sizes = 0
+    heatmap = cv2.applyColorMap(ela_values(ela["diff"], ela["max_diff"]), cv2.COLORMAP_INFERNO)
+    for region in ela["regions"]:
+        x, y, w, h = region["box"]
+        cv2.rectangle(heatmap, (x, y), (x + w, y + h), (255, 255, 0), 2)
+    sizes += _write_jpeg(heatmap, os.path.join(output_folder, "bench_ela_legacy.jpg"), 75)
+
+    sigma = noise["sigma"]
+    levels = cv2.convertScaleAbs(sigma, alpha=255.0 / max(float(np.percentile(sigma, 99)), 1e-3))
+    full = cv2.resize(levels, (sigma.shape[1] * 8, sigma.shape[0] * 8), interpolation=cv2.INTER_LINEAR)
+    heatmap = cv2.applyColorMap(full[:image.size[1], :image.size[0]], cv2.COLORMAP_JET)
+    sizes += _write_jpeg(heatmap, os.path.join(output_folder, "bench_noise_legacy.jpg"), 75)
+
+    overlay = image.bgr.copy()
+    tinted = overlay.copy()
+    tinted[copy_move["mask"] > 0] = (0, 0, 255)
+    cv2.addWeighted(tinted, 0.4, overlay, 0.6, 0, dst=overlay)
+    sizes += _write_jpeg(overlay, os.path.join(output_folder, "bench_copy_move_legacy.jpg"), 95)
+    return sizes
+
+
+def _write_jpeg(pixels, path, quality):
+    cv2.imwrite(path, pixels, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return os.path.getsize(path)
+
+
+def compact_artifacts(image, found, output_folder):
+    # The same three results as ELA and noise heatmaps plus copy-move outlines
+    ela, noise, copy_move = found
+    ela_path, _ = save_heatmap(ela_values(ela["diff"], ela["max_diff"]), "inferno", output_folder, "bench_ela",
+                               DEFAULT_SETTINGS["artifact_format"], DEFAULT_SETTINGS["artifact_max_side"])
+    noise_path, _ = save_heatmap(noise_values(noise, *image.size), "jet", output_folder, "bench_noise", "png",
+                                 DEFAULT_SETTINGS["artifact_max_side"])
+    contours, _ = cv2.findContours(copy_move["mask"], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    polygons = [cv2.approxPolyDP(contour, 1.5, True).reshape(-1, 2).tolist() for contour in contours]
+    return os.path.getsize(ela_path) + os.path.getsize(noise_path) + len(json.dumps(polygons))
+
+
+def detector_cases(label, filename, data, output_folder):
+    """
+    Yield (case_name, fn) for every detector on one input.
+
+    Detectors are timed on an already decoded image; decoding is its own case.
+    """
+    yield f"decode/{label}", lambda: decoded(data, filename)
+    if filename.endswith(".heic"):
+        # Legacy pyheif + JPEG round-trip against the direct decode, alone and
+        # through the resize step that prepares an upload for analysis
+        yield f"convert_heic_to_jpeg/{label}", lambda: convert_heic_to_jpeg(data).load()
+        yield f"decode_heif/{label}", lambda: decode_heif(data)
+        yield f"decode_heif_reduced/{label}", lambda: decode_heif(data, MAX_ANALYSIS_PIXELS)
+        yield f"decode_heif_thumbnail/{label}", lambda: decode_heif(data, MAX_ANALYSIS_PIXELS, use_thumbnails=True)
+        yield f"heic_prepare_legacy/{label}", lambda: legacy_heic_prepare(data)
+        yield f"heic_prepare/{label}", lambda: prepare_image(data, filename)
+
+    prepared = decoded(data, filename)
+    segments = extract_segments(data)
+
+    def fresh():
+        # A new wrapper per run so arrays cached by an earlier run don't flatter the numbers
+        return DecodedImage(prepared.pil, prepared.exif, name="bench", source_format=prepared.format,
+                            segments=segments, source=data)
+
+    quality = DEFAULT_SETTINGS["ela_quality"]
+    yield f"ela_analysis_legacy/{label}", lambda: legacy_ela(fresh(), output_folder, quality)
+    yield f"ela_analysis/{label}", lambda: ela_analysis(fresh(), output_folder, quality)
+    yield f"noise_analysis_legacy/{label}", lambda: legacy_noise(fresh(), output_folder)
+    yield f"noise_analysis/{label}", lambda: noise_analysis(fresh(), output_folder)
+    yield f"copy_move_detection/{label}", lambda: copy_move_detection(fresh())
+    yield f"block_copy_move_detection/{label}", lambda: block_copy_move_detection(fresh())
+    # Rendering and encoding an analysis' artifacts alone, old against new; both report the bytes written
+    found = (detect_ela(prepared.gray, quality), detect_noise(prepared.gray, prepared.rgb),
+             detect_copy_move(prepared.gray))
+    yield f"artifacts_legacy/{label}", lambda: legacy_artifacts(fresh(), found, output_folder)
+    yield f"artifacts/{label}", lambda: compact_artifacts(fresh(), found, output_folder)
+    yield f"metadata_analysis/{label}", lambda: metadata_analysis(fresh())
+    if prepared.format == "JPEG":
+        max_pixels = DEFAULT_SETTINGS["jpeg_max_pixels"]
+        yield f"jpeg_analysis/{label}", lambda: jpeg_analysis(fresh(), output_folder, max_pixels)
+    yield f"read_metadata/{label}", lambda: summarize(extract_segments(data))
+
+
+def endpoint_case(client, data, filename):
+    """
+    POST /analyze like a browser would; returns the bytes sent, the response plus every artifact it references.
+    """
+    def post():
+        response = client.post(
+            "/analyze",
+            data={"file": (io.BytesIO(data), filename), "methods": "ela,noise,copy_move,metadata"},
+            content_type="multipart/form-data",
+            headers={"Accept-Encoding": "gzip"},
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"/analyze returned {response.status_code}: {response.get_data(as_text=True)}")
+        body = response.get_data()
+        sent = len(body)
+        if response.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        for name in artifact_names(json.loads(body)["results"]):
+            sent += len(client.get(f"/uploads/{name}").get_data())
+        return sent
+    return post
+
+
+FIRST_ANALYSIS_SCRIPT = """
+import io, sys
+from PIL import Image
+from app import create_app
+app = create_app()
+app.config["UPLOAD_FOLDER"] = sys.argv[1]
+buffer = io.BytesIO()
+Image.new("RGB", (256, 256), "gray").save(buffer, format="JPEG")
+response = app.test_client().post("/analyze", data={"file": (io.BytesIO(buffer.getvalue()), "a.jpg")},
+                                  content_type="multipart/form-data")
+assert response.status_code == 200, response.status_code
+"""
+
+
+def startup_case(mode, output_folder, script="from app import create_app; create_app()"):
+    """
+    Cold start: a fresh interpreter runs script with ENGINE_LOADING=mode.
+    """
+    env = dict(os.environ, ENGINE_LOADING=mode, HISTORY_ENABLED="0", FINGERPRINT_INDEX="0")
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def start():
+        subprocess.run([sys.executable, "-c", script, output_folder], env=env, cwd=root, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return start
+
+
+def startup_cases(output_folder):
+    for mode in ("lazy", "eager"):
+        yield f"startup/create_app/{mode}", startup_case(mode, output_folder)
+    yield "startup/first_analysis/lazy", startup_case("lazy", output_folder, FIRST_ANALYSIS_SCRIPT)
+
+
+def compare(results, baseline, threshold, floor=1.0):
+    """
+    Return [(case, metric, old, new)] for metrics that got worse by more than threshold.
+
+    Changes smaller than floor (ms or MB) are ignored; sub-millisecond cases
+    are too noisy to flag on ratio alone.
+    """
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "peak_alloc_mb", "peak_rss_mb"):
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            if new > old * threshold and new - old >= floor:
+                regressions.append((case, metric, old, new))
+    return regressions
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the tampering detectors and /analyze.")
+    parser.add_argument("--sizes", default="640x480,1920x1080,4000x3000",
+                        help="comma-separated WIDTHxHEIGHT list")
+    parser.add_argument("--formats", default="jpeg,png,heic", help="comma-separated formats")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--output", default=None, help="also write the results JSON here")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="ratio over the baseline that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [parse_size(size) for size in args.sizes.split(",") if size]
+    formats = [fmt.strip().lower() for fmt in args.formats.split(",") if fmt.strip()]
+    if "heic" in formats and pillow_heif is None:
+        print("pillow-heif is not installed; skipping HEIC inputs")
+        formats.remove("heic")
+
+    work_dir = tempfile.mkdtemp(prefix="tamper-bench-")
+    os.environ["CACHE_BACKEND"] = "none"  # every run must do the work
+    os.environ["DETECTOR_EXECUTOR"] = "inline"  # one CPU-bound request at a time
+    os.environ["RATE_LIMIT_ENABLED"] = "0"  # the endpoint cases post far faster than any client may
+    os.environ["SHED_EXPENSIVE_LOAD"] = os.environ["SHED_MODERATE_LOAD"] = "0"
+    app = create_app()
+    app.config["UPLOAD_FOLDER"] = work_dir
+    client = app.test_client()
+
+    results = {}
+
+    def run(case, fn):
+        if args.filter not in case:
+            return
+        # The detectors print progress; keep the report readable
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            result = measure(fn, args.repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        results[case] = result
+        print(f"{case:55s} p50 {result['p50_ms']:9.1f} ms  p90 {result['p90_ms']:9.1f} ms  "
+              f"peak {result['peak_alloc_mb']:8.1f} MB  rss {result.get('peak_rss_mb', float('nan')):8.1f} MB"
+              + (f"  {result['bytes'] / 1024:8.1f} KB" if "bytes" in result else ""))
+
+    try:
+        for case, fn in startup_cases(work_dir):
+            run(case, fn)
+        for label, filename, data in make_inputs(sizes, formats):
+            cases = list(detector_cases(label, filename, data, work_dir))
+            cases.append((f"analyze_image/{label}", endpoint_case(client, data, filename)))
+            for case, fn in cases:
+                run(case, fn)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "cases": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline.get("cases", {}), args.threshold)
+        print("-" * 60)
+        if regressions:
+            status = 1
+            for case, metric, old, new in regressions:
+                print(f"❌ {case} {metric}: {old} -> {new} ({new / old:.2f}x)")
+        else:
+            print(f"✅ No regressions over {args.threshold:.2f}x against {args.baseline}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
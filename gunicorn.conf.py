@@ -0,0 +1,28 @@
+"""
+Gunicorn settings, read automatically from the working directory.
+
+    gunicorn run:app                                  # as in the Procfile and Dockerfile
+    GUNICORN_PRELOAD=1 ENGINE_LOADING=eager gunicorn run:app
+
+By default each worker imports the app cheaply and the post_fork hook starts
+loading the analysis engines in a background thread, so /ready turns 200
+once they are in. With GUNICORN_PRELOAD=1 and ENGINE_LOADING=eager the
+master loads them once before forking and every worker starts ready.
+
+Each worker starts its artifact garbage collector once its app is loaded
+(post_worker_init); the master never runs one, so it forks without threads.
+"""
+import os
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "0") == "1"
+
+
+def post_fork(server, worker):
+    if os.environ.get("ENGINE_LOADING", "background") == "background":
+        from app.engines import load_in_background
+        load_in_background()
+
+
+def post_worker_init(worker):
+    from app.upload import start_artifact_gc
+    start_artifact_gc(worker.wsgi)
@@ -0,0 +1,69 @@
+"""
+Bulk build of the near-duplicate index: fingerprint every image under a directory.
+
+    python index_images.py /path/to/archive --workers 8
+
+Images go through the same decode as /analyze, so their pixel digests match
+later uploads of the same picture. Rows are inserted in batches, and images
+already in the index are skipped, so re-running after an interruption only
+costs the decoding.
+"""
+import argparse
+import os
+import sys
+
+from app import create_app
+from app.batch import fingerprint_item, iter_image_files
+from app.fingerprint import get_fingerprint_index
+from app.jobs import make_executor
+from app.upload import _index_settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fingerprint a directory of images into the near-duplicate index.")
+    parser.add_argument("directory", help="directory to scan (recursively)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per database insert")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = create_app()
+    settings = _index_settings(app)
+    if settings is None:
+        print("❌ FINGERPRINT_INDEX is off")
+        return 1
+    index = get_fingerprint_index(settings)
+    paths = dict(iter_image_files(args.directory, app.config["ALLOWED_EXTENSIONS"]))
+    executor = make_executor("process", args.workers)
+    pending = []
+    inserted = errors = 0
+    try:
+        for count, (key, digest, found) in enumerate(
+                executor.map(fingerprint_item, paths, paths.values(), chunksize=16), start=1):
+            if digest is None:
+                errors += 1
+                print(f"[{count}] {key}: error ({found})")
+                continue
+            pending.append((digest, found))
+            if len(pending) >= args.batch_size:
+                inserted += index.add_many(pending)
+                pending = []
+                print(f"[{count}/{len(paths)}] {inserted} new fingerprints")
+    except KeyboardInterrupt:
+        print("\n🛑 Interrupted; re-run the same command to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return 130
+    finally:
+        if pending:
+            inserted += index.add_many(pending)
+    executor.shutdown()
+
+    print("-" * 60)
+    print(f"Images: {len(paths)} ({errors} errors), {inserted} new fingerprints")
+    return 0 if errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
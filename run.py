@@ -1,4 +1,5 @@
 from app import create_app, db
+from app.upload import start_artifact_gc
 import sys, os
 
 app = create_app()
@@ -12,6 +13,7 @@ if __name__ == "__main__":
         print("⚡ Press Ctrl+C to stop the server")
         print("-" * 60)
         db.create_all()
+    start_artifact_gc(app)
     try:
         #app.run(debug=True, host="0.0.0.0", port=5001)
         app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5001)))
@@ -24,6 +26,3 @@ if __name__ == "__main__":
 @app.errorhandler(500)
 def internal_error(error):
     return "Something went wrong: " + str(error), 500
-
-for rule in app.url_map.iter_rules():
-    print(f"{rule.endpoint}: {rule.rule}")
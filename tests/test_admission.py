@@ -0,0 +1,147 @@
+"""
+AdmissionController: a standing queue for a slot is shed, a burst is not.
+
+The controller runs on a fake clock in a single thread. Its condition
+variable is replaced by one whose wait() jumps the clock to the next
+scripted event (a slot being released), so every wait is exact.
+"""
+import types
+
+import pytest
+
+from app import ratelimit
+from app.ratelimit import AdmissionController, Overloaded
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ScriptedCondition:
+    """
+    Stands in for the controller's Condition: wait(timeout) advances the
+    clock to the next scripted (time, action) event, or by timeout if
+    there is none sooner, and runs the action.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+
+    def at(self, when, action):
+        self.events.append((when, action))
+        self.events.sort(key=lambda event: event[0])
+
+    def wait(self, timeout=None):
+        deadline = self.clock.now + timeout
+        if self.events and self.events[0][0] <= deadline:
+            when, action = self.events.pop(0)
+            self.clock.now = when
+            action()
+        else:
+            self.clock.now = deadline
+
+    def notify(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", types.SimpleNamespace(monotonic=clock, time=clock))
+    return clock
+
+
+def controller(clock, limit=1, **options):
+    admission = AdmissionController(limit, target=0.5, interval=2.0, **options)
+    admission._cond = ScriptedCondition(clock)
+    return admission
+
+
+def hold(admission):
+    """
+    Take a slot and return the function that gives it back.
+    """
+    slot = admission.slot()
+    slot.__enter__()
+    return lambda: slot.__exit__(None, None, None)
+
+
+def test_burst_that_drains_within_the_interval_is_not_shed(clock):
+    admission = controller(clock)
+    release = hold(admission)
+    clock.now += 2.0  # the burst starts a fresh interval
+    # Each arrival queues behind the one before it, then takes over its slot; the first gets in quickly
+    for wait in (0.2, 0.8, 0.8):
+        admission._cond.at(clock.now + wait, release)
+        release = hold(admission)
+        assert admission.last_wait == pytest.approx(wait)
+
+    clock.now += 0.5  # the next interval starts with the slot still busy
+    admission._cond.at(clock.now + 0.3, release)
+    release = hold(admission)
+    assert not admission.overloaded
+    release()
+
+
+def test_standing_queue_is_shed_until_a_request_gets_through_quickly(clock):
+    admission = controller(clock)
+    release = hold(admission)
+    clock.now += 2.0
+    # Every request in this interval waits a whole second for the slot
+    for _ in range(2):
+        admission._cond.at(clock.now + 1.0, release)
+        release = hold(admission)
+    assert admission.last_wait == pytest.approx(1.0)
+
+    clock.now += 0.5  # a new interval: the quickest wait in the last one exceeded target
+    with pytest.raises(Overloaded) as shed:
+        with admission.slot():
+            pass
+    assert shed.value.reason == "latency"
+    assert admission.overloaded and admission.waiting == 0
+
+    # A free slot is still handed out, and a quick admission ends the shedding
+    release()
+    with admission.slot():
+        pass
+    assert not admission.overloaded
+
+
+def test_request_waiting_max_wait_is_shed(clock):
+    admission = controller(clock, max_wait=5.0)
+    release = hold(admission)
+    started = clock.now
+    with pytest.raises(Overloaded) as shed:
+        with admission.slot():
+            pass
+    assert shed.value.reason == "timeout"
+    assert clock.now - started == pytest.approx(5.0)
+    assert admission.waiting == 0 and admission.active == 1
+    release()
+
+
+@pytest.mark.parametrize("waiting, expected", [(0, 2), (3, 8), (7, 16)])
+def test_retry_after_covers_the_queue_ahead(clock, waiting, expected):
+    admission = controller(clock, limit=2)
+    for _ in range(3):
+        with admission.slot():
+            clock.now += 4.0  # every analysis holds its slot for 4 seconds
+    admission.waiting = waiting
+    # (waiting + this request) / 2 slots, 4 seconds each
+    assert admission._retry_after() == expected
+
+
+def test_retry_after_falls_back_to_target_and_is_at_least_one_second(clock):
+    admission = controller(clock, limit=4)
+    assert admission._retry_after() == 1
@@ -0,0 +1,88 @@
+"""
+The analysis pipeline: how detector failures and timeouts are reported and cached,
+and how concurrent requests share the artifact store.
+"""
+import io
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import analysis, utils
+from app.detectors import Detector, ExecutionPlan
+from app.storage import get_artifact_store, is_valid_key
+
+CACHE = {"backend": "memory", "max_bytes": 64 * 1024 * 1024, "max_age": 3600}
+
+
+@pytest.fixture
+def upload():
+    pixels = np.random.default_rng(0).integers(0, 255, (96, 128, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_failed_detector_is_reported_and_not_cached(upload, tmp_path, monkeypatch):
+    def out_of_memory(*args):
+        raise MemoryError("no room for the error map")
+
+    monkeypatch.setattr(utils, "detect_ela", out_of_memory)
+    for _ in range(2):
+        results = analysis.analyze_bytes(upload, "fail.png", ["ela"], str(tmp_path), cache_settings=CACHE)
+        assert results["method_status"] == {"ela": "error"}
+        assert results["cache_hits"] == []
+        assert "no room" in results["ela_error"]
+
+    monkeypatch.undo()
+    results = analysis.analyze_bytes(upload, "fail.png", ["ela"], str(tmp_path), cache_settings=CACHE)
+    assert results["method_status"] == {"ela": "ok"}
+    assert results["cache_hits"] == []
+
+
+def test_overdue_detector_does_not_hold_the_response(upload):
+    release = threading.Event()
+
+    def stubborn(image, output_folder, settings):
+        release.wait(5)  # never calls deadlines.check()
+        return {"stubborn_result": "late"}
+
+    def quick(image, output_folder, settings):
+        return {"quick_result": "done"}
+
+    image = analysis.prepare_image(upload, "slow.png")
+    todo = ExecutionPlan([Detector("stubborn", stubborn, inputs=()), Detector("quick", quick, inputs=())])
+    started = time.monotonic()
+    try:
+        per_method, status = analysis._execute(image, todo, None, {}, "thread", 2, 0.2)
+        assert time.monotonic() - started < 1.0
+    finally:
+        release.set()
+    assert status == {"stubborn": "timeout", "quick": "ok"}
+    assert per_method["stubborn"] == {"stubborn_error": "Timed out after 0.2 seconds"}
+    assert per_method["quick"] == {"quick_result": "done"}
+
+
+def test_concurrent_requests_for_one_image_publish_their_own_renders(upload, tmp_path):
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    storage = {"backend": "local", "directory": str(tmp_path / "store")}
+    start = threading.Barrier(4)
+    found = []
+
+    def analyze():
+        start.wait()
+        found.append(analysis.analyze_bytes(upload, "same.png", ["ela"], str(scratch), storage_settings=storage))
+
+    threads = [threading.Thread(target=analyze) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store = get_artifact_store(storage)
+    assert len({results["ela_image"] for results in found}) == 1
+    assert all(is_valid_key(results["ela_image"]) and store.exists(results["ela_image"]) for results in found)
+    assert list(scratch.iterdir()) == []
@@ -0,0 +1,17 @@
+"""
+Cache backends' size accounting and eviction.
+"""
+from app.cache import DiskCache
+
+
+def test_disk_cache_overwrite_replaces_the_old_size(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    for _ in range(20):
+        cache.set("entry", b"x" * 300)
+    assert cache._size == 300
+    cache.set("entry", b"x" * 100)
+    assert cache._size == 100
+
+    cache.set("other", b"y" * 500)
+    assert cache.get("entry") == b"x" * 100  # nothing evicted while the total stays under max_bytes
+    assert cache._size == 600
@@ -0,0 +1,37 @@
+"""
+JobQueue backpressure: queued jobs and reserved slots share max_pending.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.jobs import JobQueue, QueueFull
+
+
+@pytest.fixture
+def queue():
+    executor = ThreadPoolExecutor(max_workers=1)
+    yield JobQueue(executor, max_pending=3)
+    executor.shutdown()
+
+
+def test_reserved_slots_count_against_max_pending(queue):
+    queue.reserve(2)
+    assert queue.pending() == 2
+    release = threading.Event()
+    queue.submit(release.wait, 5)
+    with pytest.raises(QueueFull):
+        queue.submit(release.wait, 5)
+    with pytest.raises(QueueFull):
+        queue.reserve(1)
+
+    queue.release(2)
+    queue.reserve(2)
+    release.set()
+
+
+def test_reserve_refuses_more_than_max_pending(queue):
+    with pytest.raises(QueueFull):
+        queue.reserve(4)
+    assert queue.pending() == 0
@@ -0,0 +1,94 @@
+"""
+The built-in baseline JPEG decoder and the double compression analysis.
+
+Coefficients read by read_luma_coefficients are dequantized and inverse
+transformed back to pixels, which must match libjpeg's own decode (through
+OpenCV) to within its rounding.
+"""
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import jpeg
+from app.deadlines import Deadline, DeadlineExceeded, running
+
+
+def photo(width, height, seed=0, noise=6):
+    rng = np.random.default_rng(seed)
+    base = cv2.resize(rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8), (width, height),
+                      interpolation=cv2.INTER_CUBIC)
+    return np.clip(base + rng.normal(0, noise, (height, width, 3)), 0, 255).astype(np.uint8)
+
+
+def pil_jpeg(pixels, **options):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", **options)
+    return buffer.getvalue()
+
+
+def cv2_jpeg(pixels, *params):
+    ok, encoded = cv2.imencode(".jpg", cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR), list(params))
+    assert ok
+    return encoded.tobytes()
+
+
+def luma_from_coefficients(coefs, table):
+    n = np.arange(8)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 16) * np.sqrt(2 / 8)
+    basis[0] /= np.sqrt(2)
+    rows, cols = coefs.shape[:2]
+    blocks = (coefs.astype(np.float64) * np.asarray(table, np.float64)).reshape(rows, cols, 8, 8)
+    pixels = basis.T @ blocks @ basis + 128
+    return np.clip(pixels, 0, 255).transpose(0, 2, 1, 3).reshape(rows * 8, cols * 8)
+
+
+@pytest.mark.parametrize("data", [
+    pytest.param(pil_jpeg(photo(203, 141), quality=90, subsampling=0), id="4:4:4"),
+    pytest.param(pil_jpeg(photo(203, 141), quality=90, subsampling=1), id="4:2:2"),
+    pytest.param(pil_jpeg(photo(203, 141), quality=75, subsampling=2), id="4:2:0"),
+    pytest.param(pil_jpeg(photo(203, 141)[..., 0], quality=85), id="grayscale"),
+    pytest.param(cv2_jpeg(photo(203, 141), cv2.IMWRITE_JPEG_QUALITY, 80, cv2.IMWRITE_JPEG_RST_INTERVAL, 3),
+                 id="restart-interval"),
+])
+def test_luma_coefficients_match_libjpeg(data, monkeypatch):
+    monkeypatch.setattr(jpeg, "jpegio", None)
+    coefs, table = jpeg.read_luma_coefficients(data)
+
+    expected = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE).astype(np.float64)
+    height, width = expected.shape
+    assert coefs.shape == (-(-height // 8), -(-width // 8), 64)
+    error = np.abs(luma_from_coefficients(coefs, table)[:height, :width] - expected)
+    # libjpeg's integer IDCT rounds to whole gray levels; the float one here doesn't
+    assert error.mean() < 0.3
+    assert error.max() < 0.75
+
+
+def test_progressive_jpeg_needs_jpegio(monkeypatch):
+    monkeypatch.setattr(jpeg, "jpegio", None)
+    with pytest.raises(jpeg.UnsupportedJpeg):
+        jpeg.read_luma_coefficients(pil_jpeg(photo(64, 64), progressive=True))
+
+
+def test_decoder_stops_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(jpeg, "jpegio", None)
+    deadline = Deadline()
+    deadline.cancel()
+    with pytest.raises(DeadlineExceeded), running(deadline):
+        jpeg.read_luma_coefficients(pil_jpeg(photo(64, 64)))
+
+
+def test_double_compression_finds_the_first_quality(monkeypatch):
+    monkeypatch.setattr(jpeg, "jpegio", None)
+    pixels = photo(512, 384)
+    first = np.asarray(Image.open(io.BytesIO(pil_jpeg(pixels, quality=60))).convert("RGB"))
+
+    found = jpeg.double_compression(*jpeg.read_luma_coefficients(pil_jpeg(first, quality=90)))
+    assert found["double_compressed"]
+    assert abs(found["primary_quality"] - 60) <= 5
+
+    found = jpeg.double_compression(*jpeg.read_luma_coefficients(pil_jpeg(pixels, quality=90)))
+    assert not found["double_compressed"]
+    assert found["regions"] == []
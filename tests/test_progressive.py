@@ -0,0 +1,34 @@
+"""
+Chained progressive stages: one decode, handed on through scratch files.
+"""
+import io
+import os
+import pickle
+
+import numpy as np
+from PIL import Image
+
+from app.progressive import analyze_stage
+
+
+def test_stages_share_one_decode_without_passing_pixels(tmp_path):
+    pixels = np.random.default_rng(0).integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    path = str(tmp_path / "upload")
+    with open(path, "wb") as fh:
+        fh.write(buffer.getvalue())
+    output = str(tmp_path)
+
+    full, handoff = analyze_stage(path, "photo.png", ["ela", "noise"], output)
+    assert "decode" in full["timings"]
+    assert set(handoff) == {"digests", "parked"}
+    assert os.path.exists(handoff["parked"]["path"])
+    assert len(pickle.dumps(handoff)) < 4096
+
+    copy_move, handoff = analyze_stage(path, "photo.png", ["copy_move"], output, handoff=handoff, final=True)
+    assert copy_move["method_status"] == {"copy_move": "ok"}
+    assert "decode" not in copy_move["timings"]
+    assert copy_move["image_digest"] == full["image_digest"]
+    assert handoff is None
+    assert not os.path.exists(path) and not os.path.exists(path + ".npy")
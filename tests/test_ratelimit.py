@@ -0,0 +1,62 @@
+"""
+Token buckets: the Redis Lua script must agree with MemoryBuckets.
+
+The script runs in fakeredis's embedded Lua (lupa), so both stores are fed
+the same sequence of takes and must give the same answers.
+"""
+import random
+
+import pytest
+
+from app.ratelimit import MemoryBuckets, RedisBuckets
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+LIMITS = {"user:1": (1.0, 60.0), "ip:10.0.0.1": (2.0, 120.0)}
+
+
+@pytest.fixture
+def stores():
+    return MemoryBuckets(), RedisBuckets(client=fakeredis.FakeRedis())
+
+
+def test_full_buckets_allow_and_take(stores):
+    for buckets in stores:
+        assert buckets.take(LIMITS, 10, now=1000.0) == (True, 0.0, 50.0)
+        assert buckets.level("user:1", 1.0, 60.0, 1000.0) == 50.0
+        assert buckets.level("ip:10.0.0.1", 2.0, 120.0, 1000.0) == 110.0
+
+
+def test_refused_take_reports_wait_and_takes_nothing(stores):
+    for buckets in stores:
+        assert buckets.take(LIMITS, 55, now=1000.0)[0]
+        allowed, wait, left = buckets.take(LIMITS, 10, now=1001.0)
+        assert not allowed
+        assert wait == pytest.approx(4.0)  # the user bucket holds 6 tokens, refilling at 1 per second
+        assert left == pytest.approx(-4.0)
+        assert buckets.level("ip:10.0.0.1", 2.0, 120.0, 1001.0) == pytest.approx(67.0)
+
+
+def test_cost_beyond_burst_needs_a_full_bucket(stores):
+    for buckets in stores:
+        assert buckets.take({"ip:a": (1.0, 5.0)}, 50, now=0.0)[0]
+        allowed, wait, _ = buckets.take({"ip:a": (1.0, 5.0)}, 50, now=1.0)
+        assert not allowed
+        assert wait == pytest.approx(4.0)
+
+
+def test_script_matches_memory_buckets(stores):
+    memory, redis = stores
+    rng = random.Random(0)
+    now = 1000.0
+    for _ in range(500):
+        now += rng.choice((0.0, 0.1, 0.5, 2.0, 30.0))
+        limits = dict(rng.sample(sorted(LIMITS.items()), rng.randint(1, 2)))
+        cost = rng.choice((0.5, 1.0, 7.5, 25.0, 200.0))
+        consume = rng.random() < 0.8
+        expected = memory.take(limits, cost, now, consume)
+        allowed, wait, left = redis.take(limits, cost, now, consume)
+        assert allowed == expected[0]
+        assert wait == pytest.approx(expected[1])
+        assert left == pytest.approx(expected[2])